@@ -0,0 +1,144 @@
+"""Account deletion for Warbler.
+
+Deleting a user through the ORM loads their messages, likes and follows
+into the session and deletes them row by row, all in one transaction that
+holds locks on everything it touches. `delete_user` instead only marks the
+account deleted (`users.deleted_at`), which hides it at once: it can't log
+in, its profile and listings 404 or leave it out, and its messages drop
+out of timelines, search and likes pages and can't be liked
+(`Message.with_author` and `likes.toggle_like` skip deleted authors). It
+also queues `purge_user`.
+
+`purge_user` removes what the account left behind in batches of at most
+ACCOUNT_PURGE_BATCH_SIZE rows, each batch a job and a transaction of its
+own, fixing up other users' counters with set-based UPDATEs as it goes:
+
+1. likes of the user's messages (their likers' like counts)
+2. the user's messages and their timeline entries
+3. the user's likes (the liked messages' counts)
+4. follows both ways (the other users' following/followers counts)
+
+and finally deletes the user row, letting the database's ON DELETE
+CASCADE clear whatever else refers to it.
+"""
+
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+
+from models import db, Follows, Likes, Message, TimelineEntry, User
+import counters
+import jobs
+import timeline
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def batch_size():
+    return current_app.config.get('ACCOUNT_PURGE_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+
+
+def delete_user(user_id):
+    """Mark `user_id` deleted and queue the cleanup; the caller commits."""
+
+    (User
+     .query
+     .filter(User.id == user_id)
+     .update({User.deleted_at: datetime.utcnow()}, synchronize_session=False))
+    timeline.author_changed(user_id)
+    jobs.enqueue(purge_user, key=f'purge_user:{user_id}', user_id=user_id)
+
+
+@jobs.task(concurrency=2)
+def purge_user(user_id):
+    """Job: delete a batch of what `user_id` left behind.
+
+    Queues itself again until nothing is left, then deletes the user.
+    """
+
+    size = batch_size()
+    for step in [_likes_of_messages, _messages, _likes, _following, _followers]:
+        if step(user_id, size):
+            jobs.enqueue(purge_user, user_id=user_id)
+            return
+
+    User.query.filter(User.id == user_id).delete(synchronize_session=False)
+
+
+def _likes_of_messages(user_id, size):
+    rows = (db.session
+            .query(Likes.id, Likes.user_id)
+            .join(Message, Message.id == Likes.message_id)
+            .filter(Message.user_id == user_id)
+            .limit(size)
+            .all())
+    if not rows:
+        return 0
+
+    counters.adjust(User, 'likes_count',
+                    {liker: -n for liker, n in Counter(liker for _, liker in rows).items()})
+    return _delete(Likes, Likes.id, [like_id for like_id, _ in rows])
+
+
+def _messages(user_id, size):
+    ids = [message_id for (message_id,) in db.session
+           .query(Message.id)
+           .filter(Message.user_id == user_id)
+           .limit(size)]
+    if not ids:
+        return 0
+
+    _delete(TimelineEntry, TimelineEntry.message_id, ids)
+    return _delete(Message, Message.id, ids)
+
+
+def _likes(user_id, size):
+    rows = (db.session
+            .query(Likes.id, Likes.message_id)
+            .filter(Likes.user_id == user_id)
+            .limit(size)
+            .all())
+    if not rows:
+        return 0
+
+    counters.adjust(Message, 'likes_count',
+                    {message_id: -n for message_id, n
+                     in Counter(message_id for _, message_id in rows).items()})
+    return _delete(Likes, Likes.id, [like_id for like_id, _ in rows])
+
+
+def _following(user_id, size):
+    ids = [followed_id for (followed_id,) in db.session
+           .query(Follows.user_being_followed_id)
+           .filter(Follows.user_following_id == user_id)
+           .limit(size)]
+    if not ids:
+        return 0
+
+    counters.adjust(User, 'followers_count', dict.fromkeys(ids, -1))
+    return (Follows
+            .query
+            .filter(Follows.user_following_id == user_id,
+                    Follows.user_being_followed_id.in_(ids))
+            .delete(synchronize_session=False))
+
+
+def _followers(user_id, size):
+    ids = [follower_id for (follower_id,) in db.session
+           .query(Follows.user_following_id)
+           .filter(Follows.user_being_followed_id == user_id)
+           .limit(size)]
+    if not ids:
+        return 0
+
+    counters.adjust(User, 'following_count', dict.fromkeys(ids, -1))
+    return (Follows
+            .query
+            .filter(Follows.user_being_followed_id == user_id,
+                    Follows.user_following_id.in_(ids))
+            .delete(synchronize_session=False))
+
+
+def _delete(model, column, ids):
+    return model.query.filter(column.in_(ids)).delete(synchronize_session=False)
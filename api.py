@@ -0,0 +1,279 @@
+"""Versioned JSON API for Warbler, served under /api/v1.
+
+The read endpoints select plain column tuples (no ORM objects, so no
+identity map, relationship loading or attribute instrumentation) and turn
+them straight into JSON. Message lists use the same keyset cursors as the
+HTML pages; user and like lists are keyed on ids. Every list takes
+`limit` (at most MAX_LIMIT) and `before`, the `next_cursor` of the
+previous page.
+
+Responses are encoded with orjson when it is installed, otherwise with
+the standard library's json.
+"""
+
+import json
+
+from flask import Blueprint, Response, abort, g, request
+from werkzeug.exceptions import HTTPException
+
+from models import db, Follows, Likes, Message, User
+from likes import liked_ids, toggle_like
+from querybudget import query_budget
+import identity
+import pagination
+import timeline
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MAX_LIMIT = 100
+
+MESSAGE_COLUMNS = (Message.id, Message.text, Message.timestamp,
+                   Message.likes_count, Message.user_id,
+                   User.username, User.image_url)
+
+USER_COLUMNS = (User.id, User.username, User.image_url, User.bio)
+
+PROFILE_COLUMNS = USER_COLUMNS + (User.header_image_url, User.location,
+                                  User.messages_count, User.following_count,
+                                  User.followers_count, User.likes_count)
+
+blueprint = Blueprint('api', __name__, url_prefix='/api/v1')
+
+
+##############################################################################
+# Encoding
+
+
+def dumps(payload):
+    """Encode `payload` as compact JSON bytes."""
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+
+def respond(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+def message_json(row, liked):
+    """A MESSAGE_COLUMNS row as JSON; `liked` is the viewer's liked ids."""
+
+    return {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': row.timestamp.isoformat(),
+        'likes_count': row.likes_count,
+        'liked': row.id in liked,
+        'user': {
+            'id': row.user_id,
+            'username': row.username,
+            'image_url': row.image_url,
+        },
+    }
+
+
+def messages_page(user_id, items, next_cursor):
+    """A page of message rows, marked with what `user_id` has liked."""
+
+    liked = liked_ids(user_id, [row.id for row in items])
+    return respond({'items': [message_json(row, liked) for row in items],
+                    'next_cursor': next_cursor})
+
+
+##############################################################################
+# Queries
+
+
+def message_rows():
+    """Column-only query for messages with their author's name and picture.
+
+    Leaves out messages by deleted accounts, like `Message.with_author`.
+    """
+
+    return (db.session
+            .query(*MESSAGE_COLUMNS)
+            .select_from(Message)
+            .join(User, User.id == Message.user_id)
+            .filter(User.deleted_at.is_(None)))
+
+
+def limit_arg():
+    """Page size from the querystring, capped at MAX_LIMIT (400 if < 1)."""
+
+    limit = request.args.get('limit', pagination.per_page(), type=int)
+    if limit < 1:
+        abort(400, "limit must be at least 1.")
+
+    return min(limit, MAX_LIMIT)
+
+
+def id_page(query, id_col, limit):
+    """Up to `limit` rows of `query` by descending `id_col`, and the cursor.
+
+    The cursor is the last row's id; `before` asks for rows after it.
+    """
+
+    before = request.args.get('before', type=int)
+    if before is not None:
+        query = query.filter(id_col < before)
+
+    rows = query.order_by(id_col.desc()).limit(limit + 1).all()
+    next_cursor = str(rows[limit - 1][0]) if len(rows) > limit else None
+
+    return rows[:limit], next_cursor
+
+
+def require_user(user_id):
+    """404 unless `user_id` exists."""
+
+    if not db.session.query(User.query.filter(
+            User.id == user_id, User.deleted_at.is_(None)).exists()).scalar():
+        abort(404, "No such user.")
+
+
+##############################################################################
+# Endpoints
+
+
+@blueprint.before_request
+def require_login():
+    if not g.user:
+        abort(401, "Access unauthorized.")
+
+
+@blueprint.errorhandler(HTTPException)
+def error(e):
+    return respond({'error': e.description}, e.code)
+
+
+@blueprint.route('/timeline')
+@query_budget(8)
+def home_timeline():
+    """The logged-in user's home timeline, newest first."""
+
+    user_id = g.user.id
+    page = timeline.page(user_id, before=pagination.cursor_arg(),
+                         limit=limit_arg(), messages=message_rows())
+
+    return messages_page(user_id, page.items, page.next_cursor)
+
+
+@blueprint.route('/users/<int:user_id>')
+@query_budget(3)
+def user_profile(user_id):
+    """A user's profile and counts, and whether the viewer follows them."""
+
+    row = (db.session
+           .query(*PROFILE_COLUMNS)
+           .filter(User.id == user_id, User.deleted_at.is_(None))
+           .first())
+    if row is None:
+        abort(404, "No such user.")
+
+    profile = row._asdict()
+    profile['following'] = user_id in g.user.following_ids_among([user_id])
+    return respond(profile)
+
+
+@blueprint.route('/users/<int:user_id>/messages')
+@query_budget(4)
+def user_messages(user_id):
+    """A user's messages, newest first."""
+
+    require_user(user_id)
+    page = pagination.paginate(message_rows().filter(Message.user_id == user_id),
+                               Message.timestamp, Message.id,
+                               before=pagination.cursor_arg(), limit=limit_arg())
+
+    return messages_page(g.user.id, page.items, page.next_cursor)
+
+
+def users_page(query):
+    """A page of USER_COLUMNS rows, marked with whom the viewer follows."""
+
+    items, next_cursor = id_page(query, User.id, limit_arg())
+    following = g.user.following_ids_among(row.id for row in items)
+
+    return respond({'items': [dict(row._asdict(), following=row.id in following)
+                              for row in items],
+                    'next_cursor': next_cursor})
+
+
+@blueprint.route('/users/<int:user_id>/following')
+@query_budget(4)
+def user_following(user_id):
+    """Users `user_id` follows, newest account first."""
+
+    require_user(user_id)
+    return users_page(db.session
+                      .query(*USER_COLUMNS)
+                      .join(Follows, Follows.user_being_followed_id == User.id)
+                      .filter(Follows.user_following_id == user_id,
+                              User.deleted_at.is_(None)))
+
+
+@blueprint.route('/users/<int:user_id>/followers')
+@query_budget(4)
+def user_followers(user_id):
+    """Users following `user_id`, newest account first."""
+
+    require_user(user_id)
+    return users_page(db.session
+                      .query(*USER_COLUMNS)
+                      .join(Follows, Follows.user_following_id == User.id)
+                      .filter(Follows.user_being_followed_id == user_id,
+                              User.deleted_at.is_(None)))
+
+
+@blueprint.route('/users/<int:user_id>/likes')
+@query_budget(4)
+def user_likes(user_id):
+    """Messages `user_id` has liked, newest like first."""
+
+    require_user(user_id)
+    query = (message_rows()
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id)
+             .with_entities(Likes.id.label('like_id'), *MESSAGE_COLUMNS))
+    items, next_cursor = id_page(query, Likes.id, limit_arg())
+
+    return messages_page(g.user.id, items, next_cursor)
+
+
+@blueprint.route('/messages/<int:message_id>')
+@query_budget(3)
+def message(message_id):
+    """A single message."""
+
+    row = message_rows().filter(Message.id == message_id).first()
+    if row is None:
+        abort(404, "No such message.")
+
+    return respond(message_json(row, liked_ids(g.user.id, [row.id])))
+
+
+@blueprint.route('/messages/<int:message_id>/like', methods=['POST'])
+@query_budget(6)
+def message_like(message_id):
+    """Toggle a like and return the new state.
+
+    Responds with {"liked": bool, "likes_count": int} so the page can
+    update the button without reloading. (One statement on Postgres; the
+    budget covers the SQLite fallback.)
+    """
+
+    user_id = g.user.id
+    state = toggle_like(user_id, message_id)
+    if state is None:
+        db.session.rollback()
+        abort(404, "No such message.")
+
+    db.session.commit()
+
+    identity.user_cache.invalidate(user_id)
+
+    return respond(state._asdict())
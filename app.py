@@ -1,45 +1,141 @@
 import os
+from datetime import datetime, timedelta
+from operator import attrgetter
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, abort
+from flask.ctx import _AppCtxGlobals
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from models import db, connect_db, User, Message, Likes, Follows
+from passwords import PasswordPoolFull
+import timeline
+import pagination
+import counters
+import search
+import querybudget
+import loader
+import identity
+import migrate
+import bulkload
+import metrics
+import caching
+import fragments
+import streaming
+import follows
+import writebehind
+import jobs
+import accounts
+import api
+from likes import liked_ids, toggle_like
+from querybudget import query_budget
+from writebehind import LIKE, write_buffer
 
 import pdb
 
 CURR_USER_KEY = "curr_user"
 
+
+
+class AppGlobals(_AppCtxGlobals):
+    """Flask `g` that loads the logged-in user the first time `g.user` is read.
+
+    Requests that never look at `g.user` (static files, redirects) skip the
+    lookup entirely.
+    """
+
+    def __getattr__(self, name):
+        if name != 'user':
+            raise AttributeError(name)
+
+        self.user = load_current_user()
+        return self.user
+
+
 app = Flask(__name__)
+app.app_ctx_globals_class = AppGlobals
 
 # Get DB_URI from environ variable (useful for production/testing) or,
 # if not set there, use development local db.
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
+# Comma-separated read replicas; GET requests read from them.
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri]
+app.config['REPLICA_STICKY_SECONDS'] = float(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+app.config['DB_POOL_PRE_PING'] = os.environ.get('DB_POOL_PRE_PING', '1') != '0'
+app.config['REPLICA_POOL_SIZE'] = int(os.environ.get('REPLICA_POOL_SIZE', 10))
+app.config['REPLICA_MAX_OVERFLOW'] = int(os.environ.get('REPLICA_MAX_OVERFLOW', 20))
+app.config['REPLICA_POOL_PRE_PING'] = os.environ.get('REPLICA_POOL_PRE_PING', '1') != '0'
+
+# Buffer like and follow toggles and write them in batches (writebehind.py).
+app.config['WRITE_BEHIND'] = os.environ.get('WRITE_BEHIND', '0') != '0'
+app.config['WRITE_BEHIND_MAX_PENDING'] = int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 1000))
+app.config['WRITE_BEHIND_MAX_DELAY'] = float(os.environ.get('WRITE_BEHIND_MAX_DELAY', 0.5))
+app.config['WRITE_BEHIND_DURABILITY'] = os.environ.get('WRITE_BEHIND_DURABILITY', 'memory')
+app.config['WRITE_BEHIND_JOURNAL'] = os.environ.get('WRITE_BEHIND_JOURNAL')
+
+# Background jobs (jobs.py): worker threads per web process, and whether
+# to run jobs as soon as they are queued instead (for tests).
+app.config['JOB_WORKER_THREADS'] = int(os.environ.get('JOB_WORKER_THREADS', 2))
+app.config['JOB_POLL_INTERVAL'] = float(os.environ.get('JOB_POLL_INTERVAL', 1))
+app.config['JOB_LOCK_TIMEOUT'] = int(os.environ.get('JOB_LOCK_TIMEOUT', 300))
+app.config['JOBS_EAGER'] = os.environ.get('JOBS_EAGER', '0') != '0'
+app.config['ACCOUNT_PURGE_BATCH_SIZE'] = int(os.environ.get('ACCOUNT_PURGE_BATCH_SIZE', 1000))
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['TIMELINE_SIZE'] = int(os.environ.get('TIMELINE_SIZE', 800))
+app.config['MESSAGES_PER_PAGE'] = int(os.environ.get('MESSAGES_PER_PAGE', 20))
+app.config['USERS_PER_PAGE'] = int(os.environ.get('USERS_PER_PAGE', 24))
+app.config['USER_SEARCH_MIN_LENGTH'] = int(os.environ.get('USER_SEARCH_MIN_LENGTH', 3))
+app.config['USER_SEARCH_MAX_RESULTS'] = int(os.environ.get('USER_SEARCH_MAX_RESULTS', 240))
+app.config['USER_SEARCH_CANDIDATES'] = int(os.environ.get('USER_SEARCH_CANDIDATES', 1000))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL', 30))
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 10000))
+app.config['STREAM_TEMPLATES'] = os.environ.get('STREAM_TEMPLATES', '1') != '0'
+app.config['STREAM_BATCH_SIZE'] = int(os.environ.get('STREAM_BATCH_SIZE', 100))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_WORKERS'] = int(os.environ.get('BCRYPT_WORKERS', os.cpu_count() or 1))
+app.config['BCRYPT_MAX_QUEUE'] = int(os.environ.get('BCRYPT_MAX_QUEUE', 4 * app.config['BCRYPT_WORKERS']))
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+app.cli.add_command(migrate.cli)
+app.cli.add_command(bulkload.seed_command)
+querybudget.init_app(app)
+identity.init_app(app)
+metrics.init_app(app)
+caching.init_app(app)
+fragments.init_app(app)
+writebehind.init_app(app)
+jobs.init_app(app)
+app.register_blueprint(api.blueprint)
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+def load_current_user():
+    """If we're logged in, return curr user (for `g.user`), else None.
+
+    Served from the identity cache when possible.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        return identity.user_cache.load(session[CURR_USER_KEY])
 
     else:
-        g.user = None
+        return None
 
 
 def do_login(user):
@@ -84,6 +180,10 @@ def signup():
             flash("Username or email already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except PasswordPoolFull:
+            flash("We're very busy right now, please try again.", 'danger')
+            return render_template('users/signup.html', form=form), 503
+
         do_login(user)
 
         return redirect("/")
@@ -99,10 +199,16 @@ def login():
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except PasswordPoolFull:
+            flash("We're very busy right now, please try again.", 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
+            # saves the password hash if authenticate upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -124,43 +230,106 @@ def logout():
 ##############################################################################
 # General user routes:
 
+
+def _active_user_or_404(user_id):
+    """The user with `user_id`; 404 if there is none or it was deleted."""
+
+    user = User.query.get_or_404(user_id)
+    if user.deleted_at is not None:
+        abort(404)
+    return user
+
+
+def _prime_following():
+    """`RowStream` prime: look up which users on a batch `g.user` follows."""
+
+    if not g.user:
+        return None
+
+    return lambda users: g.user.following_ids_among(user.id for user in users)
+
+
+def _prime_likes(user_id, likes):
+    """`RowStream` prime: add the batch's messages `user_id` liked to `likes`."""
+
+    return lambda messages: likes.update(
+        liked_ids(user_id, [msg.id for msg in messages]))
+
+
+def _message_cursor(msg):
+    return pagination.encode_cursor(msg.timestamp, msg.id)
+
 @app.route('/users')
+@query_budget(6)
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and an
+    'after' cursor (the last username, or user id when listing everyone)
+    from the previous page.
     """
 
-    search = request.args.get('q')
+    q = request.args.get('q')
+    after = request.args.get('after')
 
-    if not search:
-        users = User.query.all()
+    if q:
+        query = search.users_query(q, after)
+        if query is None:
+            return render_template('users/index.html', users=[], q=q,
+                                   min_length=search.user_search_min_length())
+        cursor = attrgetter('username')
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-    return render_template('users/index.html', users=users)
+        query = User.query.filter(User.deleted_at.is_(None))
+        if after:
+            if not after.isdigit():
+                abort(400)
+            query = query.filter(User.id > int(after))
+        query = query.order_by(User.id)
+        cursor = attrgetter('id')
+
+    users = streaming.RowStream(query, limit=search.users_per_page(),
+                                prime=_prime_following(), cursor=cursor)
+
+    return streaming.render('users/index.html', users=users, q=q)
 
 
 @app.route('/users/<int:user_id>')
+@query_budget(8)
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
 
-    user = User.query.get_or_404(user_id)
+    Messages are paginated newest first; pass the `before` cursor from the
+    previous page to load older ones.
+    """
+
+    user = _active_user_or_404(user_id)
+
+    conditional = caching.ConditionalPage(
+        'users_show', user.id, user.updated_at,
+        g.user and g.user.id, g.user and g.user.updated_at,
+        g.user and write_buffer.version(g.user.id),
+        last_modified=(max(user.updated_at, g.user.updated_at) if g.user
+                       else user.updated_at))
+    if conditional.fresh():
+        return conditional.not_modified()
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
+    likes_msg_ids = set()
+    messages = streaming.RowStream(
+        pagination.keyset(Message.query.filter(Message.user_id == user_id),
+                          Message.timestamp, Message.id,
+                          before=pagination.cursor_arg()),
+        limit=pagination.per_page(),
+        prime=g.user and _prime_likes(g.user.id, likes_msg_ids),
+        cursor=_message_cursor)
 
-    likes_msg_ids = [like.message_id for like in Likes.query.filter(
-        Likes.message_id.in_(msg.id for msg in messages), Likes.user_id == g.user.id).all()]
-    return render_template('users/show.html', user=user, messages=messages, likes=likes_msg_ids)
+    return conditional.apply(streaming.render(
+        'users/show.html', user=user, messages=messages, likes=likes_msg_ids))
 
 
 @app.route('/users/<int:user_id>/following')
+@query_budget(8)
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -168,11 +337,20 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = _active_user_or_404(user_id)
+    following = streaming.RowStream(
+        User.query
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == user_id,
+                User.deleted_at.is_(None))
+        .order_by(User.id),
+        prime=_prime_following())
+    return streaming.render('users/following.html', user=user,
+                            following=following)
 
 
 @app.route('/users/<int:user_id>/followers')
+@query_budget(8)
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -180,8 +358,16 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = _active_user_or_404(user_id)
+    followers = streaming.RowStream(
+        User.query
+        .join(Follows, Follows.user_following_id == User.id)
+        .filter(Follows.user_being_followed_id == user_id,
+                User.deleted_at.is_(None))
+        .order_by(User.id),
+        prime=_prime_following())
+    return streaming.render('users/followers.html', user=user,
+                            followers=followers)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -192,9 +378,10 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = _active_user_or_404(follow_id)
+    follows.follow(g.user, followed_user)
     db.session.commit()
+    identity.user_cache.invalidate(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -208,8 +395,9 @@ def stop_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    follows.unfollow(g.user, followed_user)
     db.session.commit()
+    identity.user_cache.invalidate(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -225,8 +413,13 @@ def profile():
     form = UserEditForm(obj=g.user)
 
     if form.validate_on_submit():
-        user = User.authenticate(g.user.username,
-                                 form.password.data)
+        try:
+            user = User.authenticate(g.user.username,
+                                     form.password.data)
+        except PasswordPoolFull:
+            flash("We're very busy right now, please try again.", 'danger')
+            return render_template('/users/edit.html', form=form), 503
+
         if user:
 
             try:
@@ -235,7 +428,10 @@ def profile():
                 g.user.image_url = form.image_url.data or User.image_url.default.arg
                 g.user.header_image_url = form.header_image_url.data
                 g.user.bio = form.bio.data
+                timeline.author_changed(g.user.id)
                 db.session.commit()
+                identity.user_cache.invalidate(g.user.id)
+                fragments.card_cache.invalidate_author(g.user.id)
                 return redirect(f'users/{g.user.id}')
 
             except IntegrityError:
@@ -260,8 +456,11 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id = g.user.id
+    accounts.delete_user(user_id)
     db.session.commit()
+    identity.user_cache.invalidate(user_id)
+    fragments.card_cache.invalidate_author(user_id)
 
     return redirect("/signup")
 
@@ -285,14 +484,64 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        counters.message_posted(g.user.id)
+        timeline.post(msg)
         db.session.commit()
+        identity.user_cache.invalidate(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+@query_budget(8)
+def messages_search():
+    """Full-text search over messages.
+
+    Takes 'q' (required), optional 'author' (username), 'since' and 'until'
+    (YYYY-MM-DD, inclusive) filters, and a 'before' cursor for older hits.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    q = request.args.get('q', '').strip()
+    author = request.args.get('author')
+    if not q:
+        return render_template('messages/search.html', messages=[], likes=[],
+                               next_cursor=None)
+
+    try:
+        since, until = [datetime.strptime(request.args[arg], '%Y-%m-%d')
+                        if request.args.get(arg) else None
+                        for arg in ('since', 'until')]
+        cursor = request.args.get('before')
+        before = search.decode_rank_cursor(cursor) if cursor else None
+    except ValueError:
+        abort(400)
+
+    if until is not None:
+        until += timedelta(days=1)
+
+    author_id = None
+    if author:
+        author_id = User.query.filter_by(username=author, deleted_at=None).first_or_404().id
+
+    page = search.search_messages(
+        search.MessageQuery(q, author_id, since, until), before=before)
+    messages = page.items
+
+    likes_msg_ids = liked_ids(g.user.id, [msg.id for msg in messages])
+
+    return render_template('messages/search.html', messages=messages, likes=likes_msg_ids,
+                           next_cursor=page.next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@query_budget(6)
 def messages_show(message_id):
     """Show a message."""
 
@@ -300,16 +549,19 @@ def messages_show(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = Message.with_author().filter(Message.id == message_id).first_or_404()
 
-    likes = Likes.query.filter(Likes.message_id == message_id)
-    likes_user_id = [like.user_id for like in likes]
-    if g.user.id in likes_user_id:
-        is_liked = True
-    else:
-        is_liked = False
+    conditional = caching.ConditionalPage(
+        'messages_show', msg.id, msg.user.updated_at,
+        g.user.id, g.user.updated_at, write_buffer.version(g.user.id),
+        last_modified=max(msg.timestamp, msg.user.updated_at, g.user.updated_at))
+    if conditional.fresh():
+        return conditional.not_modified()
 
-    return render_template('messages/show.html', message=msg, liked=is_liked)
+    is_liked = message_id in liked_ids(g.user.id, [message_id])
+
+    return conditional.apply(
+        render_template('messages/show.html', message=msg, liked=is_liked))
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -325,8 +577,13 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    counters.message_deleted(msg)
+    Likes.query.filter(Likes.message_id == msg.id).delete(
+        synchronize_session=False)
     db.session.delete(msg)
     db.session.commit()
+    identity.user_cache.invalidate(g.user.id)
+    fragments.card_cache.invalidate_message(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -335,23 +592,40 @@ def messages_destroy(message_id):
 # Likes Routes
 
 @app.route('/users/<int:user_id>/likes')
+@query_budget(8)
 def likes_show(user_id):
-    """Show all of a user's liked messages."""
+    """Show a user's liked messages, newest like first.
+
+    Pass the `before` cursor (a like id) from the previous page to load
+    older likes.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
+    user = _active_user_or_404(user_id)
+    per_page = pagination.per_page()
+
+    likes = Likes.query.filter(Likes.user_id == user_id)
+    before = request.args.get('before', type=int)
+    if before is not None:
+        likes = likes.filter(Likes.id < before)
+    likes = likes.order_by(Likes.id.desc()).limit(per_page + 1).all()
 
-    msgs_ids = [like.message_id for like in Likes.query.filter(
-        Likes.user_id == user_id)]
-    messages = [Message.query.get_or_404(id) for id in msgs_ids]
+    next_cursor = likes[per_page - 1].id if len(likes) > per_page else None
+    likes = likes[:per_page]
 
-    likes_msg_ids = [like.message_id for like in Likes.query.filter(
-        Likes.message_id.in_(msgs_ids), Likes.user_id == g.user.id).all()]
+    msgs_ids = [like.message_id for like in likes]
+    messages = loader.message_loader().load_many(msgs_ids)
+
+    if user_id == g.user.id:
+        likes_msg_ids = write_buffer.overlay(LIKE, user_id, msgs_ids, set(msgs_ids))
+    else:
+        likes_msg_ids = liked_ids(g.user.id, msgs_ids)
 
-    return render_template('users/likes.html', messages=messages, likes=likes_msg_ids, user=user)
+    return render_template('users/likes.html', messages=messages, likes=likes_msg_ids, user=user,
+                           next_cursor=next_cursor)
 
 
 @app.route('/messages/<int:message_id>/like', methods=['POST'])
@@ -362,18 +636,14 @@ def add_like(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    like = Likes.query.filter(
-        Likes.message_id == message_id, Likes.user_id == g.user.id).first()
+    user_id = g.user.id
+    if toggle_like(user_id, message_id) is None:
+        db.session.rollback()
+        abort(404)
 
-    if like != None:
-        db.session.delete(like)
-        db.session.commit()
-
-    else:
-        like = Likes(user_id=g.user.id, message_id=message_id)
+    db.session.commit()
 
-        db.session.add(like)
-        db.session.commit()
+    identity.user_cache.invalidate(user_id)
 
     return redirect(f'/messages/{message_id}')
 
@@ -383,44 +653,61 @@ def add_like(message_id):
 
 
 @app.route('/')
+@query_budget(10)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, one page at a
+      time (pass the `before` cursor to load older ones)
+
+    Messages come from the user's precomputed timeline; if it is cold we
+    build the page from the follow graph and warm the timeline for next time.
     """
 
     if g.user:
-        following = [user.id for user in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        before = pagination.cursor_arg()
+
+        version = timeline.version(g.user.id)
+        if version:
+            conditional = caching.ConditionalPage(
+                'homepage', g.user.id, g.user.updated_at, version,
+                write_buffer.version(g.user.id))
+            if conditional.fresh():
+                return conditional.not_modified()
+        else:
+            conditional = None
 
-        likes_msg_ids = [like.message_id for like in Likes.query.filter(
-            Likes.message_id.in_(msg.id for msg in messages), Likes.user_id == g.user.id).all()]
+        user_id = g.user.id
+        likes_msg_ids = set()
+        messages = streaming.PageStream(
+            lambda: timeline.page(user_id, before=before),
+            prime=_prime_likes(user_id, likes_msg_ids))
 
-        return render_template('home.html', messages=messages, likes=likes_msg_ids)
+        response = streaming.render('home.html', messages=messages,
+                                    likes=likes_msg_ids)
+        return conditional.apply(response) if conditional else response
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@ app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Maintenance commands
+
+@app.cli.command('trim-timelines')
+def trim_timelines():
+    """Cap every precomputed home timeline at TIMELINE_SIZE entries."""
+
+    timeline.trim()
+    db.session.commit()
+
+
+@app.cli.command('repair-counters')
+@click.option('--batch-size', default=10000,
+              help='Rows to recompute per transaction.')
+def repair_counters(batch_size):
+    """Recompute the denormalized message/follow/like counters."""
+
+    users, messages = counters.repair(batch_size)
+    click.echo(f"Recomputed counters for {users} users, {messages} messages.")
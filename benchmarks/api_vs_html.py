@@ -0,0 +1,132 @@
+"""Compare the JSON API's read endpoints with the HTML pages they mirror.
+
+For each pair (home timeline, a user's messages, following, followers,
+likes and a single message) the same randomly chosen viewers and targets
+are requested from both the HTML route and its /api/v1 counterpart, one
+after the other, through the app's full WSGI stack. The table shows
+p50/p95 latency, response size and SQL statements per request for each
+side. The HTML following and followers pages list everyone on one page,
+while the API returns a page of `--limit` users.
+
+Run it from the project root like:
+
+    python -m benchmarks.api_vs_html --users 2000 --messages 50000
+    python -m benchmarks.api_vs_html --no-seed --requests 500
+
+It uses the same database and seeding options as benchmarks.routes.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+from collections import defaultdict
+from time import perf_counter
+
+from benchmarks.routes import load_app, percentile, seed
+
+PAIRS = [
+    ('home', '/', '/api/v1/timeline'),
+    ('user messages', '/users/{user}', '/api/v1/users/{user}/messages'),
+    ('following', '/users/{user}/following', '/api/v1/users/{user}/following'),
+    ('followers', '/users/{user}/followers', '/api/v1/users/{user}/followers'),
+    ('likes', '/users/{user}/likes', '/api/v1/users/{user}/likes'),
+    ('message', '/messages/{message}', '/api/v1/messages/{message}'),
+]
+
+
+def measure(app, args):
+    """Request every pair `args.requests` times.
+
+    Returns {(pair, 'html' or 'api'): [(seconds, bytes, queries)]}.
+    """
+
+    from flask import request_tearing_down
+    from app import CURR_USER_KEY
+    from models import db, Message, User
+    import querybudget
+
+    counted = {}
+
+    # Sent once a streamed page's body has been drained (see benchmarks.routes).
+    def record_queries(sender, **extra):
+        counted['queries'] = querybudget.query_count()
+
+    request_tearing_down.connect(record_queries, app)
+
+    with app.app_context():
+        max_user_id = db.session.query(db.func.max(User.id)).scalar()
+        max_message_id = db.session.query(db.func.max(Message.id)).scalar()
+
+    rng = random.Random(args.seed)
+    client = app.test_client()
+    samples = defaultdict(list)
+
+    for i in range(args.warmup + args.requests):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = rng.randint(1, max_user_id)
+        targets = {'user': rng.randint(1, max_user_id),
+                   'message': rng.randint(1, max_message_id)}
+
+        for name, html, api in PAIRS:
+            for side, url in [('html', html), ('api', api)]:
+                start = perf_counter()
+                response = client.get(url.format(**targets),
+                                      query_string={'limit': args.limit}
+                                      if side == 'api' else None)
+                size = len(response.get_data())
+                response.close()
+                seconds = perf_counter() - start
+                if i >= args.warmup and response.status_code == 200:
+                    samples[name, side].append(
+                        (seconds, size, counted['queries']))
+
+    request_tearing_down.disconnect(record_queries, app)
+    return samples
+
+
+def print_table(samples):
+    print(f"{'endpoint':<14} {'side':<5} {'count':>6} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'bytes':>8} {'queries':>8}")
+
+    for name, _, _ in PAIRS:
+        for side in ['html', 'api']:
+            rows = samples.get((name, side))
+            if not rows:
+                continue
+            latencies = sorted(seconds * 1000 for seconds, _, _ in rows)
+            size = sum(length for _, length, _ in rows) / len(rows)
+            queries = sum(count for _, _, count in rows) / len(rows)
+            print(f"{name:<14} {side:<5} {len(rows):>6} "
+                  f"{percentile(latencies, 0.50):>8.1f} "
+                  f"{percentile(latencies, 0.95):>8.1f} "
+                  f"{size:>8.0f} {queries:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'warbler-bench.db'))
+    parser.add_argument('--no-seed', dest='seed_db', action='store_false',
+                        help='reuse the data already in --database')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=30000)
+    parser.add_argument('--likes', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per endpoint and side')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--limit', type=int, default=20,
+                        help='API page size')
+    args = parser.parse_args()
+
+    app = load_app(args.database)
+    if args.seed_db:
+        seed(app, args)
+
+    print_table(measure(app, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark login throughput against the bcrypt pool's worker count.
+
+Simulates `--clients` request threads all logging in at once, each waiting
+on a password check run by a `PasswordPool` with 1, 2, 4, ... workers, and
+reports logins/sec and per-login latency for each pool size.
+
+Run it from the project root like:
+
+    python -m benchmarks.bcrypt_logins --rounds 12 --workers 1,2,4,8
+"""
+
+import argparse
+import os
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from flask import Flask
+from flask_bcrypt import Bcrypt
+
+from passwords import PasswordPool
+
+
+def run(pool, pw_hash, clients, logins):
+    """Do `logins` checks from `clients` threads; return (elapsed, latencies)."""
+
+    def login(_):
+        start = perf_counter()
+        assert pool.check(pw_hash, 'hunter22')
+        return perf_counter() - start
+
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as requests:
+        latencies = list(requests.map(login, range(logins)))
+
+    return perf_counter() - start, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12,
+                        help='bcrypt work factor (BCRYPT_LOG_ROUNDS)')
+    parser.add_argument('--workers', default=f'1,2,4,{os.cpu_count() or 1}',
+                        help='comma-separated pool sizes to try')
+    parser.add_argument('--clients', type=int, default=32,
+                        help='concurrent logins in flight')
+    parser.add_argument('--logins', type=int, default=64,
+                        help='logins per pool size')
+    args = parser.parse_args()
+
+    app = Flask(__name__)
+    app.config['BCRYPT_LOG_ROUNDS'] = args.rounds
+    bcrypt = Bcrypt(app)
+    pw_hash = bcrypt.generate_password_hash('hunter22').decode('UTF-8')
+
+    print(f"bcrypt cost {args.rounds}, {args.clients} concurrent clients, "
+          f"{args.logins} logins per run")
+    print(f"{'workers':>7} {'logins/s':>9} {'p50 ms':>8} {'p95 ms':>8}")
+
+    for workers in sorted({int(w) for w in args.workers.split(',')}):
+        pool = PasswordPool(bcrypt, workers=workers, max_queue=args.clients)
+        elapsed, latencies = run(pool, pw_hash, args.clients, args.logins)
+
+        latencies.sort()
+        p50 = statistics.median(latencies) * 1000
+        p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+        print(f"{workers:>7} {args.logins / elapsed:>9.1f} "
+              f"{p50:>8.0f} {p95:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
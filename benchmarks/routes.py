@@ -0,0 +1,351 @@
+"""Load-test Warbler's routes and report latency per route.
+
+Seeds a database at the requested scale (generator/create_csvs.py, then
+`bulkload.seed`), then has `--clients` threads, each logged in as a few
+users of its own, send a mix of home, profile, follow, like, post and
+search requests through the app's full WSGI stack with Flask's test
+client. For every route it reports p50/p95/p99 latency, requests/sec and
+SQL statements per request (as counted by querybudget).
+
+Run it from the project root like:
+
+    python -m benchmarks.routes --users 2000 --messages 50000 --save before.json
+    python -m benchmarks.routes --no-seed --save after.json
+    python -m benchmarks.routes --compare before.json after.json
+
+The database defaults to a SQLite file in the temp directory; pass
+`--database postgresql:///warbler-bench` to use a local Postgres. Seeding
+drops everything in it.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from time import perf_counter
+
+DEFAULT_MIX = 'home=35,profile=20,follow=10,like=15,post=5,search=15'
+
+SEARCH_WORDS = ['time', 'people', 'water', 'system', 'night', 'music',
+                'power', 'party', 'story', 'future', 'car', 'home']
+
+
+def load_app(database):
+    """Import the app pointed at `database`, set up for benchmarking."""
+
+    os.environ['DATABASE_URL'] = database
+    from app import app
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    app.config['QUERY_BUDGETS_ENFORCED'] = False
+    return app
+
+
+def seed(app, args):
+    """Generate CSVs at the requested scale and bulk-load them."""
+
+    import bulkload
+
+    with tempfile.TemporaryDirectory() as out:
+        subprocess.run(
+            [sys.executable, os.path.join('generator', 'create_csvs.py'),
+             '--out', out, '--seed', str(args.seed),
+             '--users', str(args.users), '--messages', str(args.messages),
+             '--follows', str(args.follows), '--likes', str(args.likes)],
+            check=True)
+
+        with app.app_context():
+            bulkload.report(*_timed(bulkload.seed, out))
+
+
+def _timed(fn, *args):
+    start = perf_counter()
+    result = fn(*args)
+    return result, perf_counter() - start
+
+
+##############################################################################
+# Traffic
+
+
+class Client:
+    """One benchmark thread: a test client logged in as a few users."""
+
+    def __init__(self, app, user_ids, following, max_user_id, max_message_id,
+                 rng):
+        self.client = app.test_client()
+        self.user_ids = user_ids
+        self.following = following
+        self.max_user_id = max_user_id
+        self.max_message_id = max_message_id
+        self.rng = rng
+        self.user_id = None
+
+    def login(self):
+        from app import CURR_USER_KEY
+
+        self.user_id = self.rng.choice(self.user_ids)
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def home(self):
+        return 'home', self.client.get('/')
+
+    def profile(self):
+        return 'profile', self.client.get(
+            f'/users/{self.rng.randint(1, self.max_user_id)}')
+
+    def follow(self):
+        following = self.following[self.user_id]
+        other = self.rng.randint(1, self.max_user_id)
+        if other == self.user_id:
+            return self.home()
+
+        if other in following:
+            following.discard(other)
+            return 'unfollow', self.client.post(
+                f'/users/stop-following/{other}')
+
+        following.add(other)
+        return 'follow', self.client.post(f'/users/follow/{other}')
+
+    def like(self):
+        return 'like', self.client.post(
+            f'/api/v1/messages/{self.rng.randint(1, self.max_message_id)}/like')
+
+    def post(self):
+        text = ' '.join(self.rng.sample(SEARCH_WORDS, 5))
+        return 'post', self.client.post('/messages/new', data={'text': text})
+
+    def search(self):
+        if self.rng.random() < 0.5:
+            return 'search messages', self.client.get(
+                '/messages/search', query_string={'q': self.rng.choice(SEARCH_WORDS)})
+        return 'search users', self.client.get(
+            '/users', query_string={'q': self.rng.choice(SEARCH_WORDS)[:3]})
+
+
+def parse_mix(mix):
+    """'home=35,like=15' -> ([action names], [weights])."""
+
+    pairs = [part.split('=') for part in mix.split(',') if part]
+    return [name for name, weight in pairs], [float(weight) for name, weight in pairs]
+
+
+def drive(app, args):
+    """Send the traffic mix; returns (samples, elapsed seconds).
+
+    Each sample is (route, seconds, status, queries).
+    """
+
+    from flask import request_tearing_down
+    from models import db, Follows, Message, User
+    import querybudget
+
+    names, weights = parse_mix(args.mix)
+    local = threading.local()
+
+    # Sent when the request context is popped, which for a streamed page
+    # is once its body has been drained, so the count covers every query.
+    def record_queries(sender, **extra):
+        local.queries = querybudget.query_count()
+
+    request_tearing_down.connect(record_queries, app)
+
+    rng = random.Random(args.seed)
+    with app.app_context():
+        max_user_id = db.session.query(db.func.max(User.id)).scalar()
+        max_message_id = db.session.query(db.func.max(Message.id)).scalar()
+        user_ids = rng.sample(range(1, max_user_id + 1),
+                              min(max_user_id, args.clients * args.users_per_client))
+        following = defaultdict(set)
+        for follower, followed in (db.session
+                                   .query(Follows.user_following_id,
+                                          Follows.user_being_followed_id)
+                                   .filter(Follows.user_following_id.in_(user_ids))):
+            following[follower].add(followed)
+
+    clients = [Client(app, user_ids[i::args.clients], following,
+                      max_user_id, max_message_id, random.Random(args.seed + i))
+               for i in range(args.clients)]
+    samples = []
+    lock = threading.Lock()
+
+    def run(client, count, keep):
+        mine = []
+        for _ in range(count):
+            if client.rng.random() < 0.05 or client.user_id is None:
+                client.login()
+            action = client.rng.choices(names, weights)[0]
+            local.queries = None
+            start = perf_counter()
+            route, response = getattr(client, action)()
+            # Drain the (possibly streamed) body here, on this thread, so it
+            # is timed and its request context is popped where it was pushed.
+            response.get_data()
+            response.close()
+            mine.append((route, perf_counter() - start,
+                         response.status_code, local.queries))
+        if keep:
+            with lock:
+                samples.extend(mine)
+
+    def run_all(per_client, keep):
+        threads = [threading.Thread(target=run, args=(client, per_client, keep))
+                   for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    run_all(args.warmup, keep=False)
+    _, elapsed = _timed(run_all, args.requests // args.clients, True)
+    request_tearing_down.disconnect(record_queries, app)
+
+    return samples, elapsed
+
+
+##############################################################################
+# Reporting
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already-sorted list."""
+
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples, elapsed):
+    """Per-route stats: count, errors, p50/p95/p99 ms, rps, queries."""
+
+    by_route = defaultdict(list)
+    for sample in samples:
+        by_route[sample[0]].append(sample)
+    by_route['ALL'] = samples
+
+    routes = {}
+    for route, rows in sorted(by_route.items()):
+        latencies = sorted(seconds * 1000 for _, seconds, _, _ in rows)
+        queries = [count for _, _, _, count in rows if count is not None]
+        routes[route] = {
+            'count': len(rows),
+            'errors': sum(1 for _, _, status, _ in rows if status >= 500),
+            'p50': percentile(latencies, 0.50),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99),
+            'rps': len(rows) / elapsed,
+            'queries': sum(queries) / len(queries) if queries else None,
+        }
+
+    return routes
+
+
+def print_table(routes):
+    print(f"{'route':<16} {'count':>6} {'errors':>6} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'queries':>8}")
+    for route, stats in routes.items():
+        queries = (f"{stats['queries']:>8.1f}" if stats['queries'] is not None
+                   else f"{'-':>8}")
+        print(f"{route:<16} {stats['count']:>6} {stats['errors']:>6} "
+              f"{stats['p50']:>8.1f} {stats['p95']:>8.1f} {stats['p99']:>8.1f} "
+              f"{stats['rps']:>8.1f} {queries}")
+
+
+def compare(before_path, after_path, threshold):
+    """Print per-route changes between two saved runs.
+
+    Returns the routes that regressed: p95 or p99 up by more than
+    `threshold` percent, or more queries per request. Overall throughput
+    down by more than `threshold` percent counts against ALL; per-route
+    rates follow the traffic mix, so they are shown but not judged.
+    """
+
+    with open(before_path) as f:
+        before = json.load(f)['routes']
+    with open(after_path) as f:
+        after = json.load(f)['routes']
+
+    def change(old, new):
+        return (new - old) / old * 100 if old else 0.0
+
+    regressions = []
+    print(f"{'route':<16} {'p50 ms':>16} {'p95 ms':>16} {'p99 ms':>16} "
+          f"{'req/s':>14} {'queries':>12}")
+
+    for route in sorted(before.keys() & after.keys()):
+        old, new = before[route], after[route]
+        cells = []
+        for key in ['p50', 'p95', 'p99', 'rps']:
+            cells.append(f"{new[key]:>7.1f} {change(old[key], new[key]):>+6.0f}%")
+        queries = (f"{old['queries'] or 0:>5.1f} > {new['queries'] or 0:<5.1f}")
+
+        regressed = (change(old['p95'], new['p95']) > threshold
+                     or change(old['p99'], new['p99']) > threshold
+                     or (route == 'ALL'
+                         and change(old['rps'], new['rps']) < -threshold)
+                     or (new['queries'] or 0) > (old['queries'] or 0) + 0.05)
+        if regressed:
+            regressions.append(route)
+
+        print(f"{route:<16} {cells[0]:>16} {cells[1]:>16} {cells[2]:>16} "
+              f"{cells[3]:>14} {queries:>12}{'  REGRESSED' if regressed else ''}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'warbler-bench.db'))
+    parser.add_argument('--no-seed', dest='seed_db', action='store_false',
+                        help='reuse the data already in --database')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=30000)
+    parser.add_argument('--likes', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'action weights (default {DEFAULT_MIX})')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='concurrent client threads')
+    parser.add_argument('--users-per-client', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='unrecorded requests per client first')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two saved runs instead of running')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='percent change counted as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        regressions = compare(*args.compare, args.threshold)
+        if regressions:
+            print(f"Regressed: {', '.join(sorted(regressions))}")
+        sys.exit(1 if regressions else 0)
+
+    app = load_app(args.database)
+    if args.seed_db:
+        seed(app, args)
+
+    samples, elapsed = drive(app, args)
+    routes = summarize(samples, elapsed)
+
+    print(f"{len(samples)} requests from {args.clients} clients in "
+          f"{elapsed:.1f}s against {args.database}")
+    print_table(routes)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'config': vars(args), 'elapsed': elapsed,
+                       'routes': routes}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""Measure like/follow throughput with and without the write-behind buffer.
+
+`--clients` threads, each logged in as users of its own, toggle likes on a
+set of `--hot` popular messages and follow or unfollow random users
+through the app's full WSGI stack (tracking whom each user follows, so
+every follow and unfollow is valid). The same traffic is sent with
+writes going straight to the database, then through the write-behind
+buffer at each durability level. The table shows toggles per second,
+p50/p95 latency per toggle, and how long the final flush of whatever was
+still buffered took.
+
+Run it from the project root like:
+
+    python -m benchmarks.write_behind --users 2000 --messages 50000
+    python -m benchmarks.write_behind --no-seed --clients 16 --toggles 500
+
+It uses the same database and seeding options as benchmarks.routes.
+"""
+
+import argparse
+import glob
+import os
+import random
+import tempfile
+import threading
+from collections import defaultdict
+from time import perf_counter
+
+from benchmarks.routes import load_app, percentile, seed
+
+MODES = ['direct', 'memory', 'journal', 'fsync']
+
+
+def run_mode(app, args, mode):
+    """Send the toggles in `mode`; returns (latencies, elapsed, flush seconds)."""
+
+    from app import CURR_USER_KEY
+    from models import db, Follows, Message, User
+    from writebehind import write_buffer
+
+    journal = os.path.join(tempfile.gettempdir(), 'warbler-bench-writes')
+    if mode == 'direct':
+        write_buffer.configure(False)
+    else:
+        write_buffer.configure(True, max_pending=args.max_pending,
+                               max_delay=args.max_delay, durability=mode,
+                               journal_path=journal)
+
+    with app.app_context():
+        max_user_id = db.session.query(db.func.max(User.id)).scalar()
+        hot = [message_id for (message_id,) in db.session
+               .query(Message.id)
+               .order_by(Message.likes_count.desc())
+               .limit(args.hot)]
+        user_ids = random.Random(args.seed).sample(
+            range(1, max_user_id + 1), min(max_user_id, args.clients * 10))
+        following = defaultdict(set)
+        for follower, followed in (db.session
+                                   .query(Follows.user_following_id,
+                                          Follows.user_being_followed_id)
+                                   .filter(Follows.user_following_id.in_(user_ids))):
+            following[follower].add(followed)
+
+    latencies = []
+    lock = threading.Lock()
+
+    def run(i):
+        rng = random.Random(args.seed + i)
+        client = app.test_client()
+        mine = []
+        for n in range(args.toggles):
+            if n % 50 == 0:
+                user_id = rng.choice(user_ids[i::args.clients])
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+            other = rng.randint(1, max_user_id)
+            if rng.random() < args.follow_share and other != user_id:
+                if other in following[user_id]:
+                    following[user_id].discard(other)
+                    url = f'/users/stop-following/{other}'
+                else:
+                    following[user_id].add(other)
+                    url = f'/users/follow/{other}'
+            else:
+                url = f'/api/v1/messages/{rng.choice(hot)}/like'
+            start = perf_counter()
+            client.post(url)
+            mine.append(perf_counter() - start)
+        with lock:
+            latencies.extend(mine)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(args.clients)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    start = perf_counter()
+    with app.app_context():
+        write_buffer.flush()
+    flushed = perf_counter() - start
+
+    write_buffer.configure(False)
+    for path in glob.glob(glob.escape(journal) + '.*'):
+        os.remove(path)
+
+    return sorted(latencies), elapsed, flushed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', default='sqlite:///' + os.path.join(
+        tempfile.gettempdir(), 'warbler-bench.db'))
+    parser.add_argument('--no-seed', dest='seed_db', action='store_false',
+                        help='reuse the data already in --database')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=30000)
+    parser.add_argument('--likes', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--toggles', type=int, default=300,
+                        help='toggles per client and mode')
+    parser.add_argument('--hot', type=int, default=50,
+                        help='number of popular messages being liked')
+    parser.add_argument('--follow-share', type=float, default=0.3,
+                        help='fraction of toggles that are follows')
+    parser.add_argument('--max-pending', type=int, default=1000)
+    parser.add_argument('--max-delay', type=float, default=0.5)
+    parser.add_argument('--modes', default=','.join(MODES))
+    args = parser.parse_args()
+
+    app = load_app(args.database)
+    if args.seed_db:
+        seed(app, args)
+
+    print(f"{'mode':<8} {'toggles':>8} {'per sec':>9} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'flush ms':>9}")
+    for mode in args.modes.split(','):
+        latencies, elapsed, flushed = run_mode(app, args, mode)
+        print(f"{mode:<8} {len(latencies):>8} {len(latencies) / elapsed:>9.0f} "
+              f"{percentile([s * 1000 for s in latencies], 0.50):>8.1f} "
+              f"{percentile([s * 1000 for s in latencies], 0.95):>8.1f} "
+              f"{flushed * 1000:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
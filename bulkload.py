@@ -0,0 +1,320 @@
+"""Bulk loading of the generator's CSV files.
+
+`seed` rebuilds the schema and streams `users.csv`, `messages.csv`,
+`follows.csv` and `likes.csv` (whichever exist) into their tables. On
+PostgreSQL each file goes through COPY in chunks of `chunk_rows` rows, up
+to `jobs` files at once, with the non-unique secondary indexes and the
+foreign keys dropped for the load and rebuilt afterwards (which also
+validates every foreign key). Unique indexes stay in place, so a row
+that duplicates another fails its file's load. Sequences are then moved
+past the loaded ids and the denormalized counters recomputed. Other
+databases get chunked multi-row INSERTs instead. A load that fails leaves
+the database empty, with its full schema.
+
+Run from the command line:
+
+    flask seed                               # the files in generator/
+    flask seed data/ --jobs 4 --chunk-rows 200000
+"""
+
+import csv
+import io
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+from time import perf_counter
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+
+import counters
+import migrate
+from models import db
+
+# Loaded into the table of the same name; the CSV header names the columns.
+TABLES = ['users', 'messages', 'follows', 'likes']
+
+DEFAULT_DIRECTORY = 'generator'
+DEFAULT_CHUNK_ROWS = 100000
+
+Step = namedtuple('Step', ['name', 'rows', 'seconds'])
+
+
+def csv_files(directory):
+    """(table, path) for each of TABLES that has a CSV in `directory`."""
+
+    paths = [(table, os.path.join(directory, f"{table}.csv"))
+             for table in TABLES]
+    return [(table, path) for table, path in paths if os.path.exists(path)]
+
+
+def read_chunks(path, chunk_rows):
+    """Yield (columns, rows) for `path`, `chunk_rows` parsed rows at a time."""
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows:
+                return
+            yield columns, rows
+
+
+def _check_columns(table, columns):
+    unknown = set(columns) - set(db.metadata.tables[table].c.keys())
+    if unknown:
+        raise click.ClickException(
+            f"{table}.csv has unknown columns: {', '.join(sorted(unknown))}")
+
+
+def pool_map(fn, args, jobs):
+    """`fn(*a)` for each `a` in `args` on `jobs` threads, in this app's context."""
+
+    app = current_app._get_current_object()
+
+    def run(a):
+        with app.app_context():
+            return fn(*a)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(run, args))
+
+
+def reset_schema():
+    """Drop everything and recreate the schema at the latest migration."""
+
+    db.drop_all()
+    migrate.schema_migrations.drop(db.engine, checkfirst=True)
+    migrate.upgrade()
+
+
+##############################################################################
+# PostgreSQL: COPY with deferred indexes and foreign keys
+
+
+def copy_csv(table, path, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """COPY `path` into `table` on its own connection; returns a Step."""
+
+    start = perf_counter()
+    loaded = 0
+
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for columns, rows in read_chunks(path, chunk_rows):
+            _check_columns(table, columns)
+            buf = io.StringIO()
+            csv.writer(buf).writerows(rows)
+            buf.seek(0)
+            try:
+                cursor.copy_expert(
+                    f"COPY {table} ({', '.join(columns)}) "
+                    f"FROM STDIN WITH (FORMAT csv)", buf)
+            except db.engine.dialect.dbapi.IntegrityError as exc:
+                raise _duplicate_rows(table, exc)
+            loaded += len(rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+    return Step(table, loaded, perf_counter() - start)
+
+
+def _duplicate_rows(table, exc):
+    return click.ClickException(f"{table}.csv has duplicate rows: {exc}")
+
+
+def drop_deferred(tables):
+    """Drop `tables`' non-unique secondary indexes and foreign keys.
+
+    Returns the statements that recreate them, indexes first. Unique
+    indexes are kept so the load itself rejects duplicates.
+    """
+
+    with db.engine.begin() as conn:
+        indexes = conn.execute(sa.text("""
+            SELECT indexname, indexdef FROM pg_indexes
+            WHERE schemaname = current_schema()
+              AND tablename = ANY(:tables)
+              AND indexname NOT IN (SELECT conname FROM pg_constraint)
+              AND indexdef NOT LIKE 'CREATE UNIQUE INDEX %'
+        """), tables=list(tables)).fetchall()
+
+        foreign_keys = conn.execute(sa.text("""
+            SELECT conrelid::regclass::text, conname,
+                   pg_get_constraintdef(oid)
+            FROM pg_constraint
+            WHERE contype = 'f'
+              AND conrelid = ANY(CAST(:tables AS regclass[]))
+        """), tables=list(tables)).fetchall()
+
+        for table, name, definition in foreign_keys:
+            conn.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+        for name, definition in indexes:
+            conn.execute(f'DROP INDEX "{name}"')
+
+    return ([definition for name, definition in indexes],
+            [f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+             for table, name, definition in foreign_keys])
+
+
+def _execute(statement):
+    with db.engine.begin() as conn:
+        conn.execute(statement)
+
+
+def restore_deferred(index_ddl, foreign_key_ddl, jobs=1):
+    """Rebuild the dropped indexes, `jobs` at a time, then the foreign keys.
+
+    Adding a foreign key back checks every existing row, so a CSV that
+    references a missing user or message fails here.
+    """
+
+    pool_map(_execute, [(statement,) for statement in index_ddl], jobs)
+
+    try:
+        for statement in foreign_key_ddl:
+            _execute(statement)
+    except sa.exc.IntegrityError as exc:
+        raise click.ClickException(f"Foreign key check failed: {exc.orig}")
+
+
+def reset_sequences(tables):
+    """Point each serial `id` sequence past the largest loaded id."""
+
+    with db.engine.begin() as conn:
+        for table in tables:
+            if 'id' in db.metadata.tables[table].c:
+                conn.execute(sa.text(
+                    f"SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                    f"COALESCE(MAX(id), 0) + 1, false) FROM {table}"),
+                    table=table)
+
+
+##############################################################################
+# Other databases: chunked INSERTs
+
+
+def _converters(table, columns):
+    """Per-column functions turning CSV strings into column values."""
+
+    def convert(column):
+        try:
+            python_type = column.type.python_type
+        except NotImplementedError:
+            return str
+        if python_type is datetime:
+            return datetime.fromisoformat
+        if python_type in (int, float):
+            return python_type
+        return str
+
+    return [convert(table.c[name]) for name in columns]
+
+
+def insert_csv(table, path, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """INSERT `path` into `table`, a chunk per statement; returns a Step."""
+
+    start = perf_counter()
+    loaded = 0
+    model_table = db.metadata.tables[table]
+
+    with db.engine.begin() as conn:
+        for columns, rows in read_chunks(path, chunk_rows):
+            _check_columns(table, columns)
+            converters = _converters(model_table, columns)
+            try:
+                conn.execute(model_table.insert(), [
+                    {column: (convert(value) if value != '' else None)
+                     for column, convert, value in zip(columns, converters, row)}
+                    for row in rows])
+            except sa.exc.IntegrityError as exc:
+                raise _duplicate_rows(table, exc.orig)
+            loaded += len(rows)
+
+    return Step(table, loaded, perf_counter() - start)
+
+
+##############################################################################
+# Driver
+
+
+def seed(directory=DEFAULT_DIRECTORY, chunk_rows=DEFAULT_CHUNK_ROWS, jobs=1):
+    """Recreate the schema and load `directory`'s CSVs; returns the Steps."""
+
+    files = csv_files(directory)
+    if not files:
+        raise click.ClickException(f"No CSV files found in {directory}")
+    tables = [table for table, path in files]
+
+    reset_schema()
+    steps = []
+
+    try:
+        if db.engine.dialect.name != 'postgresql':
+            steps.extend(insert_csv(table, path, chunk_rows)
+                         for table, path in files)
+        else:
+            index_ddl, foreign_key_ddl = drop_deferred(tables)
+
+            steps.extend(pool_map(copy_csv, [(table, path, chunk_rows)
+                                             for table, path in files], jobs))
+
+            start = perf_counter()
+            reset_sequences(tables)
+            restore_deferred(index_ddl, foreign_key_ddl, jobs)
+            steps.append(Step('indexes and foreign keys', None,
+                              perf_counter() - start))
+    except Exception:
+        # Start over empty rather than leave a half-loaded database, perhaps
+        # without its foreign keys and indexes.
+        reset_schema()
+        raise
+
+    start = perf_counter()
+    counters.repair()
+    steps.append(Step('counters', None, perf_counter() - start))
+
+    if db.engine.dialect.name == 'postgresql':
+        start = perf_counter()
+        _execute(f"ANALYZE {', '.join(tables)}")
+        steps.append(Step('analyze', None, perf_counter() - start))
+
+    return steps
+
+
+def report(steps, elapsed):
+    """Print each step's rows/sec and the overall load rate."""
+
+    for step in steps:
+        if step.rows is None:
+            click.echo(f"{step.name:<25} {'':>13} {step.seconds:>8.1f}s")
+        else:
+            click.echo(f"{step.name:<25} {step.rows:>8} rows "
+                       f"{step.seconds:>8.1f}s "
+                       f"{step.rows / max(step.seconds, 1e-9):>10.0f} rows/s")
+
+    total = sum(step.rows or 0 for step in steps)
+    click.echo(f"Loaded {total} rows in {elapsed:.1f}s "
+               f"({total / max(elapsed, 1e-9):.0f} rows/s overall)")
+
+
+@click.command('seed')
+@click.argument('directory', default=DEFAULT_DIRECTORY,
+                type=click.Path(exists=True, file_okay=False))
+@click.option('--chunk-rows', default=DEFAULT_CHUNK_ROWS,
+              help='Rows sent per COPY / INSERT.')
+@click.option('--jobs', default=os.cpu_count() or 1,
+              help='Files loaded and indexes built in parallel (Postgres).')
+@with_appcontext
+def seed_command(directory, chunk_rows, jobs):
+    """Drop the database and bulk-load DIRECTORY's CSV files."""
+
+    started = perf_counter()
+    steps = seed(directory, chunk_rows, jobs)
+    report(steps, perf_counter() - started)
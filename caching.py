@@ -0,0 +1,151 @@
+"""HTTP caching policy for Warbler.
+
+Pages that can say cheaply what they depend on (profile, message and home
+timeline pages) build a `ConditionalPage` from those row versions before
+doing the expensive work. If the browser's `If-None-Match` (or
+`If-Modified-Since`) shows it already has that version, the view answers
+304 without querying the rest of the page or rendering it. Otherwise the
+rendered page gets an ETag and is marked `private, no-cache`, so the
+browser keeps it but revalidates it each time.
+
+Static files linked with `url_for('static', ...)` get a content-hash `v`
+query argument. Requests for the current version are cached for a year
+as immutable, and a changed file gets a new URL. Other responses are not
+stored at all.
+"""
+
+import hashlib
+import os
+from datetime import timezone
+
+from flask import Response, current_app, request, session
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+_static_hashes = {}
+_template_hash = None
+
+
+def _digest(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def _utc_naive(moment):
+    if moment is not None and moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def template_fingerprint():
+    """Hash of every template, so a deploy that changes them changes ETags."""
+
+    global _template_hash
+
+    if _template_hash is None:
+        digest = hashlib.sha1()
+        folder = os.path.join(current_app.root_path, current_app.template_folder)
+        for root, dirs, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as f:
+                    digest.update(f.read())
+        _template_hash = digest.hexdigest()
+
+    return _template_hash
+
+
+class ConditionalPage:
+    """Validators for a page built from `parts`, e.g. row ids and versions.
+
+    `last_modified`, if given, must cover everything the page shows.
+    """
+
+    def __init__(self, *parts, last_modified=None):
+        self.etag = _digest(template_fingerprint(), *parts)
+        self.last_modified = _utc_naive(last_modified)
+
+        # A page showing flashed messages mustn't be cached, or a later 304
+        # would bring the message back.
+        self.cacheable = '_flashes' not in session
+
+    def fresh(self):
+        """Does the browser already have this version?"""
+
+        if not self.cacheable:
+            return False
+
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(self.etag)
+
+        since = _utc_naive(request.if_modified_since)
+        return (since is not None and self.last_modified is not None
+                and self.last_modified.replace(microsecond=0) <= since)
+
+    def not_modified(self):
+        """An empty 304 response."""
+
+        return self.apply(Response(status=304))
+
+    def apply(self, response):
+        """Attach the validators to `response` (a response or page HTML)."""
+
+        if not isinstance(response, Response):
+            response = current_app.make_response(response)
+
+        if self.cacheable:
+            response.set_etag(self.etag)
+            if self.last_modified is not None:
+                response.last_modified = self.last_modified
+            response.headers['Cache-Control'] = 'private, no-cache'
+            response.vary.add('Cookie')
+
+        return response
+
+
+def static_fingerprint(filename):
+    """Short content hash of static `filename`, or None if it's missing."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+
+    cached = _static_hashes.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = (mtime, hashlib.md5(f.read()).hexdigest()[:12])
+        _static_hashes[path] = cached
+
+    return cached[1]
+
+
+def _fingerprint_static_urls(endpoint, values):
+    """url_defaults hook adding `v=<hash>` to static URLs."""
+
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        fingerprint = static_fingerprint(values['filename'])
+        if fingerprint:
+            values['v'] = fingerprint
+
+
+def _cache_policy(response):
+    """Pick Cache-Control for responses whose view didn't set validators."""
+
+    if request.endpoint == 'static':
+        version = request.args.get('v')
+        if version and version == static_fingerprint(request.view_args['filename']):
+            response.headers['Cache-Control'] = IMMUTABLE
+        else:
+            response.headers['Cache-Control'] = 'public, no-cache'
+
+    elif 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = 'no-store'
+
+    return response
+
+
+def init_app(app):
+    """Install the caching policy and static URL fingerprints on `app`."""
+
+    app.url_defaults(_fingerprint_static_urls)
+    app.after_request(_cache_policy)
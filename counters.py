@@ -0,0 +1,118 @@
+"""Denormalized counters for Warbler.
+
+Profile stats (messages, following, followers, likes) and per-message like
+counts are stored on the `users` and `messages` rows instead of being
+counted from the relationship collections on every page view.
+
+The routes call these helpers inside the same transaction as the write
+they describe; each one is a single `UPDATE ... SET n = n + delta`, so
+concurrent requests never lose an increment. `repair` recomputes every
+counter from the source tables.
+"""
+
+from collections import defaultdict
+
+from models import db, Follows, Likes, Message, User
+
+
+def _bump(model, ids, **deltas):
+    """Add `deltas` to counter columns of `model` rows with id in `ids`."""
+
+    if isinstance(ids, int):
+        ids = [ids]
+
+    values = {getattr(model, column): getattr(model, column) + delta
+              for column, delta in deltas.items()}
+
+    (model
+     .query
+     .filter(model.id.in_(ids))
+     .update(values, synchronize_session=False))
+
+
+def adjust(model, column, deltas):
+    """Add {row id: delta} to `column` of `model`, one UPDATE per distinct delta."""
+
+    by_delta = defaultdict(list)
+    for row_id, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(row_id)
+
+    for delta, ids in by_delta.items():
+        _bump(model, ids, **{column: delta})
+
+
+def followed(follower_id, followed_id, delta=1):
+    """`follower_id` started (delta=1) or stopped (delta=-1) following."""
+
+    _bump(User, follower_id, following_count=delta)
+    _bump(User, followed_id, followers_count=delta)
+
+
+def message_posted(user_id, delta=1):
+    """`user_id` posted (delta=1) or deleted (delta=-1) a message."""
+
+    _bump(User, user_id, messages_count=delta)
+
+
+def liked(user_id, message_id, delta=1):
+    """`user_id` liked (delta=1) or unliked (delta=-1) `message_id`."""
+
+    _bump(User, user_id, likes_count=delta)
+    _bump(Message, message_id, likes_count=delta)
+
+
+def message_deleted(message):
+    """`message` is about to be deleted along with its likes."""
+
+    message_posted(message.user_id, -1)
+    _bump(User,
+          db.session.query(Likes.user_id).filter(
+              Likes.message_id == message.id),
+          likes_count=-1)
+
+
+def _count(column, *criteria):
+    """Correlated `SELECT count(column) WHERE criteria` subquery."""
+
+    return db.select([db.func.count(column)]).where(db.and_(*criteria)).as_scalar()
+
+
+def repair(batch_size=10000):
+    """Recompute every counter from the source tables.
+
+    Works through users and messages in id ranges of `batch_size`,
+    committing after each range so no single transaction holds locks on
+    the whole table. Returns the number of (users, messages) rows touched.
+    """
+
+    user_values = {
+        User.messages_count: _count(Message.id, Message.user_id == User.id),
+        User.following_count: _count(Follows.user_being_followed_id,
+                                     Follows.user_following_id == User.id),
+        User.followers_count: _count(Follows.user_following_id,
+                                     Follows.user_being_followed_id == User.id),
+        User.likes_count: _count(Likes.id,
+                                 Likes.user_id == User.id,
+                                 Likes.message_id.isnot(None)),
+    }
+    message_values = {
+        Message.likes_count: _count(Likes.id, Likes.message_id == Message.id),
+    }
+
+    totals = []
+    for model, values in [(User, user_values), (Message, message_values)]:
+        touched = 0
+        max_id = db.session.query(db.func.max(model.id)).scalar() or 0
+
+        for start in range(0, max_id + 1, batch_size):
+            touched += (model
+                        .query
+                        .filter(model.id >= start,
+                                model.id < start + batch_size)
+                        .update(values, synchronize_session=False))
+            db.session.commit()
+
+        totals.append(touched)
+
+    return tuple(totals)
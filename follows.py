@@ -0,0 +1,107 @@
+"""Following and unfollowing for Warbler.
+
+`follow` and `unfollow` change the follow, both users' counters and the
+follower's timeline in the caller's transaction. With the write-behind
+buffer on (writebehind.py) they only record the new state there, and
+`apply_buffered` later writes a batch of follows and unfollows with one
+multi-row INSERT and one DELETE.
+"""
+
+from collections import defaultdict
+
+from models import db, Follows, User
+from writebehind import FOLLOW, pair_filter, write_buffer
+import counters
+import identity
+import timeline
+
+
+def _stored(follower_id, followed_id):
+    return db.session.query(
+        Follows
+        .query
+        .filter(Follows.user_following_id == follower_id,
+                Follows.user_being_followed_id == followed_id)
+        .exists()
+    ).scalar()
+
+
+def follow(user, followed_user):
+    """`user` starts following `followed_user`; the caller commits."""
+
+    if write_buffer.enabled:
+        write_buffer.put(FOLLOW, user.id, followed_user.id, True,
+                         lambda: _stored(user.id, followed_user.id))
+        return
+
+    user.following.append(followed_user)
+    db.session.flush()
+    counters.followed(user.id, followed_user.id)
+    timeline.follow(user.id, followed_user.id)
+
+
+def unfollow(user, followed_user):
+    """`user` stops following `followed_user`; the caller commits."""
+
+    if write_buffer.enabled:
+        write_buffer.put(FOLLOW, user.id, followed_user.id, False,
+                         lambda: _stored(user.id, followed_user.id))
+        return
+
+    user.following.remove(followed_user)
+    counters.followed(user.id, followed_user.id, -1)
+    timeline.unfollow(user.id, followed_user.id)
+
+
+def apply_buffered(changes):
+    """Write buffered (follower id, followed id, following) changes and commit.
+
+    Follows involving users deleted in the meantime are dropped.
+    """
+
+    pairs = [(follower_id, followed_id) for follower_id, followed_id, _ in changes]
+    stored = set(db.session
+                 .query(Follows.user_following_id, Follows.user_being_followed_id)
+                 .filter(pair_filter(Follows.user_following_id,
+                                     Follows.user_being_followed_id, pairs)))
+    users = {user_id for (user_id,) in db.session.query(User.id).filter(
+        User.id.in_({user_id for pair in pairs for user_id in pair}),
+        User.deleted_at.is_(None))}
+
+    added = [(follower_id, followed_id)
+             for follower_id, followed_id, following in changes
+             if following and (follower_id, followed_id) not in stored
+             and follower_id in users and followed_id in users]
+    removed = [(follower_id, followed_id)
+               for follower_id, followed_id, following in changes
+               if not following and (follower_id, followed_id) in stored]
+
+    if added:
+        db.session.execute(Follows.__table__.insert().values(
+            [{'user_following_id': follower_id, 'user_being_followed_id': followed_id}
+             for follower_id, followed_id in added]))
+    if removed:
+        (Follows
+         .query
+         .filter(pair_filter(Follows.user_following_id,
+                             Follows.user_being_followed_id, removed))
+         .delete(synchronize_session=False))
+
+    following, followers = defaultdict(int), defaultdict(int)
+    for delta, changed in [(1, added), (-1, removed)]:
+        for follower_id, followed_id in changed:
+            following[follower_id] += delta
+            followers[followed_id] += delta
+    counters.adjust(User, 'following_count', following)
+    counters.adjust(User, 'followers_count', followers)
+
+    for follower_id, followed_id in added:
+        timeline.follow(follower_id, followed_id)
+    for follower_id in {follower_id for follower_id, _ in removed}:
+        timeline.invalidate(follower_id)
+
+    db.session.commit()
+    identity.user_cache.invalidate(*following, *followers)
+
+
+write_buffer.register(FOLLOW, apply_buffered)
@@ -0,0 +1,105 @@
+"""Cache of rendered message cards.
+
+A card (author avatar and name, date and text) looks the same to every
+viewer and only changes if the author changes their name or picture, so
+`message_card(msg)` renders `messages/card.html` once and keeps the HTML
+in a bounded LRU keyed by message id. Each entry remembers the author
+fields and message values it was rendered with and is re-rendered if
+they no longer match (which also covers a database reusing a deleted
+message's id). The per-viewer like button is rendered by the page
+around the card and never cached.
+
+The cache is per process. `invalidate_message` and `invalidate_author`
+(called by the delete and profile-edit routes) free entries early; the
+version check keeps other processes from showing an old name or picture.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+from markupsafe import Markup
+
+DEFAULT_MAX_SIZE = 10000
+
+CARD_TEMPLATE = 'messages/card.html'
+
+
+class FragmentCache:
+    """LRU of rendered cards: message id -> (author id, version, html)."""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, message_id, version):
+        """Cached HTML for `message_id` rendered at `version`, or None."""
+
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is None or entry[1] != version:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(message_id)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, message_id, author_id, version, html):
+        """Cache `html`, evicting the least recently used cards."""
+
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[message_id] = (author_id, version, html)
+            self._entries.move_to_end(message_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate_message(self, *message_ids):
+        """Forget the cards for `message_ids`."""
+
+        with self._lock:
+            for message_id in message_ids:
+                self._entries.pop(message_id, None)
+
+    def invalidate_author(self, user_id):
+        """Forget every card by `user_id`."""
+
+        with self._lock:
+            for message_id in [message_id for message_id, entry
+                               in self._entries.items() if entry[0] == user_id]:
+                del self._entries[message_id]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+card_cache = FragmentCache()
+
+
+def message_card(msg):
+    """The card for `msg`, from the cache when nothing on it has changed."""
+
+    version = (msg.user.username, msg.user.image_url, msg.timestamp, msg.text)
+    html = card_cache.get(msg.id, version)
+
+    if html is None:
+        template = current_app.jinja_env.get_template(CARD_TEMPLATE)
+        html = template.render(msg=msg)
+        card_cache.put(msg.id, msg.user_id, version, html)
+
+    return Markup(html)
+
+
+def init_app(app):
+    """Size `card_cache` from FRAGMENT_CACHE_SIZE and expose `message_card`."""
+
+    card_cache.max_size = app.config.get('FRAGMENT_CACHE_SIZE', DEFAULT_MAX_SIZE)
+    app.jinja_env.globals['message_card'] = message_card
@@ -3,75 +3,266 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+Everything is drawn from a seeded NumPy generator a chunk at a time, so a
+run is reproducible, needs no network access, and streams to disk in
+bounded memory:
+
+- users.csv: profiles built from pools of Faker values, made once.
+- follows.csv: a power-law follower graph. Each user's popularity is
+  Pareto distributed and people follow others in proportion to it, so a
+  few users have most of the followers.
+- messages.csv: how often each user posts is heavy-tailed too; timestamps
+  follow a daily activity curve, come out in time order and end on
+  --end-date (a fixed day by default, not today).
+- likes.csv: a message's likes grow with its author's popularity; likers
+  are drawn by activity and never like their own messages.
+
+Run it from the project root like:
+
+    python generator/create_csvs.py --users 100000 --messages 5000000 --seed 7
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+from time import perf_counter
+
+import numpy as np
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import (HEADER_IMAGE_URLS, IMAGE_URLS, choose, cumulative,
+                     pareto, pool, timestamps, unique_pairs)
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
+NUM_LIKES = 3000
+
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# Most distinct values drawn from Faker for each pool.
+POOL_SIZE = 5000
+
+CHUNK_SIZE = 100000
+
+# Messages end on this day unless --end-date says otherwise; fixed, so the
+# same --seed writes the same files whenever it runs.
+END_DATE = '2024-01-01'
+
+
+class Population:
+    """Per-user weights that shape the follower graph, posts and likes."""
+
+    def __init__(self, rng, num_users):
+        self.size = num_users
+
+        # How many followers a user attracts: Pareto, so a heavy tail.
+        self.popularity = pareto(rng, 1.5, num_users)
+
+        # How much a user posts and likes; popular users post a bit more.
+        self.activity = (rng.lognormal(0, 1, num_users)
+                         * self.popularity ** 0.3)
+
+        # How many accounts a user follows, before scaling to a total.
+        self.following = rng.lognormal(0, 1, num_users)
+
+        self.popularity_cdf = cumulative(self.popularity)
+        self.activity_cdf = cumulative(self.activity)
+
+
+def write_users(path, rng, fake, num_users, chunk_size):
+    """Write `num_users` users; usernames get their id appended to be unique."""
+
+    size = min(num_users, POOL_SIZE)
+    usernames = pool(fake.user_name, size)
+    domains = pool(fake.free_email_domain, min(size, 100))
+    bios = pool(fake.sentence, size)
+    locations = pool(fake.city, size)
+    images = np.array(IMAGE_URLS, dtype=object)
+    headers = np.array(HEADER_IMAGE_URLS, dtype=object)
+
+    with open(path, 'w', newline='') as users_csv:
+        writer = csv.writer(users_csv)
+        writer.writerow(USERS_CSV_HEADERS)
+
+        for start in range(0, num_users, chunk_size):
+            n = min(chunk_size, num_users - start)
+            ids = np.arange(start + 1, start + n + 1).astype(str).astype(object)
+            names = usernames[rng.integers(0, size, n)] + ids
+            emails = names + '@' + domains[rng.integers(0, len(domains), n)]
+
+            writer.writerows(zip(
+                emails, names,
+                images[rng.integers(0, len(images), n)],
+                [PASSWORD] * n,
+                bios[rng.integers(0, size, n)],
+                headers[rng.integers(0, len(headers), n)],
+                locations[rng.integers(0, size, n)]))
+
+    return num_users
+
+
+def write_follows(path, rng, people, num_follows, chunk_size):
+    """Write about `num_follows` follows; who is followed is power-law."""
+
+    n = people.size
+    means = people.following * (num_follows / people.following.sum())
+    written = 0
+
+    with open(path, 'w', newline='') as follows_csv:
+        writer = csv.writer(follows_csv)
+        writer.writerow(FOLLOWS_CSV_HEADERS)
+
+        # Chunks split by follower, so a follower's duplicates are all in one.
+        for start in range(0, n, chunk_size):
+            followers = np.arange(start, min(start + chunk_size, n))
+            counts = np.minimum(rng.poisson(means[followers]), n - 1)
+            followers = np.repeat(followers, counts)
+            followed = choose(rng, people.popularity_cdf, followers.size)
+
+            keep = followers != followed
+            followers, followed = unique_pairs(followers[keep], followed[keep], n)
+
+            writer.writerows(zip((followed + 1).tolist(),
+                                 (followers + 1).tolist()))
+            written += followers.size
+
+    return written
+
+
+def write_messages_and_likes(messages_path, likes_path, rng, fake, people,
+                             num_messages, num_likes, years, chunk_size,
+                             end_date=END_DATE):
+    """Write messages in time order and about `num_likes` likes of them.
+
+    Messages span `years` years up to `end_date` (a 'YYYY-MM-DD' string).
+
+    Returns the (messages, likes) written.
+    """
+
+    n = people.size
+    texts = pool(lambda: fake.paragraph()[:MAX_WARBLER_LENGTH],
+                 min(num_messages, POOL_SIZE))
+
+    # Expected author popularity, to scale likes per message to the total.
+    activity = people.activity / people.activity.sum()
+    like_rate = num_likes / (num_messages * (activity @ people.popularity))
+
+    last_day = np.datetime64(end_date, 'D')
+    days = 365 * years
+    first_day = last_day - days
+
+    # Chunks cover whole days, so sorting each keeps the file in time order.
+    days_per_chunk = max(1, int(days * chunk_size / max(num_messages, 1)))
+    message_id = 0
+    likes_written = 0
+
+    with open(messages_path, 'w', newline='') as messages_csv, \
+            open(likes_path, 'w', newline='') as likes_csv:
+        messages_writer = csv.writer(messages_csv)
+        messages_writer.writerow(MESSAGES_CSV_HEADERS)
+        likes_writer = csv.writer(likes_csv)
+        likes_writer.writerow(LIKES_CSV_HEADERS)
+
+        for day in range(0, days, days_per_chunk):
+            span = min(days_per_chunk, days - day)
+            count = (num_messages * (day + span) // days
+                     - num_messages * day // days)
+            if not count:
+                continue
+
+            authors = choose(rng, people.activity_cdf, count)
+            ids = np.arange(message_id + 1, message_id + count + 1)
+            message_id += count
+
+            messages_writer.writerows(zip(
+                texts[rng.integers(0, len(texts), count)],
+                timestamps(rng, first_day + day, span, count),
+                (authors + 1).tolist()))
+
+            like_counts = np.minimum(
+                rng.poisson(like_rate * people.popularity[authors]), n - 1)
+            liked = np.repeat(ids, like_counts)
+            likers = choose(rng, people.activity_cdf, liked.size)
+
+            keep = likers != np.repeat(authors, like_counts)
+            liked, likers = unique_pairs(liked[keep], likers[keep], n)
+
+            likes_writer.writerows(zip((likers + 1).tolist(), liked.tolist()))
+            likes_written += liked.size
+
+    return message_id, likes_written
 
-fake = Faker()
 
-# Generate random profile image URLs to use for users
+def day(text):
+    """argparse type for a YYYY-MM-DD date."""
 
-image_urls = [
-    f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
-    for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
-    for i in range(count)
-]
+    return str(np.datetime64(text, 'D'))
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS,
+                        help='follows to draw; duplicates are dropped, '
+                             'so small graphs end up with fewer')
+    parser.add_argument('--likes', type=int, default=NUM_LIKES,
+                        help='likes to draw; duplicates are dropped')
+    parser.add_argument('--years', type=int, default=2,
+                        help='messages span this many years up to --end-date')
+    parser.add_argument('--end-date', default=END_DATE,
+                        type=day,
+                        help='last day of messages, YYYY-MM-DD')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help='rows generated per batch')
+    parser.add_argument('--out', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='directory to write the CSVs to')
+    args = parser.parse_args()
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+    rng = np.random.default_rng(args.seed)
+    fake = Faker()
+    fake.seed_instance(args.seed)
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
+    def path(name):
+        return os.path.join(args.out, name)
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
+    started = perf_counter()
+    people = Population(rng, args.users)
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+    steps = [
+        ('users', lambda: write_users(
+            path('users.csv'), rng, fake, args.users, args.chunk_size)),
+        ('follows', lambda: write_follows(
+            path('follows.csv'), rng, people, args.follows, args.chunk_size)),
+        ('messages + likes', lambda: sum(write_messages_and_likes(
+            path('messages.csv'), path('likes.csv'), rng, fake, people,
+            args.messages, args.likes, args.years, args.chunk_size,
+            args.end_date))),
+    ]
 
-# Generate follows.csv from random pairings of users
+    total = 0
+    for name, step in steps:
+        start = perf_counter()
+        rows = step()
+        elapsed = perf_counter() - start
+        total += rows
+        print(f"{name:<17} {rows:>10} rows {elapsed:>7.1f}s "
+              f"{rows / max(elapsed, 1e-9):>10.0f} rows/s")
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    elapsed = perf_counter() - started
+    print(f"Wrote {total} rows in {elapsed:.1f}s "
+          f"({total / max(elapsed, 1e-9) * 60:.0f} rows/minute)")
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Small in-process cache of logged-in users.
+
+Nearly every request needs the current user, and the row rarely changes,
+so instead of `User.query.get()` per request we keep recently-seen users'
+column values in a bounded LRU with a short TTL and rebuild a session-bound
+`User` from them without touching the database.
+
+The cache is per process: `invalidate` is called by the routes that change
+a user (profile edits, deletes, follows, likes, new messages), and the TTL
+bounds how long another worker can serve a stale copy.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 30
+
+
+class IdentityCache:
+    """LRU + TTL cache of `User` column values keyed by user id."""
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def load(self, user_id):
+        """Return the `User` with `user_id` in the current session, or None.
+
+        Deleted accounts count as missing.
+
+        Served from the cache when there is a fresh entry, otherwise loaded
+        from the database and cached.
+        """
+
+        values = self._get(user_id)
+        if values is not None:
+            user = User(**values)
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+
+        user = User.query.get(user_id)
+        if user is None or user.deleted_at is not None:
+            return None
+
+        self._put(user)
+        return user
+
+    def invalidate(self, *user_ids):
+        """Forget the cached copies of `user_ids`."""
+
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Forget every cached user."""
+
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, user_id):
+        """Fresh cached column values for `user_id`, or None."""
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires, values = entry
+            if expires <= monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return values
+
+    def _put(self, user):
+        """Cache `user`'s column values, evicting the least recently used."""
+
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+
+        values = {attr.key: getattr(user, attr.key)
+                  for attr in User.__mapper__.column_attrs}
+
+        with self._lock:
+            self._entries[user.id] = (monotonic() + self.ttl, values)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+user_cache = IdentityCache()
+
+
+def init_app(app):
+    """Size `user_cache` from USER_CACHE_SIZE / USER_CACHE_TTL."""
+
+    user_cache.max_size = app.config.get('USER_CACHE_SIZE', DEFAULT_MAX_SIZE)
+    user_cache.ttl = app.config.get('USER_CACHE_TTL', DEFAULT_TTL)
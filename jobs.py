@@ -0,0 +1,366 @@
+"""Background jobs for Warbler.
+
+Routes hand slow side effects (timeline fan-out, cleanup after deletes)
+to `enqueue`, which adds a row to the `jobs` table in the route's own
+transaction and returns. The job exists only if the route commits, and it
+is never run before the data it refers to is visible.
+
+Workers claim due jobs, run them and record the outcome:
+
+- A job's work and its "done" mark are committed together. A worker that
+  dies mid-job leaves it "running"; after JOB_LOCK_TIMEOUT seconds another
+  worker takes it over. So a job runs to completion at least once, and
+  its effects are committed once.
+- A job that raises is retried with exponential backoff, up to the task's
+  `max_attempts`, then left "failed" with its last error.
+- `enqueue(..., key=...)` is a no-op when a job with that idempotency key
+  already exists (until `flask jobs prune` deletes it).
+- A task's `concurrency` caps how many of its jobs run at once across all
+  workers.
+
+Each web process runs JOB_WORKER_THREADS worker threads, started by the
+first enqueue. Dedicated worker processes can run as well, or instead
+(with JOB_WORKER_THREADS=0):
+
+    flask jobs work [--threads N] [--task NAME ...] [--burst]
+    flask jobs status
+    flask jobs prune [--days N]
+
+With JOBS_EAGER, `enqueue` runs the task right away in the caller's
+transaction instead, for tests and debugging. Jobs queued by an eager task
+run after it returns, one after another, so a task that requeues itself
+loops rather than recursing.
+"""
+
+import json
+import os
+import socket
+from collections import deque, namedtuple
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread, get_ident, local
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.dialects import postgresql
+
+from models import db, Job
+
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_WORKER_THREADS = 2
+DEFAULT_POLL_INTERVAL = 1.0
+DEFAULT_LOCK_TIMEOUT = 300
+
+# Seconds before the first retry; doubles with each attempt, up to MAX_RETRY_DELAY.
+RETRY_DELAY = 10
+MAX_RETRY_DELAY = 3600
+
+# Jobs looked at per claim attempt.
+CLAIM_BATCH = 20
+
+Task = namedtuple('Task', ['fn', 'max_attempts', 'concurrency'])
+
+tasks = {}
+
+# Jobs queued by the eager task running on this thread.
+_eager = local()
+
+
+def task(name=None, max_attempts=DEFAULT_MAX_ATTEMPTS, concurrency=None):
+    """Register the decorated function as a task that `enqueue` can queue.
+
+    The function takes the job's payload as keyword arguments and must not
+    commit; the worker commits its work together with the job's outcome.
+    """
+
+    def register(fn):
+        fn.task_name = name or f'{fn.__module__}.{fn.__name__}'
+        tasks[fn.task_name] = Task(fn, max_attempts, concurrency)
+        return fn
+
+    return register
+
+
+def enqueue(fn, key=None, delay=0, **payload):
+    """Queue task `fn` with `payload` (JSON-able) in the current transaction.
+
+    Returns False when a job with idempotency `key` already exists.
+    """
+
+    if current_app.config.get('JOBS_EAGER'):
+        _run_eagerly(fn, payload)
+        return True
+
+    name = fn.task_name
+    values = {
+        'name': name,
+        'payload': json.dumps(payload),
+        'idempotency_key': key,
+        'max_attempts': tasks[name].max_attempts,
+        'run_at': datetime.utcnow() + timedelta(seconds=delay),
+    }
+
+    jobs = Job.__table__
+    dialect = db.engine.dialect.name
+    if key is not None and dialect == 'postgresql':
+        statement = postgresql.insert(jobs).values(**values).on_conflict_do_nothing(
+            index_elements=['idempotency_key'])
+    elif key is not None and dialect == 'sqlite':
+        statement = jobs.insert().values(**values).prefix_with('OR IGNORE')
+    else:
+        statement = jobs.insert().values(**values)
+
+    queued = db.session.execute(statement).rowcount != 0
+    workers.start(current_app._get_current_object())
+    return queued
+
+
+def _run_eagerly(fn, payload):
+    pending = getattr(_eager, 'pending', None)
+    if pending is not None:
+        pending.append((fn, payload))
+        return
+
+    _eager.pending = pending = deque([(fn, payload)])
+    try:
+        while pending:
+            fn, payload = pending.popleft()
+            fn(**payload)
+    finally:
+        _eager.pending = None
+
+
+##############################################################################
+# Running jobs
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{get_ident()}'
+
+
+def _lock_timeout():
+    return timedelta(seconds=current_app.config.get('JOB_LOCK_TIMEOUT',
+                                                    DEFAULT_LOCK_TIMEOUT))
+
+
+def _running(name, stale):
+    """Ids of `name` jobs held by live workers, oldest claim first."""
+
+    return [job_id for (job_id,) in db.session
+            .query(Job.id)
+            .filter(Job.name == name, Job.status == 'running',
+                    Job.locked_at >= stale)
+            .order_by(Job.locked_at, Job.id)]
+
+
+def claim(worker, names=None):
+    """Take the next due job for `worker` and commit; returns it or None."""
+
+    now = datetime.utcnow()
+    stale = now - _lock_timeout()
+
+    # Plain columns, not Job objects: the rollback below would expire those
+    # and reload each one on first use.
+    due = (db.session
+           .query(Job.id, Job.name, Job.status, Job.attempts)
+           .filter(db.or_(
+               db.and_(Job.status == 'queued', Job.run_at <= now),
+               db.and_(Job.status == 'running', Job.locked_at < stale))))
+    if names:
+        due = due.filter(Job.name.in_(names))
+    candidates = due.order_by(Job.run_at, Job.id).limit(CLAIM_BATCH).all()
+    db.session.rollback()
+
+    for job in candidates:
+        limit = tasks[job.name].concurrency if job.name in tasks else None
+        if limit is not None and len(_running(job.name, stale)) >= limit:
+            continue
+
+        # Only one worker's UPDATE can match: the others see the new attempts.
+        claimed = (Job
+                   .query
+                   .filter(Job.id == job.id, Job.status == job.status,
+                           Job.attempts == job.attempts)
+                   .update({Job.status: 'running', Job.locked_by: worker,
+                            Job.locked_at: now, Job.attempts: Job.attempts + 1},
+                           synchronize_session=False))
+        db.session.commit()
+        if not claimed:
+            continue
+
+        # Two workers may have claimed past the limit at once; the later
+        # claims give theirs back.
+        if limit is not None and job.id not in _running(job.name, stale)[:limit]:
+            (Job
+             .query
+             .filter(Job.id == job.id, Job.locked_by == worker)
+             .update({Job.status: 'queued', Job.locked_by: None,
+                      Job.attempts: Job.attempts - 1},
+                     synchronize_session=False))
+            db.session.commit()
+            continue
+
+        return Job.query.get(job.id)
+
+    return None
+
+
+def run(job, worker):
+    """Run a claimed `job` and record how it went. Returns True if it succeeded."""
+
+    task = tasks.get(job.name)
+    try:
+        if task is None:
+            raise LookupError(f"no task called {job.name!r}")
+        task.fn(**json.loads(job.payload))
+        finished = _finish(job, worker, status='done',
+                           finished_at=datetime.utcnow(), last_error=None)
+        if not finished:
+            # Our lock expired and another worker has the job now.
+            db.session.rollback()
+            return False
+        db.session.commit()
+        return True
+
+    except Exception as e:
+        db.session.rollback()
+        error = f'{type(e).__name__}: {e}'
+        current_app.logger.exception("Job %s (%s) failed", job.id, job.name)
+
+        if task is not None and job.attempts < job.max_attempts:
+            delay = min(RETRY_DELAY * 2 ** (job.attempts - 1), MAX_RETRY_DELAY)
+            _finish(job, worker, status='queued', last_error=error,
+                    run_at=datetime.utcnow() + timedelta(seconds=delay))
+        else:
+            _finish(job, worker, status='failed', last_error=error,
+                    finished_at=datetime.utcnow())
+        db.session.commit()
+        return False
+
+
+def _finish(job, worker, **values):
+    values.update(locked_by=None, locked_at=None)
+    return (Job
+            .query
+            .filter(Job.id == job.id, Job.locked_by == worker)
+            .update({getattr(Job, column): value
+                     for column, value in values.items()},
+                    synchronize_session=False))
+
+
+def work(names=None, burst=False, stop=None, poll=None):
+    """Claim and run jobs until `stop` is set; needs an app context.
+
+    With `burst`, returns once no job is due. Returns the number of jobs run.
+    """
+
+    worker = worker_name()
+    stop = stop or Event()
+    if poll is None:
+        poll = current_app.config.get('JOB_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+
+    ran = 0
+    while not stop.is_set():
+        job = claim(worker, names)
+        if job is None:
+            if burst:
+                break
+            stop.wait(poll)
+            continue
+
+        run(job, worker)
+        ran += 1
+
+    return ran
+
+
+class WorkerThreads:
+    """The in-process worker threads, started on first use."""
+
+    def __init__(self):
+        self.threads = []
+        self.stop = Event()
+        self._lock = Lock()
+
+    def start(self, app):
+        if self.threads:
+            return
+
+        with self._lock:
+            if self.threads:
+                return
+            for i in range(app.config.get('JOB_WORKER_THREADS',
+                                          DEFAULT_WORKER_THREADS)):
+                thread = Thread(target=self._run, args=(app,), daemon=True,
+                                name=f'jobs-{i}')
+                thread.start()
+                self.threads.append(thread)
+
+    def _run(self, app):
+        with app.app_context():
+            work(stop=self.stop)
+
+
+workers = WorkerThreads()
+
+
+##############################################################################
+# Command line
+
+cli = AppGroup('jobs', help='Run and inspect background jobs.')
+
+
+@cli.command('work')
+@click.option('--threads', default=1, help='worker threads')
+@click.option('--task', 'names', multiple=True,
+              help='only run these tasks (repeatable)')
+@click.option('--burst', is_flag=True, help='exit when no job is due')
+def work_command(threads, names, burst):
+    """Run queued jobs."""
+
+    app = current_app._get_current_object()
+    counts = []
+
+    def run_worker():
+        with app.app_context():
+            counts.append(work(names=list(names), burst=burst))
+
+    pool = [Thread(target=run_worker) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    click.echo(f"Ran {sum(counts)} jobs.")
+
+
+@cli.command('status')
+def status_command():
+    """Show job counts by task and status."""
+
+    rows = (db.session
+            .query(Job.name, Job.status, db.func.count(Job.id))
+            .group_by(Job.name, Job.status)
+            .order_by(Job.name, Job.status))
+    for name, status, count in rows:
+        click.echo(f"{name:<40} {status:<8} {count:>8}")
+
+
+@cli.command('prune')
+@click.option('--days', default=7, help='keep finished jobs this many days')
+def prune_command(days):
+    """Delete finished jobs (and their idempotency keys) older than --days."""
+
+    pruned = (Job
+              .query
+              .filter(Job.status.in_(['done', 'failed']),
+                      Job.finished_at < datetime.utcnow() - timedelta(days=days))
+              .delete(synchronize_session=False))
+    db.session.commit()
+    click.echo(f"Deleted {pruned} jobs.")
+
+
+def init_app(app):
+    """Add the `flask jobs` commands."""
+
+    app.cli.add_command(cli)
@@ -0,0 +1,180 @@
+"""Atomic like toggling for Warbler.
+
+Toggling a like used to be SELECT, then DELETE or INSERT, then commit, so
+two quick clicks could both see "not liked" and insert duplicate rows. On
+PostgreSQL `toggle_like` is a single statement: data-modifying CTEs delete the
+like if it exists, otherwise insert it (ON CONFLICT DO NOTHING against the
+unique (user_id, message_id) index), adjust both like counters by what
+actually changed, and return the new state. Other databases do the same
+in a few statements inside one transaction, relying on the unique index.
+
+With the write-behind buffer on (writebehind.py), `toggle_like` only
+records the new state there; `apply_buffered` later writes a batch of
+likes and unlikes with one multi-row INSERT and one DELETE.
+"""
+
+from collections import defaultdict, namedtuple
+
+from models import db, Likes, Message, User
+from writebehind import LIKE, pair_filter, write_buffer
+import counters
+import identity
+
+LikeState = namedtuple('LikeState', ['liked', 'likes_count'])
+
+TOGGLE_SQL = """
+WITH removed AS (
+    DELETE FROM likes
+    WHERE user_id = :user_id AND message_id = :message_id
+    RETURNING id
+), added AS (
+    INSERT INTO likes (user_id, message_id)
+    SELECT :user_id, :message_id
+    WHERE NOT EXISTS (SELECT 1 FROM removed)
+      AND EXISTS (SELECT 1 FROM messages JOIN users ON users.id = messages.user_id
+                  WHERE messages.id = :message_id AND users.deleted_at IS NULL)
+    ON CONFLICT (user_id, message_id) DO NOTHING
+    RETURNING id
+), delta AS (
+    SELECT (SELECT count(*) FROM added) - (SELECT count(*) FROM removed) AS n
+), message_count AS (
+    UPDATE messages SET likes_count = likes_count + (SELECT n FROM delta)
+    FROM users
+    WHERE messages.id = :message_id
+      AND users.id = messages.user_id AND users.deleted_at IS NULL
+    RETURNING messages.likes_count
+), user_count AS (
+    UPDATE users SET likes_count = likes_count + (SELECT n FROM delta),
+                     updated_at = now() AT TIME ZONE 'utc'
+    WHERE id = :user_id
+)
+SELECT NOT EXISTS (SELECT 1 FROM removed) AS liked,
+       (SELECT likes_count FROM message_count) AS likes_count
+"""
+
+
+def toggle_like(user_id, message_id):
+    """Like `message_id` for `user_id` if they haven't, else unlike it.
+
+    Returns the new `LikeState`, or None if there is no such message (or
+    its author has deleted their account); the caller commits (or rolls
+    back).
+    """
+
+    if write_buffer.enabled:
+        return _buffered_toggle(user_id, message_id)
+
+    if db.engine.dialect.name == 'postgresql':
+        liked, likes_count = db.session.execute(
+            db.text(TOGGLE_SQL),
+            {'user_id': user_id, 'message_id': message_id}).first()
+        return LikeState(liked, likes_count) if likes_count is not None else None
+
+    # The DELETE takes SQLite's write lock, so nothing can slip in between
+    # it and the INSERT; a conflicting insert elsewhere raises IntegrityError.
+    removed = (Likes
+               .query
+               .filter(Likes.user_id == user_id,
+                       Likes.message_id == message_id)
+               .delete(synchronize_session=False))
+
+    likes_count = _likes_count(message_id)
+    if likes_count is None:
+        return None
+
+    if not removed:
+        db.session.execute(Likes.__table__.insert().values(
+            user_id=user_id, message_id=message_id))
+
+    delta = -1 if removed else 1
+    counters.liked(user_id, message_id, delta)
+
+    return LikeState(not removed, likes_count + delta)
+
+
+def _likes_count(message_id):
+    """`message_id`'s like count, or None if it's gone or its author is."""
+
+    return (db.session
+            .query(Message.likes_count)
+            .join(Message.user)
+            .filter(Message.id == message_id, User.deleted_at.is_(None))
+            .scalar())
+
+
+def _buffered_toggle(user_id, message_id):
+    likes_count = _likes_count(message_id)
+    if likes_count is None:
+        return None
+
+    liked = write_buffer.toggle(
+        LIKE, user_id, message_id,
+        lambda: bool(liked_ids(user_id, [message_id])))
+
+    return LikeState(liked, likes_count + write_buffer.net(LIKE, message_id))
+
+
+def apply_buffered(changes):
+    """Write buffered (user id, message id, liked) changes and commit.
+
+    Likes of messages or by users deleted in the meantime are dropped.
+    """
+
+    pairs = [(user_id, message_id) for user_id, message_id, _ in changes]
+    stored = set(db.session
+                 .query(Likes.user_id, Likes.message_id)
+                 .filter(pair_filter(Likes.user_id, Likes.message_id, pairs)))
+    users = {user_id for (user_id,) in db.session.query(User.id).filter(
+        User.id.in_({user_id for user_id, _ in pairs}),
+        User.deleted_at.is_(None))}
+    messages = {message_id for (message_id,) in db.session
+                .query(Message.id)
+                .join(Message.user)
+                .filter(Message.id.in_({message_id for _, message_id in pairs}),
+                        User.deleted_at.is_(None))}
+
+    added = [(user_id, message_id) for user_id, message_id, liked in changes
+             if liked and (user_id, message_id) not in stored
+             and user_id in users and message_id in messages]
+    removed = [(user_id, message_id) for user_id, message_id, liked in changes
+               if not liked and (user_id, message_id) in stored]
+
+    if added:
+        db.session.execute(Likes.__table__.insert().values(
+            [{'user_id': user_id, 'message_id': message_id}
+             for user_id, message_id in added]))
+    if removed:
+        (Likes
+         .query
+         .filter(pair_filter(Likes.user_id, Likes.message_id, removed))
+         .delete(synchronize_session=False))
+
+    user_deltas, message_deltas = defaultdict(int), defaultdict(int)
+    for delta, changed in [(1, added), (-1, removed)]:
+        for user_id, message_id in changed:
+            user_deltas[user_id] += delta
+            message_deltas[message_id] += delta
+    counters.adjust(User, 'likes_count', user_deltas)
+    counters.adjust(Message, 'likes_count', message_deltas)
+
+    db.session.commit()
+    identity.user_cache.invalidate(*user_deltas)
+
+
+def liked_ids(user_id, message_ids):
+    """Which of `message_ids` has `user_id` liked? Returns a set.
+
+    Includes likes and unlikes still in the write-behind buffer.
+    """
+
+    if not message_ids:
+        return set()
+
+    return write_buffer.overlay(LIKE, user_id, message_ids, {
+        message_id for (message_id,) in db.session
+        .query(Likes.message_id)
+        .filter(Likes.user_id == user_id,
+                Likes.message_id.in_(message_ids))})
+
+
+write_buffer.register(LIKE, apply_buffered)
@@ -0,0 +1,60 @@
+"""Batched, order-preserving loading of rows by id (DataLoader-style).
+
+Routes that start from a list of ids (e.g. a user's liked message ids)
+should not fetch each row with its own `query.get()`. A `BatchLoader`
+collects the ids, fetches every one it hasn't seen yet in a single
+`IN (...)` query, and hands the rows back in the order the ids were
+given. Rows are remembered for the rest of the request, so asking again
+is free.
+"""
+
+from flask import g
+
+from models import Message
+
+
+class BatchLoader:
+    """Loads rows of one model by id, batching and caching lookups."""
+
+    def __init__(self, query):
+        """`query` is the base query to load from, e.g. `Message.with_author()`."""
+
+        self.query = query
+        self.model = query.column_descriptions[0]['entity']
+        self.cache = {}
+
+    def load_many(self, ids):
+        """Return the rows for `ids`, in the same order, in at most one query.
+
+        Ids with no row (e.g. deleted since the id list was read) are
+        skipped.
+        """
+
+        ids = list(ids)
+        missing = {id for id in ids if id not in self.cache}
+
+        if missing:
+            for row in self.query.filter(self.model.id.in_(missing)):
+                self.cache[row.id] = row
+
+        return [self.cache[id] for id in ids if id in self.cache]
+
+    def load(self, id):
+        """Return the row for `id`, or None if there isn't one."""
+
+        rows = self.load_many([id])
+        return rows[0] if rows else None
+
+    def prime(self, rows):
+        """Remember already-loaded `rows` so later loads don't fetch them."""
+
+        for row in rows:
+            self.cache[row.id] = row
+
+
+def message_loader():
+    """This request's `BatchLoader` for messages (with their authors)."""
+
+    if 'message_loader' not in g:
+        g.message_loader = BatchLoader(Message.with_author())
+    return g.message_loader
@@ -0,0 +1,220 @@
+"""Lightweight request instrumentation for Warbler.
+
+Every request's SQL time (SQLAlchemy engine events), template rendering
+time (Flask's template signals), query count (querybudget) and total
+time are measured and
+
+- sent back in a `Server-Timing` header, which browsers' dev tools show
+  alongside the network timings;
+- added to per-route counters and latency histograms, served in the
+  Prometheus text format at `/metrics` along with the state of each
+  database connection pool.
+
+Streamed pages (see `streaming`) send their headers before the body runs
+its queries, so their Server-Timing only covers the work done up front;
+/metrics records every request once its body is finished, streamed or not.
+
+The numbers are kept per process, so scrape each worker and let
+Prometheus add them up.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+from time import perf_counter
+
+from flask import (Response, before_render_template, current_app, g,
+                   has_app_context, request, template_rendered)
+from sqlalchemy.engine import Engine
+
+from models import db
+import querybudget
+
+# Histogram bucket upper bounds, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Observation counts per bucket, plus their sum."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+    def lines(self, name, labels):
+        """Prometheus sample lines, with cumulative buckets."""
+
+        total = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            total += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {total}'
+        yield f'{name}_sum{{{labels}}} {self.sum}'
+        yield f'{name}_count{{{labels}}} {total}'
+
+
+class Registry:
+    """Per-route request metrics for this process."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = defaultdict(int)
+            self.duration = defaultdict(Histogram)
+            self.db_duration = defaultdict(Histogram)
+            self.template_seconds = defaultdict(float)
+            self.queries = defaultdict(int)
+
+    def observe(self, route, method, status, total, db_time, template_time,
+                queries):
+        """Record one finished request."""
+
+        with self._lock:
+            self.requests[(route, method, status)] += 1
+            self.duration[route].observe(total)
+            self.db_duration[route].observe(db_time)
+            self.template_seconds[route] += template_time
+            self.queries[route] += queries
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+
+        with self._lock:
+            lines = [
+                '# HELP warbler_requests_total Requests handled.',
+                '# TYPE warbler_requests_total counter',
+            ]
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f'warbler_requests_total{{route="{route}",'
+                             f'method="{method}",status="{status}"}} {count}')
+
+            for name, help_text, histograms in [
+                    ('warbler_request_duration_seconds',
+                     'Time to handle a request.', self.duration),
+                    ('warbler_request_db_seconds',
+                     'Time spent in SQL per request.', self.db_duration)]:
+                lines += [f'# HELP {name} {help_text}',
+                          f'# TYPE {name} histogram']
+                for route, histogram in sorted(histograms.items()):
+                    lines.extend(histogram.lines(name, f'route="{route}"'))
+
+            for name, help_text, values in [
+                    ('warbler_template_seconds_total',
+                     'Time spent rendering templates.', self.template_seconds),
+                    ('warbler_queries_total',
+                     'SQL statements run.', self.queries)]:
+                lines += [f'# HELP {name} {help_text}',
+                          f'# TYPE {name} counter']
+                for route, value in sorted(values.items()):
+                    lines.append(f'{name}{{route="{route}"}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_start'] = perf_counter()
+
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    """Add the statement's time to the current request's DB time."""
+
+    if has_app_context():
+        g.db_time = g.get('db_time', 0.0) + perf_counter() - conn.info['query_start']
+
+
+def _start_render(sender, template, context, **extra):
+    g.render_start = perf_counter()
+
+
+def _end_render(sender, template, context, **extra):
+    """Add the render's time to the current request's template time."""
+
+    g.template_time = (g.get('template_time', 0.0)
+                       + perf_counter() - g.pop('render_start', perf_counter()))
+
+
+def _start_request():
+    g.request_start = perf_counter()
+
+
+def _finish_request(response):
+    """Add the Server-Timing header (so far, for a streamed response)."""
+
+    total = perf_counter() - g.get('request_start', perf_counter())
+    db_time = g.get('db_time', 0.0)
+    template_time = g.get('template_time', 0.0)
+    queries = querybudget.query_count()
+
+    response.headers.add(
+        'Server-Timing',
+        f'db;dur={db_time * 1000:.1f};desc="{queries} queries", '
+        f'tpl;dur={template_time * 1000:.1f}, '
+        f'total;dur={total * 1000:.1f}')
+
+    g.response_status = response.status_code
+    return response
+
+
+def _record_request(exc):
+    """Record the request, once its body (streamed or not) is done.
+
+    Runs at request teardown, which a streamed response puts off until
+    its generator finishes.
+    """
+
+    if 'request_start' not in g:
+        return
+
+    registry.observe(request.endpoint or 'unmatched', request.method,
+                     g.get('response_status', 500),
+                     perf_counter() - g.request_start, g.get('db_time', 0.0),
+                     g.get('template_time', 0.0), querybudget.query_count())
+
+
+def pool_metrics():
+    """Connection pool gauges and checkout counts per database bind."""
+
+    stats = db.pool_stats(current_app._get_current_object())
+    lines = []
+    for stat, kind, help_text in [
+            ('size', 'gauge', 'Configured pool size.'),
+            ('idle', 'gauge', 'Connections idle in the pool.'),
+            ('checked_out', 'gauge', 'Connections in use.'),
+            ('overflow', 'gauge', 'Connections open beyond the pool size.'),
+            ('checkouts', 'counter', 'Connections handed out by the pool.')]:
+        name = f'warbler_db_pool_{stat}' + ('_total' if kind == 'counter' else '')
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for bind, numbers in stats:
+            if stat in numbers:
+                lines.append(f'{name}{{bind="{bind}"}} {numbers[stat]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_view():
+    """Prometheus scrape endpoint."""
+
+    return Response(registry.render() + pool_metrics(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def init_app(app):
+    """Instrument `app`'s requests and serve /metrics."""
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_record_request)
+    before_render_template.connect(_start_render, app)
+    template_rendered.connect(_end_render, app)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,271 @@
+"""Versioned schema migrations for Warbler.
+
+Each migration is a module in `migrations/` named `NNNN_description.py`
+with an `upgrade(conn)` function. `upgrade` applies the ones not yet
+recorded in the `schema_migrations` table, in version order, each in its
+own transaction, so a database created before a change can be brought up
+to date without `db.drop_all()`.
+
+A migration that sets `TRANSACTIONAL = False` runs outside a transaction
+on PostgreSQL instead, each statement committing as it goes. Building
+indexes (`create_index`) and backfilling columns (`backfill`) work that
+way, so neither holds a lock on a whole table for its duration; such a
+migration must be safe to run again after failing part way.
+
+A brand-new database is built straight from the models with
+`db.create_all()` and stamped as fully migrated.
+
+Run from the command line:
+
+    flask db upgrade      # apply pending migrations
+    flask db status       # show applied / pending migrations
+    flask db explain      # index-usage report for the routes' queries
+"""
+
+import importlib
+import pkgutil
+from datetime import datetime
+
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+import migrations
+import timeline
+from models import db, Follows, Likes, Message, User
+
+# Rows per UPDATE in `backfill`.
+BACKFILL_BATCH_SIZE = 10000
+
+metadata = sa.MetaData()
+
+schema_migrations = sa.Table(
+    'schema_migrations', metadata,
+    sa.Column('version', sa.Integer, primary_key=True),
+    sa.Column('name', sa.Text, nullable=False),
+    sa.Column('applied_at', sa.DateTime, nullable=False),
+)
+
+
+def has_table(conn, table):
+    """Does `table` exist?"""
+
+    return conn.dialect.has_table(conn, table)
+
+
+def has_column(conn, table, column):
+    """Does `table` have a column called `column`?"""
+
+    return column in {col['name'] for col in sa.inspect(conn).get_columns(table)}
+
+
+def create_index(conn, name, table, spec, unique=False):
+    """Create index `name` on `table` unless it exists.
+
+    `spec` is the rest of the statement, e.g. "(user_id, timestamp)". On
+    PostgreSQL the index is built CONCURRENTLY, which doesn't block writes
+    but can't run in a transaction, and a build that failed half way is
+    dropped and started over.
+    """
+
+    concurrently = ''
+    if conn.dialect.name == 'postgresql':
+        concurrently = ' CONCURRENTLY'
+        invalid = conn.execute(sa.text(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = indexrelid "
+            "WHERE relname = :name AND NOT indisvalid"), name=name).scalar()
+        if invalid:
+            conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+    conn.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX{concurrently} "
+                 f"IF NOT EXISTS {name} ON {table} {spec}")
+
+
+def backfill(conn, table, assignments, batch_size=BACKFILL_BATCH_SIZE):
+    """UPDATE `table` SET `assignments` in batches of `batch_size` ids."""
+
+    last = conn.execute(f"SELECT max(id) FROM {table}").scalar() or 0
+    for low in range(0, last, batch_size):
+        conn.execute(sa.text(f"UPDATE {table} SET {assignments} "
+                             f"WHERE id > :low AND id <= :high"),
+                     low=low, high=low + batch_size)
+
+
+def available():
+    """All migrations as (version, name, module), oldest first."""
+
+    found = []
+    for info in pkgutil.iter_modules(migrations.__path__):
+        version, _, name = info.name.partition('_')
+        if version.isdigit():
+            module = importlib.import_module(f"migrations.{info.name}")
+            found.append((int(version), name, module))
+
+    return sorted(found, key=lambda migration: migration[0])
+
+
+def applied():
+    """Versions already applied to the database, as a set."""
+
+    with db.engine.begin() as conn:
+        schema_migrations.create(conn, checkfirst=True)
+        return {version for (version,) in
+                conn.execute(sa.select([schema_migrations.c.version]))}
+
+
+def _record(conn, version, name):
+    conn.execute(schema_migrations.insert().values(
+        version=version, name=name, applied_at=datetime.utcnow()))
+
+
+def upgrade(target=None):
+    """Apply pending migrations up to `target` (default: all).
+
+    Returns the (version, name) pairs that were applied.
+    """
+
+    done = applied()
+    todo = [(version, name, module)
+            for version, name, module in available()
+            if version not in done and (target is None or version <= target)]
+
+    with db.engine.connect() as conn:
+        fresh = not done and not has_table(conn, 'users')
+
+    if fresh:
+        db.create_all()
+        with db.engine.begin() as conn:
+            for version, name, module in todo:
+                _record(conn, version, name)
+        return [(version, name) for version, name, module in todo]
+
+    for version, name, module in todo:
+        if (getattr(module, 'TRANSACTIONAL', True)
+                or db.engine.dialect.name != 'postgresql'):
+            with db.engine.begin() as conn:
+                module.upgrade(conn)
+                _record(conn, version, name)
+            continue
+
+        with db.engine.connect() as conn:
+            module.upgrade(conn.execution_options(isolation_level='AUTOCOMMIT'))
+        with db.engine.begin() as conn:
+            _record(conn, version, name)
+
+    return [(version, name) for version, name, module in todo]
+
+
+##############################################################################
+# Index-usage report
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN a statement (EXPLAIN QUERY PLAN on SQLite)."""
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    prefix = ('EXPLAIN QUERY PLAN ' if compiler.dialect.name == 'sqlite'
+              else 'EXPLAIN ')
+    return prefix + compiler.process(element.statement, **kw)
+
+
+def route_queries(user_id, message_id):
+    """The hot queries behind each route, keyed by a short description."""
+
+    newest = (Message.timestamp.desc(), Message.id.desc())
+
+    return {
+        'homepage (timeline store)':
+            timeline.entries_query(user_id).limit(21),
+        'homepage (follow-graph fallback)':
+            timeline.followed_messages(user_id).order_by(*newest).limit(21),
+        'users_show messages':
+            Message.query.filter(Message.user_id == user_id)
+                         .order_by(*newest).limit(21),
+        'liked-by-me check':
+            Likes.query.filter(Likes.user_id == user_id,
+                               Likes.message_id.in_([message_id])),
+        'likes_show':
+            Likes.query.filter(Likes.user_id == user_id)
+                       .order_by(Likes.id.desc()).limit(21),
+        'likes on a message':
+            Likes.query.filter(Likes.message_id == message_id),
+        'show_following':
+            db.session.query(Follows.user_being_followed_id)
+                      .filter(Follows.user_following_id == user_id),
+        'users_followers':
+            db.session.query(Follows.user_following_id)
+                      .filter(Follows.user_being_followed_id == user_id),
+        'is_following':
+            Follows.query.filter(Follows.user_following_id == user_id,
+                                 Follows.user_being_followed_id == user_id),
+    }
+
+
+def index_report():
+    """EXPLAIN each route query; returns [(route, indexes_used, plan)].
+
+    `indexes_used` lists the index names the plan mentions; an empty list
+    means the query scans a table.
+    """
+
+    user_id = db.session.query(db.func.max(User.id)).scalar() or 1
+    message_id = db.session.query(db.func.max(Message.id)).scalar() or 1
+
+    index_names = {index.name
+                   for table in db.metadata.tables.values()
+                   for index in table.indexes}
+    index_names |= {f"{table.name}_pkey" for table in db.metadata.tables.values()}
+
+    report = []
+    for route, query in route_queries(user_id, message_id).items():
+        plan = '\n'.join(str(row[-1]) for row in
+                         db.session.execute(Explain(query.statement)))
+        used = sorted(name for name in index_names if name in plan)
+        if 'PRIMARY KEY' in plan or 'sqlite_autoindex' in plan:
+            used.append('primary key')
+        report.append((route, used, plan))
+
+    return report
+
+
+##############################################################################
+# Command line
+
+cli = AppGroup('db', help='Schema migrations.')
+
+
+@cli.command('upgrade')
+@click.option('--to', 'target', type=int, help='Stop at this version.')
+def upgrade_command(target):
+    """Apply pending migrations."""
+
+    for version, name in upgrade(target):
+        click.echo(f"Applied {version:04d} {name}")
+
+
+@cli.command('status')
+def status_command():
+    """Show which migrations are applied."""
+
+    done = applied()
+    for version, name, module in available():
+        state = 'applied' if version in done else 'pending'
+        click.echo(f"{version:04d} {name:<40} {state}")
+
+
+@cli.command('explain')
+@click.option('--verbose', is_flag=True, help='Print the full plans.')
+def explain_command(verbose):
+    """Report which index each route's query plan uses."""
+
+    for route, used, plan in index_report():
+        click.echo(f"{route:<35} {', '.join(used) or 'NO INDEX (scan)'}")
+        if verbose:
+            click.echo('    ' + plan.replace('\n', '\n    '))
@@ -0,0 +1,28 @@
+"""Unique (user_id, message_id) on likes, plus lookup indexes.
+
+Drops duplicate and orphaned likes first so the unique index can be built.
+Runs outside a transaction so the indexes can be built without blocking
+writes; run it again if a like duplicated in the meantime fails the build.
+"""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+INDEXES = [
+    ('uq_likes_user_message', 'likes', '(user_id, message_id)', True),
+    ('ix_likes_message_id', 'likes', '(message_id)', False),
+    ('ix_messages_user_timestamp', 'messages', '(user_id, timestamp)', False),
+    ('ix_follows_following_followed', 'follows',
+     '(user_following_id, user_being_followed_id)', False),
+]
+
+
+def upgrade(conn):
+    conn.execute("DELETE FROM likes "
+                 "WHERE user_id IS NULL OR message_id IS NULL")
+    conn.execute("DELETE FROM likes WHERE id NOT IN ("
+                 "SELECT min(id) FROM likes GROUP BY user_id, message_id)")
+
+    for name, table, spec, unique in INDEXES:
+        create_index(conn, name, table, spec, unique=unique)
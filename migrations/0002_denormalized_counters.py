@@ -0,0 +1,39 @@
+"""Counter columns on users and messages, backfilled from the source tables.
+
+The backfill runs outside a transaction in batches of ids, so each UPDATE
+only locks its own batch of rows.
+"""
+
+from migrate import backfill, has_column
+
+TRANSACTIONAL = False
+
+COLUMNS = [
+    ('users', 'messages_count'),
+    ('users', 'following_count'),
+    ('users', 'followers_count'),
+    ('users', 'likes_count'),
+    ('messages', 'likes_count'),
+]
+
+
+def upgrade(conn):
+    for table, column in COLUMNS:
+        if not has_column(conn, table, column):
+            conn.execute(f"ALTER TABLE {table} "
+                         f"ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0")
+
+    backfill(conn, 'users', """
+          messages_count = (SELECT count(*) FROM messages
+                            WHERE messages.user_id = users.id),
+          following_count = (SELECT count(*) FROM follows
+                             WHERE follows.user_following_id = users.id),
+          followers_count = (SELECT count(*) FROM follows
+                             WHERE follows.user_being_followed_id = users.id),
+          likes_count = (SELECT count(*) FROM likes
+                         WHERE likes.user_id = users.id)
+    """)
+    backfill(conn, 'messages', """
+          likes_count = (SELECT count(*) FROM likes
+                         WHERE likes.message_id = messages.id)
+    """)
@@ -0,0 +1,26 @@
+"""Precomputed home timelines (timeline_entries)."""
+
+import sqlalchemy as sa
+
+metadata = sa.MetaData()
+
+timeline_entries = sa.Table(
+    'timeline_entries', metadata,
+    sa.Column('user_id', sa.Integer,
+              sa.ForeignKey('users.id', ondelete='cascade'), primary_key=True),
+    sa.Column('message_id', sa.Integer,
+              sa.ForeignKey('messages.id', ondelete='cascade'),
+              primary_key=True),
+    sa.Column('author_id', sa.Integer,
+              sa.ForeignKey('users.id', ondelete='cascade'), nullable=False),
+    sa.Column('timestamp', sa.DateTime, nullable=False),
+    sa.Index('ix_timeline_entries_user_timestamp', 'user_id', 'timestamp'),
+)
+
+# Only so the foreign keys above can resolve; never created here.
+sa.Table('users', metadata, sa.Column('id', sa.Integer, primary_key=True))
+sa.Table('messages', metadata, sa.Column('id', sa.Integer, primary_key=True))
+
+
+def upgrade(conn):
+    timeline_entries.create(conn, checkfirst=True)
@@ -0,0 +1,20 @@
+"""Trigram index for username search and full-text index for messages.
+
+PostgreSQL only; other databases have no equivalent and search falls back
+to scanning.
+"""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+
+    conn.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    create_index(conn, 'ix_users_username_trgm', 'users',
+                 'USING gin (username gin_trgm_ops)')
+    create_index(conn, 'ix_messages_text_fts', 'messages',
+                 "USING gin (to_tsvector('english'::regconfig, text))")
@@ -0,0 +1,22 @@
+"""Last-modified time on users, used to validate cached pages."""
+
+from migrate import backfill, has_column
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    if has_column(conn, 'users', 'updated_at'):
+        return
+
+    if conn.dialect.name == 'postgresql':
+        # CURRENT_TIMESTAMP isn't volatile, so existing rows take the value
+        # it had when the column was added: no rewrite, no backfill.
+        conn.execute("ALTER TABLE users ADD COLUMN updated_at TIMESTAMP "
+                     "NOT NULL DEFAULT CURRENT_TIMESTAMP")
+        return
+
+    # SQLite can't add a column with a non-constant default, so add it bare
+    # and backfill.
+    conn.execute("ALTER TABLE users ADD COLUMN updated_at TIMESTAMP")
+    backfill(conn, 'users', "updated_at = CURRENT_TIMESTAMP")
@@ -0,0 +1,28 @@
+"""Background job queue (jobs)."""
+
+import sqlalchemy as sa
+
+metadata = sa.MetaData()
+
+jobs = sa.Table(
+    'jobs', metadata,
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('name', sa.Text, nullable=False),
+    sa.Column('payload', sa.Text, nullable=False),
+    sa.Column('idempotency_key', sa.Text, unique=True),
+    sa.Column('status', sa.Text, nullable=False, server_default='queued'),
+    sa.Column('attempts', sa.Integer, nullable=False, server_default='0'),
+    sa.Column('max_attempts', sa.Integer, nullable=False),
+    sa.Column('run_at', sa.DateTime, nullable=False),
+    sa.Column('locked_by', sa.Text),
+    sa.Column('locked_at', sa.DateTime),
+    sa.Column('last_error', sa.Text),
+    sa.Column('created_at', sa.DateTime, nullable=False,
+              server_default=sa.func.current_timestamp()),
+    sa.Column('finished_at', sa.DateTime),
+    sa.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+)
+
+
+def upgrade(conn):
+    jobs.create(conn, checkfirst=True)
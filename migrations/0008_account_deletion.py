@@ -0,0 +1,14 @@
+"""Soft-deleted accounts (users.deleted_at), and an index for the
+timeline_entries cascade when messages are deleted."""
+
+from migrate import create_index, has_column
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    if not has_column(conn, 'users', 'deleted_at'):
+        conn.execute("ALTER TABLE users ADD COLUMN deleted_at TIMESTAMP")
+
+    create_index(conn, 'ix_timeline_entries_message_id', 'timeline_entries',
+                 '(message_id)')
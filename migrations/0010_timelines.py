@@ -0,0 +1,25 @@
+"""Record which home timelines are built (timelines), so an empty one
+counts as built rather than cold."""
+
+import sqlalchemy as sa
+
+metadata = sa.MetaData()
+
+timelines = sa.Table(
+    'timelines', metadata,
+    sa.Column('user_id', sa.Integer,
+              sa.ForeignKey('users.id', ondelete='cascade'), primary_key=True),
+    sa.Column('built_at', sa.DateTime, nullable=False),
+)
+
+# Only so the foreign key above can resolve; never created here.
+sa.Table('users', metadata, sa.Column('id', sa.Integer, primary_key=True))
+
+
+def upgrade(conn):
+    timelines.create(conn, checkfirst=True)
+
+    # Every timeline with entries was built.
+    conn.execute("INSERT INTO timelines (user_id, built_at) "
+                 "SELECT DISTINCT user_id, CURRENT_TIMESTAMP FROM timeline_entries "
+                 "WHERE user_id NOT IN (SELECT user_id FROM timelines)")
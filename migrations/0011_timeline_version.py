@@ -0,0 +1,10 @@
+"""Per-timeline version (timelines.version), bumped when a followed author
+edits their profile, so the home page ETag needn't look at every author."""
+
+from migrate import has_column
+
+
+def upgrade(conn):
+    if not has_column(conn, 'timelines', 'version'):
+        conn.execute("ALTER TABLE timelines "
+                     "ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
@@ -0,0 +1,19 @@
+"""Trigram GiST index for username search, replacing the GIN one.
+
+Besides serving ILIKE, a GiST index can return the usernames nearest a
+query first, so search only ranks a bounded set of candidates. PostgreSQL
+only, like 0004.
+"""
+
+from migrate import create_index
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+
+    create_index(conn, 'ix_users_username_trgm_gist', 'users',
+                 'USING gist (username gist_trgm_ops)')
+    conn.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_trgm")
@@ -0,0 +1 @@
+"""Versioned schema migrations for Warbler (applied by `migrate.py`)."""
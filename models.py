@@ -2,11 +2,15 @@
 
 from datetime import datetime
 
+from flask import g, has_app_context
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from passwords import PasswordPool
+from replicas import Database
+from writebehind import FOLLOW, write_buffer
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+password_pool = PasswordPool(bcrypt)
+db = Database()
 
 
 class Follows(db.Model):
@@ -26,6 +30,13 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with the followed user; this serves lookups
+    # by follower ("who does X follow?").
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -48,6 +59,145 @@ class Likes(db.Model):
 
     )
 
+    __table_args__ = (
+        db.Index('uq_likes_user_message', 'user_id', 'message_id',
+                 unique=True),
+        db.Index('ix_likes_message_id', 'message_id'),
+    )
+
+
+class TimelineEntry(db.Model):
+    """One message id on a user's precomputed home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_user_timestamp', 'user_id', 'timestamp'),
+        # Serves the cascade when a message is deleted.
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+
+class Timeline(db.Model):
+    """Marks a user's precomputed home timeline as built, even when empty."""
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    built_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # Bumped when someone on the timeline edits their profile.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+
+class Job(db.Model):
+    """A queued, running or finished background job. See `jobs`."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # JSON-encoded keyword arguments for the task.
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    idempotency_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+        server_default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_by = db.Column(db.Text)
+
+    locked_at = db.Column(db.DateTime)
+
+    last_error = db.Column(db.Text)
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.current_timestamp(),
+    )
+
+    finished_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,6 +244,47 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts, maintained by the routes via `counters`
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=db.func.current_timestamp(),
+    )
+
+    # Set when the account is deleted; the rows are removed later (see
+    # `accounts`).
+    deleted_at = db.Column(db.DateTime)
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -118,25 +309,67 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_use`?
+
+        Answered with an indexed EXISTS lookup on `follows` (never by
+        loading the relationship) and remembered for the rest of the request.
+        A follow or unfollow still in the write-behind buffer wins.
+        """
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        pending = write_buffer.state(FOLLOW, self.id, other_user.id)
+        if pending is not None:
+            return pending
+
+        cache = _follow_cache()
+        key = (self.id, other_user.id)
+
+        if key not in cache:
+            cache[key] = db.session.query(
+                Follows
+                .query
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id == other_user.id)
+                .exists()
+            ).scalar()
+
+        return cache[key]
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` is this user following? Returns a set.
+
+        Resolves a whole page of users in one query and primes the
+        per-request cache, so later `is_following` calls on those users are
+        free.
+        """
+
+        user_ids = set(user_ids)
+        if not user_ids:
+            return set()
+
+        followed = {followed_id for (followed_id,) in db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id,
+                            Follows.user_being_followed_id.in_(user_ids))}
+        followed = write_buffer.overlay(FOLLOW, self.id, user_ids, followed)
+
+        cache = _follow_cache()
+        for user_id in user_ids:
+            cache[(self.id, user_id)] = user_id in followed
+
+        return followed
 
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password and adds user to system. Raises PasswordPoolFull
+        if the hashing pool is saturated.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_pool.hash(password)
 
         user = User(
             username=username,
@@ -157,18 +390,79 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with an old work factor it is replaced
+        with a fresh one; the caller's commit saves it. Raises
+        PasswordPoolFull if the hashing pool is saturated.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = password_pool.check(user.password, password)
             if is_auth:
+                if password_pool.needs_rehash(user.password):
+                    user.password = password_pool.hash(password)
                 return user
 
         return False
 
 
+# Trigram index so `/users?q=` substring searches don't scan `users`
+# (PostgreSQL only; other databases fall back to a plain scan).
+db.event.listen(
+    User.__table__, 'before_create',
+    db.DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(
+        dialect='postgresql'))
+db.event.listen(
+    User.__table__, 'after_create',
+    db.DDL("CREATE INDEX ix_users_username_trgm_gist "
+           "ON users USING gist (username gist_trgm_ops)").execute_if(
+        dialect='postgresql'))
+
+
+def _follow_cache():
+    """Per-request {(follower_id, followed_id): bool} follow-state cache.
+
+    Outside a request (e.g. in a shell) nothing is cached.
+    """
+
+    if not has_app_context():
+        return {}
+
+    if 'follow_cache' not in g:
+        g.follow_cache = {}
+    return g.follow_cache
+
+
+@db.event.listens_for(User.following, 'append')
+def _remember_follow(user, followed_user, initiator):
+    """Keep the follow-state cache right when `user` follows someone."""
+
+    _follow_cache()[(user.id, followed_user.id)] = True
+
+
+@db.event.listens_for(User.following, 'remove')
+def _forget_follow(user, followed_user, initiator):
+    """Keep the follow-state cache right when `user` unfollows someone."""
+
+    _follow_cache()[(user.id, followed_user.id)] = False
+
+
+@db.event.listens_for(User.followers, 'append')
+def _remember_follower(user, follower, initiator):
+    """Keep the follow-state cache right when someone follows `user`."""
+
+    _follow_cache()[(follower.id, user.id)] = True
+
+
+@db.event.listens_for(User.followers, 'remove')
+def _forget_follower(user, follower, initiator):
+    """Keep the follow-state cache right when someone unfollows `user`."""
+
+    _follow_cache()[(follower.id, user.id)] = False
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -187,7 +481,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -196,9 +490,44 @@ class Message(db.Model):
         nullable=False,
     )
 
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp'),
+    )
+
     user = db.relationship('User')
     likes = db.relationship('Likes')
 
+    @classmethod
+    def with_author(cls):
+        """Query for messages that loads each author in the same SELECT.
+
+        Use this for any page that shows `msg.user`, otherwise every card
+        lazy-loads its author with a query of its own. Messages by deleted
+        accounts, still waiting to be purged, are left out.
+        """
+
+        return (cls
+                .query
+                .join(cls.user)
+                .filter(User.deleted_at.is_(None))
+                .options(db.contains_eager(cls.user)))
+
+
+# Full-text index for message search (PostgreSQL only). Being an
+# expression index, Postgres maintains it row by row on insert and delete.
+db.event.listen(
+    Message.__table__, 'after_create',
+    db.DDL("CREATE INDEX ix_messages_text_fts ON messages "
+           "USING gin (to_tsvector('english'::regconfig, text))").execute_if(
+        dialect='postgresql'))
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -208,3 +537,5 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    bcrypt.init_app(app)
+    password_pool.init_app(app)
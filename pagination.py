@@ -0,0 +1,89 @@
+"""Keyset (cursor) pagination for Warbler's message lists.
+
+Pages are keyed on `(timestamp, id)` rather than OFFSET, so fetching page
+1000 costs the same index seek as fetching page 1. A cursor is an opaque
+string naming the last row of the previous page; the next page is every
+row strictly older than it.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort, current_app, request
+
+from models import db
+
+DEFAULT_PER_PAGE = 20
+CURSOR_TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(timestamp, id):
+    """Make a cursor pointing at the row (`timestamp`, `id`)."""
+
+    return f"{timestamp.strftime(CURSOR_TIME_FORMAT)}-{id}"
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into a `(timestamp, id)` pair.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    timestamp, id = cursor.split('-')
+    return datetime.strptime(timestamp, CURSOR_TIME_FORMAT), int(id)
+
+
+def per_page():
+    """Configured number of messages per page."""
+
+    return current_app.config.get('MESSAGES_PER_PAGE', DEFAULT_PER_PAGE)
+
+
+def cursor_arg(name='before'):
+    """Read and decode a cursor from the querystring (400 if malformed)."""
+
+    cursor = request.args.get(name)
+    if not cursor:
+        return None
+
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        abort(400)
+
+
+def paginate(query, timestamp_col, id_col, before=None, limit=None):
+    """Return a `Page` of `query` ordered newest first by (timestamp, id).
+
+    `before` is a decoded cursor; only rows strictly older than it are
+    returned. One extra row is fetched to learn whether an older page exists.
+    """
+
+    limit = limit or per_page()
+    rows = keyset(query, timestamp_col, id_col, before).limit(limit + 1).all()
+
+    return page_of(rows, limit)
+
+
+def keyset(query, timestamp_col, id_col, before=None):
+    """`query` ordered newest first, starting strictly older than `before`."""
+
+    if before is not None:
+        query = query.filter(
+            db.tuple_(timestamp_col, id_col) < db.tuple_(*before))
+
+    return query.order_by(timestamp_col.desc(), id_col.desc())
+
+
+def page_of(rows, limit):
+    """Build a `Page` from up to `limit + 1` message rows."""
+
+    items = rows[:limit]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor(last.timestamp, last.id)
+
+    return Page(items, next_cursor)
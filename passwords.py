@@ -0,0 +1,100 @@
+"""Bounded worker pool for bcrypt password hashing and checking.
+
+bcrypt is deliberately slow (hundreds of milliseconds at the default work
+factor), so a burst of logins run inline can tie up every request worker
+at once. `PasswordPool` runs the hashing on a fixed number of threads
+(bcrypt releases the GIL, so they use real cores) and turns requests away
+with `PasswordPoolFull` once too many are already waiting, instead of
+letting the queue grow without bound.
+
+Configuration:
+
+- BCRYPT_LOG_ROUNDS: work factor for new hashes (default 12). Hashes made
+  with a different cost are transparently rehashed on the next login.
+- BCRYPT_WORKERS: hashing threads (default: number of CPUs).
+- BCRYPT_MAX_QUEUE: most hash/check jobs running or waiting at once
+  (default: 4 per worker).
+- BCRYPT_TIMEOUT: seconds a request waits for its job (default 10); one
+  that waits longer gets `PasswordPoolFull` too. Its job keeps its place
+  in the queue until it finishes.
+"""
+
+import os
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore
+
+DEFAULT_LOG_ROUNDS = 12
+
+
+class PasswordPoolFull(Exception):
+    """Too many password jobs are already queued, or ours took too long;
+    try again later."""
+
+
+class PasswordPool:
+    """Runs a Flask-Bcrypt instance's hash/check calls on a bounded pool."""
+
+    def __init__(self, bcrypt, workers=None, max_queue=None, timeout=10,
+                 rounds=DEFAULT_LOG_ROUNDS):
+        self.bcrypt = bcrypt
+        self.timeout = timeout
+        # Work factor for new hashes.
+        self.rounds = rounds
+        self._configure(workers or os.cpu_count() or 1, max_queue)
+
+    def _configure(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue or workers * 4
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='bcrypt')
+        self._slots = BoundedSemaphore(self.max_queue)
+
+    def init_app(self, app):
+        """Size the pool and set the work factor from `app`'s config."""
+
+        self._executor.shutdown(wait=False)
+        self._configure(app.config.get('BCRYPT_WORKERS') or os.cpu_count() or 1,
+                        app.config.get('BCRYPT_MAX_QUEUE'))
+        self.timeout = app.config.get('BCRYPT_TIMEOUT', self.timeout)
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result."""
+
+        slots = self._slots
+        if not slots.acquire(blocking=False):
+            raise PasswordPoolFull()
+
+        try:
+            future = self._executor.submit(fn, *args)
+        except Exception:
+            slots.release()
+            raise
+
+        # The slot is held until the job is done, not just until we stop
+        # waiting for it, so jobs we gave up on still count as queued.
+        future.add_done_callback(lambda _: slots.release())
+        try:
+            return future.result(self.timeout)
+        except futures.TimeoutError:
+            raise PasswordPoolFull() from None
+
+    def hash(self, password):
+        """bcrypt-hash `password` at the configured cost; returns a str."""
+
+        return self._run(self.bcrypt.generate_password_hash,
+                         password, self.rounds).decode('UTF-8')
+
+    def check(self, pw_hash, password):
+        """Does `password` match `pw_hash`?"""
+
+        return self._run(self.bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different cost than we use now?"""
+
+        try:
+            return int(pw_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
@@ -0,0 +1,65 @@
+"""Per-route SQL query budgets for Warbler.
+
+Every SQL statement run during a request is counted. A view can declare
+the most statements it should ever need with `@query_budget(n)`; when
+budgets are enforced (QUERY_BUDGETS_ENFORCED, on in the test suites) a
+request that goes over raises `QueryBudgetExceeded`, so an N+1 query
+sneaking into a template fails the tests instead of slowing down
+production.
+"""
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy.engine import Engine
+
+from models import db
+
+
+class QueryBudgetExceeded(Exception):
+    """A view ran more SQL statements than its declared budget."""
+
+
+def query_budget(max_queries):
+    """Declare that the decorated view runs at most `max_queries` statements."""
+
+    def decorator(view):
+        view.query_budget = max_queries
+        return view
+
+    return decorator
+
+
+def query_count():
+    """Number of SQL statements run so far in this request."""
+
+    return g.get('query_count', 0)
+
+
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    """Count a statement against the current request."""
+
+    if has_app_context():
+        g.query_count = query_count() + 1
+
+
+def _check_budget(response):
+    """Fail the request if its view went over budget."""
+
+    if not current_app.config.get('QUERY_BUDGETS_ENFORCED', current_app.testing):
+        return response
+
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+
+    if budget is not None and query_count() > budget:
+        raise QueryBudgetExceeded(
+            f"{request.endpoint} ran {query_count()} queries "
+            f"(budget {budget})")
+
+    return response
+
+
+def init_app(app):
+    """Check query budgets after every request to `app`."""
+
+    app.after_request(_check_budget)
@@ -0,0 +1,174 @@
+"""Read-replica routing for Warbler's database.
+
+`Database` is Flask-SQLAlchemy with a session that sends the SELECTs run
+while handling a GET (or HEAD) request to a read replica, and everything
+else (writes, flushes, other requests, CLI commands) to the primary.
+
+- SQLALCHEMY_REPLICA_URIS lists the replicas. Each request picks one at
+  random and reads from it throughout; with none configured everything
+  goes to the primary.
+- Once a request writes, the rest of its reads use the primary too.
+- After a POST (or any other non-GET request), that browser's reads go to
+  the primary for REPLICA_STICKY_SECONDS, so people see their own writes
+  however far the replicas lag.
+
+The primary's pool is set with DB_POOL_SIZE, DB_MAX_OVERFLOW and
+DB_POOL_PRE_PING, the replicas' with the same REPLICA_ settings.
+`pool_stats` reports each pool for /metrics.
+"""
+
+import random
+from collections import defaultdict
+from time import time
+
+from flask import current_app, g, has_request_context, request
+from flask import session as browser_session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.expression import SelectBase
+
+READ_METHODS = frozenset(['GET', 'HEAD'])
+
+# Session key holding the time until which reads go to the primary.
+STICKY_KEY = '_primary_until'
+
+DEFAULT_STICKY_SECONDS = 5
+
+
+def pool_options(app, prefix, url):
+    """create_engine() pool arguments from the `prefix`_ settings."""
+
+    options = {'pool_pre_ping': app.config.get(f'{prefix}_POOL_PRE_PING', True)}
+
+    # SQLite's pools are per thread and don't take a size.
+    if not url.drivername.startswith('sqlite'):
+        for setting, option in [('POOL_SIZE', 'pool_size'),
+                                ('MAX_OVERFLOW', 'max_overflow')]:
+            value = app.config.get(f'{prefix}_{setting}')
+            if value is not None:
+                options[option] = value
+
+    return options
+
+
+def _replica():
+    """The replica engine for this statement's request, or None."""
+
+    if not has_request_context() or request.method not in READ_METHODS:
+        return None
+
+    engines = current_app.extensions.get('replicas')
+    if not engines or g.get('db_wrote'):
+        return None
+
+    if browser_session.get(STICKY_KEY, 0) > time():
+        return None
+
+    if 'db_replica' not in g:
+        g.db_replica = random.choice(engines)
+    return g.db_replica
+
+
+class RoutingSession(SignallingSession):
+    """Session reading from a replica where `_replica()` allows it."""
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, SelectBase) and not self._flushing:
+            replica = _replica()
+            if replica is not None:
+                return replica
+
+        elif has_request_context():
+            g.db_wrote = True
+
+        return super().get_bind(mapper, clause)
+
+
+def _stick_to_primary(response):
+    """after_request: keep this browser on the primary after a write."""
+
+    if (request.method not in READ_METHODS
+            and current_app.extensions.get('replicas')):
+        browser_session[STICKY_KEY] = time() + current_app.config.get(
+            'REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+
+    return response
+
+
+class Database(SQLAlchemy):
+    """Flask-SQLAlchemy with replica routing and per-bind pool settings."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_checkouts = defaultdict(int)
+        self._watched = set()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        options.update(pool_options(app, 'DB', sa_url))
+        return super().apply_driver_hacks(app, sa_url, options)
+
+    def init_app(self, app):
+        super().init_app(app)
+        app.after_request(_stick_to_primary)
+        self.init_replicas(app)
+
+    def init_replicas(self, app):
+        """(Re)create the engines for `app`'s SQLALCHEMY_REPLICA_URIS."""
+
+        for engine in app.extensions.get('replicas', []):
+            engine.dispose()
+
+        engines = []
+        for uri in app.config.get('SQLALCHEMY_REPLICA_URIS') or []:
+            url = make_url(uri)
+            engines.append(create_engine(
+                url, echo=app.config.get('SQLALCHEMY_ECHO', False),
+                **pool_options(app, 'REPLICA', url)))
+        app.extensions['replicas'] = engines
+
+        for bind, engine in self.binds(app):
+            self._watch(bind, engine)
+
+    def binds(self, app):
+        """[(bind name, engine)] for the primary and each replica."""
+
+        return [('primary', self.get_engine(app))] + [
+            (f'replica{i}', engine)
+            for i, engine in enumerate(app.extensions.get('replicas', []))]
+
+    def _watch(self, bind, engine):
+        """Count `engine`'s pool checkouts under `bind`."""
+
+        if engine in self._watched:
+            return
+        self._watched.add(engine)
+
+        def checkout(dbapi_connection, record, proxy):
+            self.pool_checkouts[bind] += 1
+
+        event.listen(engine, 'checkout', checkout)
+
+    def pool_stats(self, app):
+        """[(bind, stats)] for the primary and each replica's pool.
+
+        Stats are the pool's size, idle (checked in) and checked out
+        connections and overflow where the pool keeps them, plus checkouts
+        so far.
+        """
+
+        stats = []
+        for bind, engine in self.binds(app):
+            pool = engine.pool
+            numbers = {'checkouts': self.pool_checkouts[bind]}
+            for name, method in [('size', 'size'), ('idle', 'checkedin'),
+                                 ('checked_out', 'checkedout'),
+                                 ('overflow', 'overflow')]:
+                if hasattr(pool, method):
+                    numbers[name] = getattr(pool, method)()
+            stats.append((bind, numbers))
+
+        return stats
@@ -0,0 +1,190 @@
+"""Search for Warbler.
+
+Username search is a case-insensitive substring match. On PostgreSQL it is
+served by a trigram GiST index on `users.username` (see `models.py`), so
+`ILIKE '%q%'` is an index scan rather than a sequential scan of `users`.
+Queries need at least USER_SEARCH_MIN_LENGTH characters (a trigram index
+can't narrow anything shorter). Results are ranked: exact match, then
+prefix matches, then everything else by trigram similarity (shortest
+username first elsewhere). Only the best USER_SEARCH_MAX_RESULTS matches
+are returned, paged by keyset on the last username shown.
+
+So that a common query doesn't rank every match on each page, PostgreSQL
+only ranks the USER_SEARCH_CANDIDATES matches most similar to the query,
+which the index returns nearest first. A prefix match that is far less
+similar than that many others (a long username) can be left out.
+
+Message search is full-text on PostgreSQL, backed by a GIN index over
+`to_tsvector('english', text)` and ranked by `ts_rank`. The index is an
+expression index, so Postgres updates it row by row as messages are added
+and deleted; it is never rebuilt. Other databases fall back to a substring
+match in id order.
+"""
+
+from collections import namedtuple
+
+from flask import current_app
+
+from models import db, Message, User
+import pagination
+
+TS_CONFIG = "'english'::regconfig"
+
+DEFAULT_USERS_PER_PAGE = 24
+DEFAULT_USER_SEARCH_MIN_LENGTH = 3
+DEFAULT_USER_SEARCH_MAX_RESULTS = 240
+DEFAULT_USER_SEARCH_CANDIDATES = 1000
+
+
+def users_per_page():
+    """Configured number of users per search page."""
+
+    return current_app.config.get('USERS_PER_PAGE', DEFAULT_USERS_PER_PAGE)
+
+
+def user_search_min_length():
+    """Shortest username query that is searched."""
+
+    return current_app.config.get('USER_SEARCH_MIN_LENGTH',
+                                  DEFAULT_USER_SEARCH_MIN_LENGTH)
+
+
+def _dialect():
+    """Name of the database dialect we're talking to."""
+
+    return db.engine.dialect.name
+
+
+def like_pattern(text):
+    """Escape LIKE wildcards in `text` so it matches literally."""
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def _rank_key(username, q):
+    """Sort key of `username` (a column or literal) for query `q`, best first."""
+
+    lowered = db.func.lower(username)
+    key = [db.case([(lowered == q, 0),
+                    (lowered.like(f"{like_pattern(q)}%", escape='\\'), 1)],
+                   else_=2)]
+    if _dialect() == 'postgresql':
+        key.append(-db.func.similarity(username, q))
+    return key + [db.func.length(username), username]
+
+
+def users_query(q, after=None):
+    """Query for users matching `q`, best match first.
+
+    `after` is the last username of the previous page. Returns None when
+    `q` is too short to search.
+    """
+
+    q = q.strip().lower()
+    if len(q) < user_search_min_length():
+        return None
+
+    matches = (db.session
+               .query(User.id)
+               .filter(User.deleted_at.is_(None))
+               .filter(User.username.ilike(f"%{like_pattern(q)}%", escape='\\')))
+    if _dialect() == 'postgresql':
+        nearest = (matches
+                   .order_by(User.username.op('<->')(q))
+                   .limit(current_app.config.get('USER_SEARCH_CANDIDATES',
+                                                 DEFAULT_USER_SEARCH_CANDIDATES)))
+        matches = db.session.query(User.id).filter(User.id.in_(nearest))
+
+    key = _rank_key(User.username, q)
+    best = (matches
+            .add_columns(*[column.label(f'key{i}') for i, column in enumerate(key)])
+            .order_by(*key)
+            .limit(current_app.config.get('USER_SEARCH_MAX_RESULTS',
+                                          DEFAULT_USER_SEARCH_MAX_RESULTS))
+            .subquery())
+    best_key = [best.c[f'key{i}'] for i in range(len(key))]
+
+    query = User.query.join(best, best.c.id == User.id)
+    if after is not None:
+        query = query.filter(db.tuple_(*best_key)
+                             > db.tuple_(*_rank_key(db.literal(after), q)))
+
+    return query.order_by(*best_key)
+
+
+MessageQuery = namedtuple('MessageQuery', ['text', 'author_id', 'since', 'until'])
+
+
+def encode_rank_cursor(rank, id):
+    """Make a cursor pointing at the search hit (`rank`, `id`)."""
+
+    return f"{rank!r}_{id}"
+
+
+def decode_rank_cursor(cursor):
+    """Turn a search cursor back into a `(rank, id)` pair.
+
+    Raises ValueError if the cursor is malformed.
+    """
+
+    rank, id = cursor.rsplit('_', 1)
+    return float(rank), int(id)
+
+
+def message_document():
+    """The tsvector expression the message full-text index is built on."""
+
+    return db.func.to_tsvector(db.literal_column(TS_CONFIG), Message.text)
+
+
+def search_messages(query, before=None, limit=None):
+    """Return a `pagination.Page` of messages matching `query`.
+
+    `query` is a `MessageQuery`; `author_id`, `since` and `until` narrow the
+    hits to one author and a [since, until) time range when given. Hits are
+    ordered best match first and `before` is a decoded `(rank, id)` cursor
+    from the previous page.
+    """
+
+    limit = limit or pagination.per_page()
+    messages = Message.with_author()
+
+    if _dialect() == 'postgresql':
+        tsquery = db.func.plainto_tsquery(db.literal_column(TS_CONFIG),
+                                          query.text)
+        # ts_rank is a float4; compared with the float8 cursor it would never
+        # equal the rank it came from, so ties would repeat across pages.
+        rank = db.cast(db.func.ts_rank(message_document(), tsquery),
+                       db.Float(precision=53))
+        messages = messages.filter(message_document().op('@@')(tsquery))
+    else:
+        rank = db.literal(0.0)
+        messages = messages.filter(
+            Message.text.ilike(f"%{like_pattern(query.text)}%", escape='\\'))
+
+    if query.author_id is not None:
+        messages = messages.filter(Message.user_id == query.author_id)
+    if query.since is not None:
+        messages = messages.filter(Message.timestamp >= query.since)
+    if query.until is not None:
+        messages = messages.filter(Message.timestamp < query.until)
+    if before is not None:
+        messages = messages.filter(
+            db.tuple_(rank, Message.id) < db.tuple_(*before))
+
+    rows = (messages
+            .add_columns(rank.label('rank'))
+            .order_by(db.desc('rank'), Message.id.desc())
+            .limit(limit + 1)
+            .all())
+
+    items = [message for message, rank in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        message, rank = rows[limit - 1]
+        next_cursor = encode_rank_cursor(rank, message.id)
+
+    return pagination.Page(items, next_cursor)
@@ -1,21 +1,14 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
-from csv import DictReader
-from app import app
-from models import User, Message, Follows, db
-
-with app.app_context():
-    db.drop_all()
-    db.create_all()
+Same as `flask seed`; see bulkload.py for the options.
+"""
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+from time import perf_counter
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
-
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+from app import app
+import bulkload
 
 with app.app_context():
-    db.session.commit()
+    started = perf_counter()
+    steps = bulkload.seed()
+    bulkload.report(steps, perf_counter() - started)
@@ -0,0 +1,21 @@
+// Toggle likes through the JSON endpoint instead of a full form post.
+$(document).on('submit', 'form[action$="/like"]', function (evt) {
+  evt.preventDefault();
+
+  var $form = $(this);
+  var $button = $form.find('button');
+  var url = '/api/v1' + $form.attr('action');
+
+  $button.prop('disabled', true);
+
+  $.post(url)
+    .done(function (state) {
+      $button.html(state.liked ? '<i class="fa fa-star"></i>' : 'like');
+    })
+    .fail(function () {
+      $form.get(0).submit();  // fall back to the plain form post
+    })
+    .always(function () {
+      $button.prop('disabled', false);
+    });
+});
@@ -0,0 +1,129 @@
+"""Streamed page rendering for Warbler's long pages.
+
+`render` sends a template as Jinja generates it, so the page head and
+layout reach the browser before the view's rows are fetched. The rows are
+passed in as a `RowStream`: the query runs only when the template's loop
+starts, and is read through a server-side cursor (`yield_per`) in
+batches, so each card is sent as its batch arrives and the whole list is
+never held in memory.
+
+Headers go out before the body, so anything the template does while
+streaming can't change them: flashed messages are popped from the session
+up front, and the SQL run while streaming isn't included in Server-Timing
+(/metrics does count it) or checked against the view's query budget.
+
+STREAM_TEMPLATES (on by default) turns streaming off, e.g. for debugging;
+the same views and templates then render in one piece.
+"""
+
+from flask import (Response, before_render_template, current_app,
+                   get_flashed_messages, render_template, stream_with_context,
+                   template_rendered)
+
+DEFAULT_BATCH_SIZE = 100
+
+# Template events per chunk sent; keeps chunks from being a few bytes each.
+BUFFER_SIZE = 40
+
+
+class RowStream:
+    """The rows of `query`, fetched while the template iterates over them.
+
+    `prime(batch)` runs on each batch of rows before they are used, to look
+    up per-viewer state (follows, likes) for the batch in one query. With
+    `limit`, at most `limit` rows are yielded, and after the loop
+    `has_more` says whether the query had more; `cursor(last_row)` then
+    gives `next_cursor`.
+    """
+
+    def __init__(self, query, limit=None, prime=None, cursor=None,
+                 batch_size=None):
+        self.query = query
+        self.limit = limit
+        self.prime = prime
+        self.cursor = cursor
+        self.batch_size = batch_size or current_app.config.get(
+            'STREAM_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+        self.has_more = False
+        self.last = None
+
+    def __iter__(self):
+        for batch in self._batches():
+            if self.prime is not None:
+                self.prime(batch)
+            for row in batch:
+                self.last = row
+                yield row
+
+    def _batches(self):
+        query, size = self.query, self.batch_size
+        if self.limit is not None:
+            query = query.limit(self.limit + 1)
+            size = min(size, self.limit + 1)
+
+        batch = []
+        for count, row in enumerate(query.yield_per(size), 1):
+            if self.limit is not None and count > self.limit:
+                self.has_more = True
+                break
+
+            batch.append(row)
+            if len(batch) == size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    @property
+    def next_cursor(self):
+        if self.has_more and self.cursor is not None:
+            return self.cursor(self.last)
+        return None
+
+
+class PageStream(RowStream):
+    """A `pagination.Page` from `fetch()`, called when the template iterates.
+
+    For pages whose rows have to be fetched in one go, this still defers
+    the fetch until the page head has been sent.
+    """
+
+    def __init__(self, fetch, prime=None):
+        super().__init__(None, prime=prime)
+        self.fetch = fetch
+        self._next_cursor = None
+
+    def _batches(self):
+        page = self.fetch()
+        self._next_cursor = page.next_cursor
+        if page.items:
+            yield page.items
+
+    @property
+    def next_cursor(self):
+        return self._next_cursor
+
+
+def render(template_name, **context):
+    """Render `template_name` as a streamed response (see the module doc)."""
+
+    app = current_app._get_current_object()
+    if not app.config.get('STREAM_TEMPLATES', True):
+        return render_template(template_name, **context)
+
+    # Pop the flashes now: the session cookie is sent before the template
+    # reads them. base.html then gets them from the request's cache.
+    get_flashed_messages(with_categories=True)
+
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)
+        stream = template.stream(context)
+        stream.enable_buffering(BUFFER_SIZE)
+        yield from stream
+        template_rendered.send(app, template=template, context=context)
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
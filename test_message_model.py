@@ -7,9 +7,16 @@
 
 from app import app
 import os
+import shutil
+import tempfile
 from unittest import TestCase
 
+import click
+from flask import Flask
+
 from models import db, User, Message, Follows, Likes
+import bulkload
+import migrate
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -166,3 +173,31 @@ class MessageModelTestCase(TestCase):
 
         # a message can only have one like per user.
         self.assertEqual(errors, 1)
+
+    def test_bulkload_rejects_duplicates(self):
+        """Does a bulk load with a duplicate like fail with a report?"""
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for table, lines in [
+                ('users', ["id,email,username,password", "1,a@test.com,a,x"]),
+                ('messages', ["id,text,timestamp,user_id",
+                              "1,hello,2020-01-01 00:00:00,1"]),
+                ('likes', ["user_id,message_id", "1,1", "1,1"])]:
+            with open(os.path.join(directory, f"{table}.csv"), 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+
+        # seed() drops everything, so load into a database of its own.
+        scratch = Flask(__name__)
+        scratch.config['SQLALCHEMY_DATABASE_URI'] = (
+            'sqlite:///' + os.path.join(directory, 'scratch.db'))
+        scratch.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(scratch)
+
+        with scratch.app_context():
+            with self.assertRaisesRegex(click.ClickException, "likes.csv has duplicate rows"):
+                bulkload.seed(directory)
+
+            with db.engine.connect() as conn:
+                self.assertTrue(migrate.has_table(conn, 'likes'))
+                self.assertEqual(conn.execute("SELECT count(*) FROM users").scalar(), 0)
@@ -6,10 +6,16 @@
 
 
 from app import app, CURR_USER_KEY
+import identity
+import metrics
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Follows, Job, Message, Timeline, TimelineEntry, User
+import jobs
+import search
+import timeline
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -32,6 +38,34 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request that runs more SQL than its route's query budget
+
+app.config['QUERY_BUDGETS_ENFORCED'] = True
+
+# Render pages in one piece, so every statement counts against the budget
+# (statements run while a page streams are sent after the check)
+
+app.config['STREAM_TEMPLATES'] = False
+
+# Run background jobs as they are queued
+
+app.config['JOBS_EAGER'] = True
+
+
+@jobs.task(name='tests.fail', max_attempts=2, concurrency=1)
+def fail():
+    raise ValueError("boom")
+
+
+countdown_runs = []
+
+
+@jobs.task(name='tests.countdown')
+def countdown(n):
+    countdown_runs.append(n)
+    if n:
+        jobs.enqueue(countdown, n=n - 1)
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -39,6 +73,11 @@ class MessageViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        identity.user_cache.clear()
+        Job.query.delete()
+        Timeline.query.delete()
+        TimelineEntry.query.delete()
+        Follows.query.delete()
         User.query.delete()
         Message.query.delete()
 
@@ -77,6 +116,123 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def test_job_queue(self):
+        """Is fan-out queued, and do workers run, retry, dedupe and limit jobs?"""
+
+        follower = User.signup("follower", "follower@test.com", "password", None)
+        db.session.commit()
+        author_id, follower_id = self.testuser.id, follower.id
+        db.session.add(Follows(user_being_followed_id=author_id,
+                               user_following_id=follower_id))
+        db.session.add(Message(text="Earlier", user_id=author_id))
+        db.session.commit()
+        with app.app_context():
+            timeline.rebuild(author_id)
+            timeline.rebuild(follower_id)
+            db.session.commit()
+
+        def on_timeline(user_id, message_id):
+            return TimelineEntry.query.filter_by(
+                user_id=user_id, message_id=message_id).count() == 1
+
+        app.config['JOBS_EAGER'] = False
+        app.config['JOB_WORKER_THREADS'] = 0
+        try:
+            c = app.test_client()
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+            c.post("/messages/new", data={"text": "Queued"})
+            msg_id = Message.query.filter_by(text="Queued").one().id
+
+            self.assertTrue(on_timeline(author_id, msg_id))
+            self.assertFalse(on_timeline(follower_id, msg_id))
+            self.assertEqual(Job.query.one().status, 'queued')
+
+            with app.app_context():
+                self.assertFalse(jobs.enqueue(timeline.fan_out_to_followers,
+                                              key=f'fan_out:{msg_id}',
+                                              message_id=msg_id))
+                db.session.commit()
+                self.assertEqual(jobs.work(burst=True), 1)
+
+            self.assertTrue(on_timeline(follower_id, msg_id))
+            self.assertEqual(Job.query.one().status, 'done')
+
+            with app.app_context():
+                jobs.enqueue(fail)
+                db.session.commit()
+                self.assertEqual(jobs.work(burst=True), 1)
+                job = Job.query.filter_by(name='tests.fail').one()
+                self.assertEqual((job.status, job.attempts, job.last_error),
+                                 ('queued', 1, 'ValueError: boom'))
+
+                job.run_at = datetime.utcnow()
+                db.session.commit()
+                self.assertEqual(jobs.work(burst=True), 1)
+                job = Job.query.filter_by(name='tests.fail').one()
+                self.assertEqual((job.status, job.attempts), ('failed', 2))
+
+                # At most one 'tests.fail' job runs at a time.
+                db.session.add(Job(name='tests.fail', payload='{}', max_attempts=2,
+                                   status='running', locked_by='elsewhere',
+                                   locked_at=datetime.utcnow()))
+                jobs.enqueue(fail)
+                db.session.commit()
+                self.assertEqual(jobs.work(burst=True), 0)
+        finally:
+            app.config['JOBS_EAGER'] = True
+            app.config['JOB_WORKER_THREADS'] = 2
+
+    def test_eager_jobs_loop(self):
+        """Do eager jobs queued by an eager job run after it, not inside it?"""
+
+        del countdown_runs[:]
+        with app.app_context():
+            jobs.enqueue(countdown, n=2000)
+        self.assertEqual(countdown_runs, list(range(2000, -1, -1)))
+
+    def test_fan_out_after_follow(self):
+        """Does a queued fan-out skip timelines a follow already filled?"""
+
+        late = User.signup("late", "late@test.com", "password", None)
+        early = User.signup("early", "early@test.com", "password", None)
+        db.session.commit()
+        author_id, late_id, early_id = self.testuser.id, late.id, early.id
+        db.session.add(Follows(user_being_followed_id=author_id,
+                               user_following_id=early_id))
+        db.session.add_all([Message(text="Earlier", user_id=author_id),
+                            Message(text="Mine", user_id=late_id)])
+        db.session.commit()
+        with app.app_context():
+            timeline.rebuild(late_id)
+            timeline.rebuild(early_id)
+            db.session.commit()
+
+        app.config['JOBS_EAGER'] = False
+        app.config['JOB_WORKER_THREADS'] = 0
+        try:
+            author = app.test_client()
+            with author.session_transaction() as sess:
+                sess[CURR_USER_KEY] = author_id
+            author.post("/messages/new", data={"text": "Queued"})
+            msg_id = Message.query.filter_by(text="Queued").one().id
+
+            follower = app.test_client()
+            with follower.session_transaction() as sess:
+                sess[CURR_USER_KEY] = late_id
+            follower.post(f"/users/follow/{author_id}")
+
+            with app.app_context():
+                self.assertEqual(jobs.work(burst=True), 1)
+        finally:
+            app.config['JOBS_EAGER'] = True
+            app.config['JOB_WORKER_THREADS'] = 2
+
+        self.assertEqual(Job.query.one().status, 'done')
+        for user_id in [late_id, early_id]:
+            self.assertEqual(TimelineEntry.query.filter_by(
+                user_id=user_id, message_id=msg_id).count(), 1)
+
     def test_show_message(self):
         """Can user see a single message?"""
 
@@ -216,3 +372,108 @@ class MessageViewTestCase(TestCase):
 
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Access unauthorized", str(resp.data))
+
+    def test_search_messages(self):
+        """Can user search messages by text, author and date?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            db.session.add_all([
+                Message(text="warbling about pancakes",
+                        user_id=self.testuser.id,
+                        timestamp=datetime(2021, 5, 1)),
+                Message(text="nothing to see here",
+                        user_id=self.testuser.id,
+                        timestamp=datetime(2021, 5, 2)),
+            ])
+            db.session.commit()
+
+            resp = c.get("/messages/search?q=pancakes")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("warbling about pancakes", html)
+            self.assertNotIn("nothing to see here", html)
+
+            resp = c.get("/messages/search?q=pancakes&author=testuser"
+                         "&since=2021-05-02")
+            self.assertNotIn("warbling about pancakes",
+                             resp.get_data(as_text=True))
+
+            resp = c.get("/messages/search?q=pancakes&until=2021-05-01")
+            self.assertIn("warbling about pancakes",
+                          resp.get_data(as_text=True))
+
+            resp = c.get("/messages/search?q=pancakes&since=yesterday")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_search_messages_ties(self):
+        """Are hits tied on rank paged through once each?
+
+        Every hit ties on PostgreSQL (same text) and elsewhere (no ranking).
+        """
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        self.addCleanup(app.config.pop, 'MESSAGES_PER_PAGE')
+
+        db.session.add_all([Message(text=f"pancakes {n}", user_id=self.testuser.id)
+                            for n in range(5)])
+        db.session.commit()
+
+        with app.test_request_context():
+            query = search.MessageQuery("pancakes", None, None, None)
+            seen, before = [], None
+            for _ in range(5):
+                page = search.search_messages(query, before)
+                seen.extend(message.id for message in page.items)
+                if page.next_cursor is None:
+                    break
+                before = search.decode_rank_cursor(page.next_cursor)
+
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+    def test_timing_and_metrics(self):
+        """Do responses carry Server-Timing, and does /metrics count them?"""
+
+        metrics.registry.reset()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            msg = Message(text="test message", user_id=self.testuser.id)
+            db.session.add(msg)
+            db.session.commit()
+
+            resp = c.get(f'/messages/{msg.id}')
+            timing = resp.headers['Server-Timing']
+            self.assertIn('db;dur=', timing)
+            self.assertIn('tpl;dur=', timing)
+            self.assertIn('total;dur=', timing)
+
+            resp = c.get('/metrics')
+            text = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('warbler_requests_total{route="messages_show",'
+                          'method="GET",status="200"} 1', text)
+            self.assertIn('warbler_request_duration_seconds_bucket'
+                          '{route="messages_show",le="+Inf"} 1', text)
+            self.assertIn('warbler_queries_total{route="messages_show"}', text)
+
+    def test_streamed_metrics(self):
+        """Does /metrics count the queries a streamed page runs as it streams?"""
+
+        metrics.registry.reset()
+        app.config['STREAM_TEMPLATES'] = True
+        self.addCleanup(app.config.__setitem__, 'STREAM_TEMPLATES', False)
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.testuser.id
+        resp = client.get('/')
+        resp.get_data()
+        resp.close()
+        up_front = int(resp.headers['Server-Timing'].split('desc="')[1].split()[0])
+
+        self.assertGreater(metrics.registry.queries['homepage'], up_front)
@@ -7,9 +7,16 @@
 
 from app import app
 import os
+import shutil
+import tempfile
+from threading import Event
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from flask import Flask
+
+from models import db, bcrypt, password_pool, User, Message, Follows
+import migrate
+from passwords import PasswordPool, PasswordPoolFull
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -212,3 +219,105 @@ class UserModelTestCase(TestCase):
             "testuser1", "WRONG_PASSWORD"), False)
         self.assertEqual(User.authenticate("", "WRONG_PASSWORD"), False)
         self.assertEqual(User.authenticate("testuser1", ""), False)
+
+    def test_following_ids_among(self):
+        """Does the bulk follow lookup resolve a page of users at once?"""
+
+        users = [User(email=f"test{n}@test.com",
+                      username=f"testuser{n}",
+                      password="HASHED_PASSWORD") for n in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        main = users[0]
+        db.session.add_all([
+            Follows(user_being_followed_id=users[1].id,
+                    user_following_id=main.id),
+            Follows(user_being_followed_id=users[3].id,
+                    user_following_id=main.id),
+        ])
+        db.session.commit()
+
+        with app.test_request_context():
+            self.assertEqual(
+                main.following_ids_among(user.id for user in users),
+                {users[1].id, users[3].id})
+            self.assertTrue(main.is_following(users[3]))
+            self.assertFalse(main.is_following(users[2]))
+            self.assertTrue(users[1].is_followed_by(main))
+            self.assertEqual(main.following_ids_among([]), set())
+
+    def test_authenticate_rehashes_old_cost(self):
+        """Is a password hashed at an old work factor upgraded on login?"""
+
+        old_rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.addCleanup(password_pool.init_app, app)
+        self.addCleanup(app.config.__setitem__, 'BCRYPT_LOG_ROUNDS', old_rounds)
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        password_pool.init_app(app)
+        user = User.signup("testuser1", "test1@test.com", "password", None)
+        db.session.commit()
+        self.assertIn("$04$", user.password)
+
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        password_pool.init_app(app)
+        self.assertEqual(User.authenticate("testuser1", "password"), user)
+        self.assertIn("$05$", user.password)
+        self.assertEqual(User.authenticate("testuser1", "password"), user)
+
+    def test_password_pool_full(self):
+        """Does a saturated hashing pool turn new work away?"""
+
+        pool = PasswordPool(bcrypt, workers=1, max_queue=1)
+        pool._slots.acquire()
+
+        with self.assertRaises(PasswordPoolFull):
+            pool.hash("password")
+
+    def test_password_pool_timeout(self):
+        """Does a job that runs too long time out, yet keep its slot until done?"""
+
+        pool = PasswordPool(bcrypt, workers=1, max_queue=1, timeout=0.01)
+        finish = Event()
+
+        with self.assertRaises(PasswordPoolFull):
+            pool._run(finish.wait)
+        self.assertFalse(pool._slots.acquire(blocking=False))
+
+        finish.set()
+        pool._executor.shutdown(wait=True)
+        self.assertTrue(pool._slots.acquire(blocking=False))
+
+    def test_migrations_on_empty_database(self):
+        """Do the migrations bring an empty database to the latest version,
+        and can each one run again over an up-to-date schema?"""
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        empty = Flask(__name__)
+        empty.config['SQLALCHEMY_DATABASE_URI'] = (
+            'sqlite:///' + os.path.join(directory, 'empty.db'))
+        empty.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+        db.init_app(empty)
+
+        versions = [version for version, name, module in migrate.available()]
+        with empty.app_context():
+            self.assertEqual([version for version, name in migrate.upgrade()],
+                             versions)
+            self.assertEqual(max(migrate.applied()), versions[-1])
+            self.assertEqual(migrate.upgrade(), [])
+
+            users = User.__table__
+            with db.engine.begin() as conn:
+                conn.execute(users.insert().values(
+                    email="test@test.com", username="testuser",
+                    password="HASHED_PASSWORD", messages_count=5))
+                conn.execute(migrate.schema_migrations.delete())
+
+            self.assertEqual([version for version, name in migrate.upgrade()],
+                             versions)
+            self.assertEqual(max(migrate.applied()), versions[-1])
+            with db.engine.connect() as conn:
+                self.assertEqual(conn.execute(
+                    db.select([users.c.messages_count])).scalar(), 0)
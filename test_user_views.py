@@ -6,10 +6,26 @@
 
 
 from app import app, CURR_USER_KEY
+import identity
+from flask import g
+import fcntl
 import os
+import shutil
+import tempfile
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, connect_db, Message, User, Likes
+from models import (db, bcrypt, connect_db, Job, Message, User, Likes, Follows,
+                    Timeline, TimelineEntry)
+import timeline
+import pagination
+import counters
+import search
+import loader
+import querybudget
+import fragments
+import jobs
+from writebehind import LIKE, FOLLOW, WriteBuffer, write_buffer
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -32,6 +48,19 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Fail any request that runs more SQL than its route's query budget
+
+app.config['QUERY_BUDGETS_ENFORCED'] = True
+
+# Render pages in one piece, so every statement counts against the budget
+# (statements run while a page streams are sent after the check)
+
+app.config['STREAM_TEMPLATES'] = False
+
+# Run background jobs as they are queued
+
+app.config['JOBS_EAGER'] = True
+
 
 class UserViewTestCase(TestCase):
     """Test views for users."""
@@ -39,6 +68,12 @@ class UserViewTestCase(TestCase):
     def setUp(self):
         """Create test client, add sample data."""
 
+        identity.user_cache.clear()
+        Job.query.delete()
+        Timeline.query.delete()
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
         User.query.delete()
         Message.query.delete()
 
@@ -289,6 +324,253 @@ class UserViewTestCase(TestCase):
 
             self.assertEqual(len(likes), 0)
 
+    def test_toggle_like_json(self):
+        """Does the JSON endpoint toggle a like and report the new count?"""
+
+        with self.client as c:
+            resp = c.post("/api/v1/messages/1000/like")
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+            m = Message(id=1000, user_id=self.user1_id, text="hello")
+            db.session.add(m)
+            db.session.commit()
+
+            resp = c.post("/api/v1/messages/1000/like")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(), {"liked": True, "likes_count": 1})
+            self.assertEqual(User.query.get(self.mainuser_id).likes_count, 1)
+
+            resp = c.post("/api/v1/messages/1000/like")
+            self.assertEqual(resp.get_json(), {"liked": False, "likes_count": 0})
+            self.assertEqual(Likes.query.filter(
+                Likes.user_id == self.mainuser_id).count(), 0)
+
+            resp = c.post("/api/v1/messages/9999/like")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_json_api(self):
+        """Do the JSON read endpoints serve lean, paginated rows?"""
+
+        msg1_id, msg2_id = self.msg1.id, self.msg2.id
+
+        with self.client as c:
+            resp = c.get("/api/v1/timeline")
+            self.assertEqual(resp.status_code, 401)
+            self.assertEqual(resp.get_json(), {"error": "Access unauthorized."})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+            db.session.add_all([
+                Follows(user_following_id=self.mainuser_id,
+                        user_being_followed_id=self.user1_id),
+                Follows(user_following_id=self.mainuser_id,
+                        user_being_followed_id=self.user2_id),
+                Follows(user_following_id=self.user3_id,
+                        user_being_followed_id=self.mainuser_id),
+                Likes(user_id=self.mainuser_id, message_id=msg1_id),
+            ])
+            db.session.commit()
+
+            resp = c.get("/api/v1/timeline?limit=2")
+            self.assertEqual(resp.status_code, 200)
+            page = resp.get_json()
+            self.assertEqual([m["text"] for m in page["items"]],
+                             ["I am user number 2", "I am user number 1"])
+            self.assertEqual(page["items"][1]["user"]["username"], "testuser1")
+            self.assertTrue(page["items"][1]["liked"])
+
+            resp = c.get("/api/v1/timeline",
+                         query_string={"before": page["next_cursor"], "limit": 2})
+            page = resp.get_json()
+            self.assertEqual([m["text"] for m in page["items"]],
+                             ["I am the main user"])
+            self.assertIsNone(page["next_cursor"])
+
+            resp = c.get(f"/api/v1/users/{self.user1_id}")
+            self.assertEqual(resp.get_json()["username"], "testuser1")
+            self.assertTrue(resp.get_json()["following"])
+
+            resp = c.get(f"/api/v1/users/{self.mainuser_id}/following?limit=1")
+            page = resp.get_json()
+            self.assertEqual([u["username"] for u in page["items"]], ["testuser2"])
+            resp = c.get(f"/api/v1/users/{self.mainuser_id}/following",
+                         query_string={"before": page["next_cursor"]})
+            self.assertEqual([u["username"] for u in resp.get_json()["items"]],
+                             ["testuser1"])
+
+            resp = c.get(f"/api/v1/users/{self.mainuser_id}/followers")
+            self.assertEqual(resp.get_json()["items"][0]["username"], "testuser3")
+            self.assertFalse(resp.get_json()["items"][0]["following"])
+
+            resp = c.get(f"/api/v1/users/{self.mainuser_id}/likes")
+            self.assertEqual([m["id"] for m in resp.get_json()["items"]],
+                             [msg1_id])
+
+            resp = c.get(f"/api/v1/users/{self.user4_id}/messages")
+            self.assertEqual(resp.get_json()["items"][0]["text"],
+                             "I am user number 4")
+
+            resp = c.get(f"/api/v1/messages/{msg2_id}")
+            self.assertEqual(resp.get_json()["text"], "I am user number 2")
+            self.assertFalse(resp.get_json()["liked"])
+
+            self.assertEqual(c.get("/api/v1/messages/9999").status_code, 404)
+            self.assertEqual(c.get("/api/v1/users/9999/likes").status_code, 404)
+            self.assertEqual(c.get("/api/v1/timeline?before=junk").status_code, 400)
+
+    def test_streamed_pages(self):
+        """Do the long pages stream, with follow state fetched per batch?"""
+
+        db.session.add_all([
+            Follows(user_following_id=uid, user_being_followed_id=self.user4_id)
+            for uid in [self.mainuser_id, self.user1_id, self.user2_id,
+                        self.user3_id]])
+        db.session.add(Follows(user_following_id=self.mainuser_id,
+                               user_being_followed_id=self.user2_id))
+        db.session.commit()
+
+        app.config['STREAM_TEMPLATES'] = True
+        app.config['STREAM_BATCH_SIZE'] = 2
+        app.config['USERS_PER_PAGE'] = 3
+        try:
+            c = app.test_client()
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+
+            resp = c.get(f"/users/{self.user4_id}/followers")
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+            for username in ["mainuser", "testuser1", "testuser2", "testuser3"]:
+                self.assertIn(f"@{username}", html)
+            self.assertIn(f'action="/users/stop-following/{self.user2_id}"', html)
+            self.assertIn(f'action="/users/follow/{self.user3_id}"', html)
+
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("@testuser2", html)
+            self.assertNotIn("@testuser3", html)
+            self.assertIn(f"after={self.user2_id}", html)
+            html = c.get(f"/users?after={self.user2_id}").get_data(as_text=True)
+            self.assertIn("@testuser3", html)
+            self.assertNotIn("@testuser2", html)
+
+            html = c.get("/users?q=nobody").get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+        finally:
+            app.config['STREAM_TEMPLATES'] = False
+            app.config['STREAM_BATCH_SIZE'] = 100
+            app.config['USERS_PER_PAGE'] = 24
+
+    def test_replica_routing(self):
+        """Do GET reads use the replica, until the browser POSTs something?"""
+
+        replica_path = os.path.join(tempfile.gettempdir(), 'warbler-test-replica.db')
+        app.config['SQLALCHEMY_REPLICA_URIS'] = [f'sqlite:///{replica_path}']
+        db.init_replicas(app)
+        try:
+            replica = app.extensions['replicas'][0]
+            db.metadata.drop_all(replica)
+            db.metadata.create_all(replica)
+            with replica.begin() as conn:
+                conn.execute(User.__table__.insert(),
+                             {'id': 1, 'username': 'replicaonly',
+                              'email': 'replica@test.com', 'password': 'x'})
+
+            c = app.test_client()
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("replicaonly", html)
+            self.assertNotIn("testuser1", html)
+
+            c.post(f"/users/follow/{self.user1_id}")
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("testuser1", html)
+            self.assertNotIn("replicaonly", html)
+
+            app.config['REPLICA_STICKY_SECONDS'] = 0
+            c.post(f"/users/follow/{self.user1_id}")
+            html = c.get("/users").get_data(as_text=True)
+            self.assertIn("replicaonly", html)
+
+            metrics = c.get("/metrics").get_data(as_text=True)
+            self.assertIn('warbler_db_pool_checkouts_total{bind="primary"}', metrics)
+            self.assertIn('warbler_db_pool_checkouts_total{bind="replica0"}', metrics)
+        finally:
+            app.config['SQLALCHEMY_REPLICA_URIS'] = []
+            app.config['REPLICA_STICKY_SECONDS'] = 5
+            db.init_replicas(app)
+            os.remove(replica_path)
+
+    def test_write_behind(self):
+        """Are buffered likes and follows seen at once, then written in bulk?"""
+
+        m = Message(id=1000, user_id=self.user1_id, text="hello")
+        db.session.add(m)
+        db.session.commit()
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        journal = os.path.join(directory, 'writes')
+        write_buffer.configure(True, max_delay=3600, durability='journal',
+                               journal_path=journal)
+        try:
+            c = app.test_client()
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+
+            resp = c.post("/api/v1/messages/1000/like")
+            self.assertEqual(resp.get_json(), {"liked": True, "likes_count": 1})
+            c.post(f"/users/follow/{self.user2_id}")
+
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(Follows.query.filter(
+                Follows.user_following_id == self.mainuser_id).count(), 0)
+            self.assertIn("fa-star", c.get("/messages/1000").get_data(as_text=True))
+            self.assertIn("Unfollow", c.get(
+                f"/users/{self.user2_id}").get_data(as_text=True))
+
+            # Unliking and liking again leaves one pending like.
+            resp = c.post("/api/v1/messages/1000/like")
+            self.assertEqual(resp.get_json(), {"liked": False, "likes_count": 0})
+            c.post("/api/v1/messages/1000/like")
+
+            # Each process journals to a file of its own
+            own = f'{journal}.{os.getpid()}'
+            self.assertEqual(len(open(own).readlines()), 4)
+
+            # Another process's journal is replayed once that process is
+            # gone, and left alone while it lives
+            other = os.path.join(directory, 'other')
+            shutil.copy(own, f'{other}.1')
+            open(f'{other}.1.lock', 'w').close()
+            shutil.copy(own, f'{other}.2')
+            live = open(f'{other}.2.lock', 'w')
+            self.addCleanup(live.close)
+            fcntl.flock(live, fcntl.LOCK_EX)
+
+            replayed = WriteBuffer()
+            replayed.configure(True, durability='journal', journal_path=other)
+            self.assertTrue(replayed.state(LIKE, self.mainuser_id, 1000))
+            self.assertTrue(replayed.state(FOLLOW, self.mainuser_id, self.user2_id))
+            self.assertFalse(os.path.exists(f'{other}.1'))
+            self.assertFalse(os.path.exists(f'{other}.1.lock'))
+            self.assertTrue(os.path.exists(f'{other}.2'))
+            self.assertEqual(len(open(f'{other}.{os.getpid()}').readlines()), 2)
+            replayed.configure(False)
+
+            with app.app_context():
+                self.assertEqual(write_buffer.flush(), 2)
+
+            self.assertEqual(Likes.query.count(), 1)
+            self.assertEqual(Message.query.get(1000).likes_count, 1)
+            mainuser = User.query.get(self.mainuser_id)
+            self.assertEqual(mainuser.likes_count, 1)
+            self.assertEqual(mainuser.following_count, 1)
+            self.assertTrue(mainuser.is_following(User.query.get(self.user2_id)))
+            self.assertIsNone(write_buffer.version(self.mainuser_id))
+        finally:
+            write_buffer.configure(False)
+
     def test_like_show(self):
         """Test that user can veiw all liked messages"""
 
@@ -318,3 +600,423 @@ class UserViewTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertIn("hello", html)
             self.assertIn("huzzah", html)
+
+    def test_homepage_timeline(self):
+        """Does the homepage warm the timeline and pick up new messages?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+
+            # First visit builds the timeline from the follow graph
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("I am user number 1", html)
+            self.assertNotIn("I am user number 2", html)
+            self.assertTrue(timeline.is_warm_timeline(self.mainuser_id))
+
+            # A new message from a followed user is fanned out to main
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            c.post("/messages/new", data={"text": "fresh warble"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("fresh warble", html)
+
+            # Unfollowing drops the precomputed timeline
+            c.post(f"/users/stop-following/{self.user1_id}")
+            self.assertFalse(timeline.is_warm_timeline(self.mainuser_id))
+
+            # An empty timeline is built once, not on every visit
+            quiet = User(username="quiet", email="quiet@test.com", password="testing")
+            db.session.add(quiet)
+            db.session.commit()
+            quiet_id = quiet.id
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = quiet_id
+            c.get("/")
+            built_at = Timeline.query.get(quiet_id).built_at
+            etag = c.get("/").headers['ETag']
+            self.assertEqual(c.get("/", headers={'If-None-Match': etag}).status_code, 304)
+            self.assertEqual(Timeline.query.get(quiet_id).built_at, built_at)
+            self.assertEqual(TimelineEntry.query.filter_by(user_id=quiet_id).count(), 0)
+
+    def test_timeline_built_twice(self):
+        """Is building an already-built timeline a no-op, as when two first
+        visits race or a lagging replica shows a built timeline as cold?"""
+
+        db.session.add(Follows(user_being_followed_id=self.user1_id,
+                               user_following_id=self.mainuser_id))
+        db.session.commit()
+
+        with app.app_context():
+            self.assertTrue(timeline._build(self.mainuser_id))
+            self.assertFalse(timeline._build(self.mainuser_id))
+            db.session.commit()
+
+            self.assertEqual(
+                TimelineEntry.query.filter_by(user_id=self.mainuser_id).count(),
+                Message.query.filter(Message.user_id.in_(
+                    [self.mainuser_id, self.user1_id])).count())
+
+    def test_show_user_pagination(self):
+        """Are a user's messages paged with a 'load older' cursor?"""
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        self.addCleanup(app.config.pop, 'MESSAGES_PER_PAGE')
+
+        for n in range(3):
+            db.session.add(Message(text=f'paged warble {n}',
+                                   user_id=self.user1_id,
+                                   timestamp=datetime(2020, 1, n + 1)))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+
+            html = c.get(f"/users/{self.user1_id}").get_data(as_text=True)
+            self.assertIn("I am user number 1", html)
+            self.assertIn("paged warble 2", html)
+            self.assertNotIn("paged warble 1", html)
+
+            cursor = pagination.encode_cursor(datetime(2020, 1, 3), 0)
+            self.assertIn("load-older", html)
+
+            resp = c.get(f"/users/{self.user1_id}?before={cursor}")
+            html = resp.get_data(as_text=True)
+            self.assertIn("paged warble 1", html)
+            self.assertIn("paged warble 0", html)
+            self.assertNotIn("paged warble 2", html)
+            self.assertNotIn("load-older", html)
+
+            resp = c.get(f"/users/{self.user1_id}?before=garbage")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_conditional_get(self):
+        """Is an unchanged profile answered with 304, and static cached?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+
+            resp = c.get(f"/users/{self.user1_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['Cache-Control'], 'private, no-cache')
+            etag = resp.headers['ETag']
+
+            resp = c.get(f"/users/{self.user1_id}",
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            # Following user1 bumps both users, so the page changes
+            c.post(f"/users/follow/{self.user1_id}")
+            resp = c.get(f"/users/{self.user1_id}",
+                         headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+            # The home page changes when a followed author edits their
+            # profile, but not when their counters do
+            c.get("/")
+            etag = c.get("/").headers['ETag']
+            self.assertEqual(c.get("/", headers={'If-None-Match': etag}).status_code, 304)
+            User.query.get(self.user1_id).likes_count += 1
+            db.session.commit()
+            self.assertEqual(c.get("/", headers={'If-None-Match': etag}).status_code, 304)
+
+            author = app.test_client()
+            with author.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            User.query.get(self.user1_id).password = (
+                bcrypt.generate_password_hash("testing").decode())
+            db.session.commit()
+            author.post("/users/profile", data={
+                "username": "renamed1", "email": "1test@test.com",
+                "bio": "hello", "password": "testing"})
+            resp = c.get("/", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("renamed1", resp.get_data(as_text=True))
+
+            html = c.get("/").get_data(as_text=True)
+            self.assertIn("/static/stylesheets/style.css?v=", html)
+            url = html.split('href="/static/stylesheets/style.css')[1].split('"')[0]
+            resp = c.get(f"/static/stylesheets/style.css{url}")
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+
+            resp = c.get("/users/follow/nobody")
+            self.assertEqual(resp.headers['Cache-Control'], 'no-store')
+
+    def test_counters(self):
+        """Do the routes keep the denormalized counters in step?"""
+
+        msg1_id = self.msg1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+
+            c.post(f"/users/follow/{self.user1_id}")
+            c.post(f"/users/follow/{self.user2_id}")
+            c.post(f"/users/stop-following/{self.user2_id}")
+            c.post("/messages/new", data={"text": "counted"})
+            c.post(f"/messages/{msg1_id}/like")
+
+            main = User.query.get(self.mainuser_id)
+            user1 = User.query.get(self.user1_id)
+            self.assertEqual(main.following_count, 1)
+            self.assertEqual(user1.followers_count, 1)
+            self.assertEqual(main.messages_count, 1)
+            self.assertEqual(main.likes_count, 1)
+            self.assertEqual(Message.query.get(msg1_id).likes_count, 1)
+
+            # Deleting the liked message takes the like with it
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            c.post(f"/messages/{msg1_id}/delete")
+            self.assertEqual(User.query.get(self.mainuser_id).likes_count, 0)
+
+            # repair recomputes from the source tables
+            User.query.update({User.followers_count: 42})
+            db.session.commit()
+            counters.repair()
+            self.assertEqual(User.query.get(self.user1_id).followers_count, 1)
+            self.assertEqual(User.query.get(self.user2_id).followers_count, 0)
+
+    def test_delete_user(self):
+        """Is a deleted account hidden at once and cleaned up in batches?"""
+
+        msg0_id, msg1_id = self.msg0.id, self.msg1.id
+
+        main = app.test_client()
+        with main.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.mainuser_id
+        main.post(f"/users/follow/{self.user1_id}")
+        main.post(f"/messages/{msg1_id}/like")
+
+        other = app.test_client()
+        with other.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user2_id
+        other.post(f"/users/follow/{self.mainuser_id}")
+        other.post(f"/messages/{msg0_id}/like")
+        self.assertIn("I am the main user", other.get("/").get_data(as_text=True))
+
+        app.config['JOBS_EAGER'] = False
+        app.config['JOB_WORKER_THREADS'] = 0
+        app.config['ACCOUNT_PURGE_BATCH_SIZE'] = 1
+        try:
+            resp = main.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+            self.assertIsNotNone(User.query.get(self.mainuser_id).deleted_at)
+            self.assertEqual(other.get(f"/users/{self.mainuser_id}").status_code, 404)
+            self.assertNotIn("mainuser", other.get("/users").get_data(as_text=True))
+            self.assertEqual(Job.query.count(), 1)
+
+            # Their messages are gone from every page before the purge runs
+            for url in ["/", "/messages/search?q=main", f"/users/{self.user2_id}/likes"]:
+                self.assertNotIn("I am the main user",
+                                 other.get(url).get_data(as_text=True))
+            self.assertEqual(other.get(f"/messages/{msg0_id}").status_code, 404)
+            self.assertEqual(other.get(f"/api/v1/messages/{msg0_id}").status_code, 404)
+            self.assertEqual(other.post(f"/messages/{msg0_id}/like").status_code, 404)
+            self.assertEqual(Message.query.get(msg0_id).likes_count, 1)
+
+            # And they are gone from follow lists both ways
+            for url in [f"/users/{self.user2_id}/following",
+                        f"/users/{self.user1_id}/followers"]:
+                self.assertNotIn("mainuser", other.get(url).get_data(as_text=True))
+                self.assertEqual(other.get("/api/v1" + url).get_json()['items'], [])
+
+            with app.app_context():
+                # One batch per job: a like of their message, their message,
+                # their like, each follow, then the account itself.
+                self.assertEqual(jobs.work(burst=True), 6)
+        finally:
+            app.config['JOBS_EAGER'] = True
+            app.config['JOB_WORKER_THREADS'] = 2
+            app.config['ACCOUNT_PURGE_BATCH_SIZE'] = 1000
+
+        self.assertIsNone(User.query.get(self.mainuser_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.mainuser_id).count(), 0)
+        self.assertEqual(Message.query.get(msg1_id).likes_count, 0)
+        self.assertEqual(User.query.get(self.user1_id).followers_count, 0)
+        user2 = User.query.get(self.user2_id)
+        self.assertEqual((user2.following_count, user2.likes_count), (0, 0))
+
+    def test_search_users_ranked(self):
+        """Are search results ranked and paginated?"""
+
+        db.session.add(User(username="xtestuser1x",
+                            email="x@test.com", password="testing"))
+        db.session.commit()
+
+        def usernames(q, after=None):
+            with app.app_context():
+                return [u.username for u in search.users_query(q, after)]
+
+        self.assertEqual(usernames("TESTUSER1"), ["testuser1", "xtestuser1x"])
+
+        # Pages continue after the last username shown
+        self.assertEqual(usernames("testuser"),
+                         ["testuser1", "testuser2", "testuser3", "testuser4",
+                          "xtestuser1x"])
+        self.assertEqual(usernames("testuser", after="testuser2"),
+                         ["testuser3", "testuser4", "xtestuser1x"])
+
+        # LIKE wildcards in the query are matched literally
+        self.assertEqual(usernames("%%%"), [])
+
+        # Short queries aren't searched, and results are capped
+        with app.app_context():
+            self.assertIsNone(search.users_query("te"))
+        app.config['USER_SEARCH_MAX_RESULTS'] = 2
+        try:
+            self.assertEqual(usernames("testuser"), ["testuser1", "testuser2"])
+        finally:
+            app.config['USER_SEARCH_MAX_RESULTS'] = 240
+
+        app.config['USERS_PER_PAGE'] = 2
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.mainuser_id
+
+                html = c.get("/users?q=testuser").get_data(as_text=True)
+                self.assertIn("after=testuser2", html)
+                html = c.get("/users?q=testuser&after=testuser2").get_data(as_text=True)
+                self.assertIn("@testuser3", html)
+                self.assertNotIn("@testuser2", html)
+
+                html = c.get("/users?q=te").get_data(as_text=True)
+                self.assertIn("at least 3 characters", html)
+                self.assertEqual(c.get("/users?after=x").status_code, 400)
+        finally:
+            app.config['USERS_PER_PAGE'] = 24
+
+    def test_homepage_query_budget(self):
+        """Does the homepage query count stay flat as the timeline grows?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+
+            for user_id in [self.user1_id, self.user2_id, self.user3_id]:
+                c.post(f"/users/follow/{user_id}")
+                for n in range(5):
+                    db.session.add(Message(text=f"budget {n}", user_id=user_id))
+            db.session.commit()
+
+            # Cold (rebuilds the timeline) and warm reads both fit the budget
+            self.assertEqual(c.get("/").status_code, 200)
+            self.assertEqual(c.get("/").status_code, 200)
+
+            # A route that goes over budget fails loudly
+            app.view_functions['homepage'].query_budget = 1
+            self.addCleanup(setattr, app.view_functions['homepage'],
+                            'query_budget', 10)
+            self.assertEqual(c.get("/").status_code, 500)
+
+    def test_likes_show_paginated(self):
+        """Are liked messages shown newest like first, a page at a time?"""
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        self.addCleanup(app.config.pop, 'MESSAGES_PER_PAGE')
+
+        msg_ids = [msg.id for msg in [self.msg3, self.msg1, self.msg2]]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+
+            for msg_id in msg_ids:
+                c.post(f"/messages/{msg_id}/like")
+
+            html = c.get(f"/users/{self.mainuser_id}/likes").get_data(as_text=True)
+            self.assertLess(html.index("I am user number 2"),
+                            html.index("I am user number 1"))
+            self.assertNotIn("I am user number 3", html)
+
+            first_like = Likes.query.filter_by(message_id=msg_ids[1]).one()
+            self.assertIn(f"likes?before={first_like.id}", html)
+
+            html = c.get(f"/users/{self.mainuser_id}/likes"
+                         f"?before={first_like.id}").get_data(as_text=True)
+            self.assertIn("I am user number 3", html)
+            self.assertNotIn("I am user number 1", html)
+            self.assertNotIn("load-older", html)
+
+    def test_batch_loader(self):
+        """Does the loader fetch ids in one query and keep their order?"""
+
+        ids = [self.msg2.id, self.msg0.id, 999999, self.msg2.id]
+
+        with app.test_request_context():
+            messages = loader.message_loader().load_many(ids)
+            self.assertEqual([msg.id for msg in messages],
+                             [self.msg2.id, self.msg0.id, self.msg2.id])
+            self.assertIs(loader.message_loader().load(self.msg0.id),
+                          messages[1])
+            self.assertIsNone(loader.message_loader().load(999999))
+
+    def test_message_card_cache(self):
+        """Are cards reused across viewers and redrawn after a profile edit?"""
+
+        fragments.card_cache.clear()
+        user1 = User.query.get(self.user1_id)
+
+        with app.test_request_context():
+            first = fragments.message_card(self.msg1)
+            self.assertIn("I am user number 1", first)
+            self.assertEqual(fragments.message_card(self.msg1), first)
+            self.assertEqual(fragments.card_cache.hits, 1)
+
+            user1.username = "renamed"
+            db.session.commit()
+            self.assertIn("@renamed", fragments.message_card(self.msg1))
+            self.assertEqual(fragments.card_cache.misses, 2)
+
+            fragments.card_cache.invalidate_author(self.user1_id)
+            fragments.message_card(self.msg1)
+            self.assertEqual(fragments.card_cache.misses, 3)
+
+        # The like button stays per-viewer, outside the cached card
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+            c.post(f"/messages/{self.msg1.id}/like")
+            html = c.get(f"/users/{self.user1_id}").get_data(as_text=True)
+            self.assertIn('<i class="fa fa-star">', html)
+
+    def test_current_user_lazy_and_cached(self):
+        """Is g.user only loaded when used, and then served from cache?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.mainuser_id
+
+            # Logging out never looks at g.user, so runs no queries at all
+            c.get("/logout")
+            self.assertNotIn('user', g)
+            self.assertEqual(querybudget.query_count(), 0)
+
+        with app.test_request_context():
+            user = identity.user_cache.load(self.mainuser_id)
+            before = querybudget.query_count()
+            self.assertEqual(identity.user_cache.load(self.mainuser_id), user)
+            self.assertEqual(querybudget.query_count(), before)
+
+            User.query.filter_by(id=self.mainuser_id).update(
+                {User.username: "renamed"})
+            db.session.commit()
+            identity.user_cache.invalidate(self.mainuser_id)
+
+        with app.test_request_context():
+            self.assertEqual(
+                identity.user_cache.load(self.mainuser_id).username, "renamed")
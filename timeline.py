@@ -0,0 +1,343 @@
+"""Precomputed home timelines for Warbler (fan-out-on-write).
+
+Every user's home timeline is stored as a bounded list of message ids in
+the `timeline_entries` table, newest first. New messages are pushed onto
+the timelines of the author and their followers when they are posted
+(the author's at once, the followers' by a background job), so the
+homepage reads a ready-made page with one index seek instead of
+rebuilding it from the follow graph on every hit.
+
+A timeline is "warm" once `rebuild` has built it, which it records in
+`timelines` (so a user with nothing to show isn't rebuilt on every visit),
+and "cold" again after `invalidate`. `page` rebuilds a cold timeline
+before reading it. Only warm timelines receive fan-out, so a cold
+timeline never holds a partial list.
+"""
+
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.dialects import postgresql
+
+from models import db, Follows, Message, Timeline, TimelineEntry
+import jobs
+import pagination
+
+DEFAULT_TIMELINE_SIZE = 800
+
+
+def timeline_size():
+    """Maximum number of entries kept on each user's timeline."""
+
+    return current_app.config.get('TIMELINE_SIZE', DEFAULT_TIMELINE_SIZE)
+
+
+def read(user_id, limit, before=None, messages=None):
+    """Return up to `limit` newest messages from `user_id`'s timeline.
+
+    `before` is a decoded pagination cursor. An empty list means the
+    timeline is cold, empty or exhausted.
+    """
+
+    return entries_query(user_id, before, messages).limit(limit).all()
+
+
+def _messages(messages):
+    """The base message query: `messages`, or messages with their authors."""
+
+    return Message.with_author() if messages is None else messages
+
+
+def entries_query(user_id, before=None, messages=None):
+    """Query for `user_id`'s timeline messages, newest first.
+
+    `messages` is the query to select them with, e.g. a column-only query
+    for callers that don't need ORM objects; it defaults to
+    `Message.with_author()`.
+    """
+
+    query = (_messages(messages)
+             .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+             .filter(TimelineEntry.user_id == user_id))
+
+    if before is not None:
+        query = query.filter(db.tuple_(TimelineEntry.timestamp,
+                                       TimelineEntry.message_id)
+                             < db.tuple_(*before))
+
+    return query.order_by(TimelineEntry.timestamp.desc(),
+                          TimelineEntry.message_id.desc())
+
+
+def followed_messages(user_id, messages=None):
+    """Query for messages by `user_id` and everyone they follow."""
+
+    followed_ids = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+
+    return _messages(messages).filter(
+        db.or_(Message.user_id.in_(followed_ids), Message.user_id == user_id))
+
+
+def page(user_id, before=None, limit=None, messages=None):
+    """Return a `pagination.Page` of `user_id`'s home timeline.
+
+    Served from the precomputed timeline when it holds a full page. A cold
+    timeline is rebuilt from the follow graph first, and an empty warm one
+    has nothing to show; a short read from a warm one means the page runs
+    past its oldest entry, so that page is built from the follow graph
+    instead. `messages` is passed on to `entries_query`.
+    """
+
+    limit = limit or pagination.per_page()
+
+    rows = read(user_id, limit + 1, before, messages)
+    if len(rows) > limit:
+        return pagination.page_of(rows, limit)
+
+    if not rows and before is None:
+        if is_warm_timeline(user_id):
+            return pagination.page_of(rows, limit)
+        # Cold (at least on the replica we read), so there is nothing to
+        # invalidate first. Building writes, so the re-read below comes from
+        # the primary even if another request built it first.
+        _build(user_id)
+        db.session.commit()
+        return pagination.page_of(read(user_id, limit + 1, messages=messages),
+                                  limit)
+
+    return pagination.paginate(followed_messages(user_id, messages),
+                               Message.timestamp, Message.id,
+                               before=before, limit=limit)
+
+
+def _entries_from(user_id, messages_query):
+    """INSERT ... SELECT copying `messages_query` onto `user_id`'s timeline."""
+
+    rows = (messages_query
+            .with_entities(db.literal(user_id),
+                           Message.id,
+                           Message.user_id,
+                           Message.timestamp)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(timeline_size()))
+
+    return TimelineEntry.__table__.insert().from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'], rows.statement)
+
+
+def rebuild(user_id):
+    """Fill `user_id`'s timeline from the follow graph (warms a cold timeline)."""
+
+    invalidate(user_id)
+    _build(user_id)
+
+
+def _build(user_id):
+    """Mark `user_id`'s cold timeline built and fill it.
+
+    Does nothing, and returns False, if it is already built. The check is
+    the INSERT into `timelines` itself, made on the primary: a concurrent
+    build's uncommitted row makes it wait for that transaction, then skip.
+    """
+
+    if not _claim(user_id):
+        return False
+
+    db.session.execute(_entries_from(user_id, followed_messages(user_id)))
+    return True
+
+
+def _claim(user_id):
+    """INSERT `user_id`'s `timelines` row unless it exists; True if inserted."""
+
+    timelines = Timeline.__table__
+    values = {'user_id': user_id, 'built_at': datetime.utcnow()}
+
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        statement = postgresql.insert(timelines).values(**values).on_conflict_do_nothing(
+            index_elements=['user_id'])
+    elif dialect == 'sqlite':
+        statement = timelines.insert().values(**values).prefix_with('OR IGNORE')
+    else:
+        statement = timelines.insert().values(**values)
+
+    return db.session.execute(statement).rowcount != 0
+
+
+def invalidate(user_id):
+    """Drop `user_id`'s timeline; it is rebuilt on their next homepage hit."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user_id)
+     .delete(synchronize_session=False))
+    (Timeline
+     .query
+     .filter(Timeline.user_id == user_id)
+     .delete(synchronize_session=False))
+
+
+def post(message):
+    """Put a newly-flushed `message` on its author's timeline now, and queue
+    pushing it onto their followers' timelines.
+    """
+
+    push_to_author(message)
+    jobs.enqueue(fan_out_to_followers, key=f'fan_out:{message.id}',
+                 message_id=message.id)
+
+
+@jobs.task(concurrency=4)
+def fan_out_to_followers(message_id):
+    """Job: push message `message_id` onto its author's followers' timelines."""
+
+    message = Message.query.get(message_id)
+    if message is not None:
+        push_to_followers(message)
+
+
+def push_to_followers(message):
+    """Push `message` onto its author's followers' timelines.
+
+    Only timelines that are already warm are touched, and ones that already
+    have the message are skipped: this runs as a job, so a follow or a
+    rebuild in the meantime may have put it there.
+    """
+
+    entries = TimelineEntry.__table__
+    is_warm = db.exists().where(
+        Timeline.__table__.c.user_id == Follows.user_following_id)
+    has_message = db.exists().where(
+        db.and_(entries.c.user_id == Follows.user_following_id,
+                entries.c.message_id == message.id))
+
+    followers = (db.select([Follows.user_following_id,
+                            db.literal(message.id),
+                            db.literal(message.user_id),
+                            db.literal(message.timestamp)])
+                 .where(Follows.user_being_followed_id == message.user_id)
+                 .where(is_warm)
+                 .where(~has_message))
+
+    db.session.execute(entries.insert().from_select(
+        ['user_id', 'message_id', 'author_id', 'timestamp'], followers))
+
+    trim(db.session
+         .query(Follows.user_following_id)
+         .filter(Follows.user_being_followed_id == message.user_id))
+
+
+def push_to_author(message):
+    """Push `message` onto its author's timeline, if warm."""
+
+    if is_warm_timeline(message.user_id):
+        db.session.add(TimelineEntry(user_id=message.user_id,
+                                     message_id=message.id,
+                                     author_id=message.user_id,
+                                     timestamp=message.timestamp))
+        db.session.flush()
+        trim([message.user_id])
+
+
+def follow(follower_id, followed_id):
+    """Merge `followed_id`'s recent messages into `follower_id`'s timeline."""
+
+    if not is_warm_timeline(follower_id):
+        return
+
+    db.session.execute(_entries_from(
+        follower_id, Message.query.filter(Message.user_id == followed_id)))
+    trim([follower_id])
+
+
+def unfollow(follower_id, followed_id):
+    """Remove `followed_id` from `follower_id`'s timeline.
+
+    Deleting only that author's entries could leave a truncated timeline
+    that no longer holds the newest messages of everyone else, so the whole
+    timeline is dropped and rebuilt lazily instead.
+    """
+
+    invalidate(follower_id)
+
+
+def is_warm_timeline(user_id):
+    """Does `user_id` have a precomputed timeline?"""
+
+    return db.session.query(
+        Timeline.query.filter(Timeline.user_id == user_id).exists()
+    ).scalar()
+
+
+def version(user_id):
+    """(built at, version, entries, newest message id) of `user_id`'s
+    timeline, or None if cold.
+
+    Changes whenever the timeline is rebuilt or a message is added to or
+    removed from it, and whenever someone `user_id` follows edits their
+    profile (`author_changed`), so it can validate a cached home page.
+    """
+
+    def stored(column):
+        return (db.select([column])
+                .where(Timeline.user_id == user_id)
+                .as_scalar())
+
+    built, changes, entries, newest = (db.session
+                                       .query(stored(Timeline.built_at),
+                                              stored(Timeline.version),
+                                              db.func.count(),
+                                              db.func.max(TimelineEntry.message_id))
+                                       .filter(TimelineEntry.user_id == user_id)
+                                       .one())
+    return (built, changes, entries, newest) if built else None
+
+
+def author_changed(user_id):
+    """Bump the version of `user_id`'s followers' timelines.
+
+    Their cards show `user_id`'s name and picture, so call this (in the
+    same transaction) when those change.
+    """
+
+    (Timeline
+     .query
+     .filter(Timeline.user_id.in_(db.session
+                                  .query(Follows.user_following_id)
+                                  .filter(Follows.user_being_followed_id == user_id)))
+     .update({Timeline.version: Timeline.version + 1},
+             synchronize_session=False))
+
+
+def trim(user_ids=None):
+    """Cap timelines at `timeline_size()` entries, dropping the oldest.
+
+    `user_ids` may be a list or a subquery; when omitted every timeline is
+    trimmed.
+    """
+
+    rank = (db.func
+            .row_number()
+            .over(partition_by=TimelineEntry.user_id,
+                  order_by=(TimelineEntry.timestamp.desc(),
+                            TimelineEntry.message_id.desc()))
+            .label('rank'))
+
+    ranked = db.session.query(TimelineEntry.user_id,
+                              TimelineEntry.message_id,
+                              rank)
+    if user_ids is not None:
+        ranked = ranked.filter(TimelineEntry.user_id.in_(user_ids))
+    ranked = ranked.subquery()
+
+    overflow = (db.select([ranked.c.user_id, ranked.c.message_id])
+                .where(ranked.c.rank > timeline_size()))
+
+    (TimelineEntry
+     .query
+     .filter(db.tuple_(TimelineEntry.user_id,
+                       TimelineEntry.message_id).in_(overflow))
+     .delete(synchronize_session=False))
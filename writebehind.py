@@ -0,0 +1,507 @@
+"""Write-behind buffering for likes and follows.
+
+With WRITE_BEHIND on, a like or follow toggle doesn't write to the
+database. It records the new (user, target) state in `write_buffer` and
+returns. Toggling the same pair again before the buffer is written
+replaces the earlier state, and a pair toggled back to what the database
+holds drops out of the buffer altogether. A background thread writes the
+buffer every WRITE_BEHIND_MAX_DELAY seconds, and sooner once
+WRITE_BEHIND_MAX_PENDING pairs are waiting. Each kind of change is written
+by a handler (`likes.apply_buffered`, `follows.apply_buffered`) that
+applies a batch with a few multi-row statements in one transaction,
+instead of one transaction per click.
+
+Until a change is written, reads in this process see it. `state`,
+`overlay` and `net` put the buffered state over what the database says.
+The like buttons, follow buttons and like counts use them, and `version`
+keeps cached pages from hiding the change. Read-your-writes only holds
+within the one process, though: a user whose next request lands on
+another worker doesn't see the change until it is written (within
+WRITE_BEHIND_MAX_DELAY seconds), and neither do stored counters on
+profiles.
+
+WRITE_BEHIND_DURABILITY sets what a crash can lose:
+
+- 'memory': up to WRITE_BEHIND_MAX_DELAY seconds of toggles.
+- 'journal': nothing a process crash can lose. Each toggle is appended to
+  the process's journal, which another process replays after a crash.
+- 'fsync': as 'journal', but each append is fsynced, so the toggles also
+  survive a machine crash.
+
+WRITE_BEHIND_JOURNAL is a path prefix: each process journals to
+WRITE_BEHIND_JOURNAL.<pid>, opened when it first uses the buffer (so
+workers forked from a preloaded app each get their own), and holds a lock
+on WRITE_BEHIND_JOURNAL.<pid>.lock while it lives. When a process opens
+its journal it takes over the journals of processes that are gone (their
+locks are free), replaying their toggles into its own buffer. A process
+that exits cleanly with nothing left to write removes its files.
+
+This module doesn't touch the models, so `models` can import it.
+"""
+
+import atexit
+import fcntl
+import glob
+import os
+import uuid
+from collections import defaultdict
+from itertools import count
+from threading import Event, Lock, Thread
+
+from flask import current_app
+from sqlalchemy import and_, or_
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+DURABILITY_LEVELS = ('memory', 'journal', 'fsync')
+
+DEFAULT_MAX_PENDING = 1000
+DEFAULT_MAX_DELAY = 0.5
+
+# Changes per handler call. Each call is one transaction; this also keeps
+# statements under SQLite's bound-parameter limit.
+BATCH_SIZE = 400
+
+
+def pair_filter(left, right, pairs):
+    """SQL condition matching rows whose (`left`, `right`) is in `pairs`."""
+
+    grouped = defaultdict(list)
+    for a, b in pairs:
+        grouped[a].append(b)
+
+    return or_(*[and_(left == a, right.in_(bs)) for a, bs in grouped.items()])
+
+
+class WriteBuffer:
+    """Pending (kind, user id, target id) -> state changes.
+
+    Each entry holds the state the database is taken to have (None when
+    unknown, after a journal replay), the state to write, and a sequence
+    number.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.max_pending = DEFAULT_MAX_PENDING
+        self.max_delay = DEFAULT_MAX_DELAY
+        self.durability = 'memory'
+        self.journal_path = None
+        self.app = None
+
+        self._handlers = {}
+        self._pending = {}
+        self._flushing = {}
+        self._user_seq = {}
+        self._seq = count(1)
+        self._token = uuid.uuid4().hex[:8]
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._wake = Event()
+        self._thread = None
+        self._journal = None
+        self._journal_lock = None
+        self._path = None
+
+    def init_app(self, app):
+        self.app = app
+        self.configure(
+            enabled=app.config.get('WRITE_BEHIND', False),
+            max_pending=app.config.get('WRITE_BEHIND_MAX_PENDING', DEFAULT_MAX_PENDING),
+            max_delay=app.config.get('WRITE_BEHIND_MAX_DELAY', DEFAULT_MAX_DELAY),
+            durability=app.config.get('WRITE_BEHIND_DURABILITY', 'memory'),
+            journal_path=app.config.get('WRITE_BEHIND_JOURNAL'))
+
+    def configure(self, enabled, max_pending=DEFAULT_MAX_PENDING,
+                  max_delay=DEFAULT_MAX_DELAY, durability='memory',
+                  journal_path=None):
+        """(Re)configure the buffer.
+
+        With journaling, this process's journal is opened (and dead
+        processes' replayed) when the buffer is first used.
+        """
+
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"WRITE_BEHIND_DURABILITY must be one of "
+                             f"{', '.join(DURABILITY_LEVELS)}, not {durability!r}")
+        if enabled and durability != 'memory' and not journal_path:
+            raise ValueError(f"WRITE_BEHIND_DURABILITY={durability!r} "
+                             f"needs WRITE_BEHIND_JOURNAL")
+
+        with self._lock:
+            self._close_journal()
+
+            self.enabled = enabled
+            self.max_pending = max_pending
+            self.max_delay = max_delay
+            self.durability = durability
+            self.journal_path = journal_path
+
+    def register(self, kind, handler):
+        """Have `handler(changes)` write `kind` changes.
+
+        `changes` is a list of (user id, target id, state); the handler
+        writes them and commits.
+        """
+
+        self._handlers[kind] = handler
+
+    ##########################################################################
+    # Recording changes
+
+    def toggle(self, kind, user_id, target_id, stored):
+        """Flip the pair's state and return the new one.
+
+        `stored()` reads the state from the database; it is only called
+        when nothing is buffered for the pair.
+        """
+
+        return self._record(kind, user_id, target_id, lambda state: not state,
+                            stored)
+
+    def put(self, kind, user_id, target_id, state, stored):
+        """Set the pair's state (see `toggle`)."""
+
+        return self._record(kind, user_id, target_id, lambda _: state, stored)
+
+    def _record(self, kind, user_id, target_id, change, stored):
+        self._open_journal()
+        key = (kind, user_id, target_id)
+
+        original = None
+        if self.state(kind, user_id, target_id) is None:
+            original = bool(stored())
+
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is not None:
+                original, current = entry[0], entry[1]
+            elif key in self._flushing:
+                # Being written right now; that write is what we build on.
+                original = current = self._flushing[key][1]
+            else:
+                if original is None:
+                    # Written between our look and taking the lock.
+                    original = bool(stored())
+                current = original
+
+            state = bool(change(current))
+            seq = next(self._seq)
+            self._user_seq[user_id] = seq
+            if state == original:
+                self._pending.pop(key, None)
+            else:
+                self._pending[key] = (original, state, seq)
+
+            self._log(kind, user_id, target_id, state)
+            waiting = len(self._pending)
+
+        self._schedule(waiting)
+        return state
+
+    def _schedule(self, waiting):
+        """Start the flusher if needed, and flush early when the buffer fills."""
+
+        self._start_flusher()
+
+        if waiting >= 2 * self.max_pending:
+            # The flusher has fallen behind; write from this thread too.
+            self.flush()
+        elif waiting >= self.max_pending:
+            self._wake.set()
+
+    ##########################################################################
+    # Reading through the buffer
+
+    def _start_flusher(self):
+        if self._thread is None and self.app is not None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, daemon=True,
+                                          name='write-behind')
+                    self._thread.start()
+                    atexit.register(self._flush_at_exit)
+
+    def _entry(self, key):
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._flushing.get(key)
+        return entry
+
+    def state(self, kind, user_id, target_id):
+        """The buffered state of the pair, or None if nothing is buffered."""
+
+        self._open_journal()
+        if not self._pending and not self._flushing:
+            return None
+
+        entry = self._entry((kind, user_id, target_id))
+        return None if entry is None else entry[1]
+
+    def overlay(self, kind, user_id, target_ids, stored):
+        """`stored`, the set of `target_ids` on in the database, as buffered."""
+
+        self._open_journal()
+        if not self._pending and not self._flushing:
+            return stored
+
+        result = set(stored)
+        for target_id in target_ids:
+            entry = self._entry((kind, user_id, target_id))
+            if entry is not None:
+                if entry[1]:
+                    result.add(target_id)
+                else:
+                    result.discard(target_id)
+        return result
+
+    def net(self, kind, target_id):
+        """How much buffered changes will move `target_id`'s count by.
+
+        Briefly counts a batch twice after it commits, until `flush` lets
+        go of it.
+        """
+
+        self._open_journal()
+        with self._lock:
+            entries = [entry for entries in (self._flushing, self._pending)
+                       for key, entry in entries.items()
+                       if key[0] == kind and key[2] == target_id]
+
+        return sum(int(state) - int(original)
+                   for original, state, _ in entries if original is not None)
+
+    def version(self, user_id):
+        """A token that changes with each buffered change by `user_id`.
+
+        None when `user_id` has nothing buffered; for cache validators.
+        """
+
+        seq = self._user_seq.get(user_id)
+        return None if seq is None else f'{self._token}:{seq}'
+
+    ##########################################################################
+    # Writing
+
+    def flush(self):
+        """Write everything buffered; returns the number of changes written.
+
+        Needs an app context. A batch whose handler fails goes back into
+        the buffer, to be retried on the next flush.
+        """
+
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    self._user_seq.clear()
+                    return 0
+                batch, self._pending = self._pending, {}
+                self._flushing = batch
+                self._rotate_journal()
+
+            by_kind = defaultdict(list)
+            for (kind, user_id, target_id), (_, state, _) in batch.items():
+                by_kind[kind].append((user_id, target_id, state))
+
+            written, failed = 0, {}
+            for kind, changes in by_kind.items():
+                for start in range(0, len(changes), BATCH_SIZE):
+                    chunk = changes[start:start + BATCH_SIZE]
+                    try:
+                        self._handlers[kind](chunk)
+                        written += len(chunk)
+                    except Exception:
+                        current_app.logger.exception(
+                            "Writing %d buffered %s changes failed", len(chunk), kind)
+                        for user_id, target_id, _ in chunk:
+                            key = (kind, user_id, target_id)
+                            failed[key] = batch[key]
+
+            with self._lock:
+                self._flushing = {}
+                self._restore(failed)
+                waiting = {user_id for (_, user_id, _) in self._pending}
+                self._user_seq = {user_id: seq for user_id, seq
+                                  in self._user_seq.items() if user_id in waiting}
+                self._finish_journal(bool(failed))
+
+            return written
+
+    def _restore(self, failed):
+        """Put the entries of failed batches back under newer changes."""
+
+        for key, (original, state, seq) in failed.items():
+            newer = self._pending.get(key)
+            if newer is None:
+                self._pending[key] = (original, state, seq)
+            elif newer[1] == original:
+                del self._pending[key]
+            else:
+                self._pending[key] = (original, newer[1], newer[2])
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.max_delay)
+            self._wake.clear()
+            with self.app.app_context():
+                self.flush()
+
+    def _flush_at_exit(self):
+        if self.enabled and self.app is not None:
+            with self.app.app_context():
+                self.flush()
+
+        with self._lock:
+            if self._path is not None and not self._pending:
+                path = self._path
+                self._close_journal()
+                for leftover in [path, path + '.lock']:
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+
+    def _forked(self):
+        """In a forked child: start empty, without the parent's journal.
+
+        The parent still has its buffered changes and will write them; the
+        child opens a journal of its own when it first uses the buffer.
+        """
+
+        self._close_journal()
+        self._pending, self._flushing, self._user_seq = {}, {}, {}
+        self._lock, self._flush_lock, self._wake = Lock(), Lock(), Event()
+        self._thread = None
+        self._token = uuid.uuid4().hex[:8]
+
+    ##########################################################################
+    # Journal
+
+    def _open_journal(self):
+        """Open this process's journal on first use, taking over dead ones."""
+
+        if self._path is not None or not self.enabled or self.durability == 'memory':
+            return
+
+        with self._lock:
+            if self._path is not None:
+                return
+
+            path = f'{self.journal_path}.{os.getpid()}'
+            lock = _flock(path + '.lock')
+            if lock is None:
+                raise RuntimeError(f"Another write buffer in this process "
+                                   f"journals to {path}.")
+
+            # Our own journal is there too if a process with our pid died.
+            adopted = []
+            for lock_path in glob.glob(glob.escape(self.journal_path) + '.*.lock'):
+                if lock_path != path + '.lock':
+                    dead = _flock(lock_path)
+                    if dead is not None:
+                        adopted.append((lock_path[:-len('.lock')], dead))
+
+            self._path, self._journal_lock = path, lock
+            for journal in [path] + [journal for journal, _ in adopted]:
+                self._replay(journal)
+            self._rewrite_journal()
+
+            for journal, dead in adopted:
+                for leftover in [journal, journal + '.flushing', journal + '.lock']:
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+                dead.close()
+
+            waiting = bool(self._pending)
+
+        if waiting:
+            self._start_flusher()
+            self._wake.set()
+
+    def _close_journal(self):
+        for f in [self._journal, self._journal_lock]:
+            if f is not None:
+                f.close()
+        self._journal = self._journal_lock = self._path = None
+
+    def _log(self, kind, user_id, target_id, state):
+        if self._journal is None:
+            return
+
+        self._journal.write(f'{kind} {user_id} {target_id} {int(state)}\n')
+        self._journal.flush()
+        if self.durability == 'fsync':
+            os.fsync(self._journal.fileno())
+
+    def _rotate_journal(self):
+        """Move the journal aside while its entries are being written."""
+
+        if self._journal is None:
+            return
+
+        self._journal.close()
+        os.replace(self._path, self._path + '.flushing')
+        self._journal = open(self._path, 'a')
+
+    def _finish_journal(self, failed):
+        if self._journal is None:
+            return
+
+        if failed:
+            self._rewrite_journal()
+        else:
+            os.remove(self._path + '.flushing')
+
+    def _replay(self, journal):
+        """Load `journal` (and one being written at a crash) into the buffer."""
+
+        for path in [journal + '.flushing', journal]:
+            if not os.path.exists(path):
+                continue
+            with open(path) as journal:
+                for line in journal:
+                    try:
+                        kind, user_id, target_id, state = line.split()
+                        key = (kind, int(user_id), int(target_id))
+                        self._pending[key] = (None, state == '1', next(self._seq))
+                    except ValueError:
+                        # A line cut short by the crash.
+                        continue
+
+    def _rewrite_journal(self):
+        """Replace the journal(s) with one holding just what is buffered."""
+
+        if self._journal is not None:
+            self._journal.close()
+
+        temporary = self._path + '.tmp'
+        with open(temporary, 'w') as journal:
+            for (kind, user_id, target_id), (_, state, _) in self._pending.items():
+                journal.write(f'{kind} {user_id} {target_id} {int(state)}\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temporary, self._path)
+
+        if os.path.exists(self._path + '.flushing'):
+            os.remove(self._path + '.flushing')
+
+        self._journal = open(self._path, 'a')
+
+
+def _flock(path):
+    """Open `path` with an exclusive flock; None if another process holds it."""
+
+    lock = open(path, 'a')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+write_buffer = WriteBuffer()
+os.register_at_fork(after_in_child=write_buffer._forked)
+
+
+def init_app(app):
+    write_buffer.init_app(app)